@@ -0,0 +1,249 @@
+"""
+Aggregation of realization curves to mean, std, cov and quantile curves.
+
+Realizations are read in chunks of sites from a reader (HazardData, an OpenQuake hdf5 file or an arrow
+realization dataset), weighted and aggregated on a process pool. The chunk size is chosen so that the
+realizations held in memory (the chunks being aggregated plus the one being read) stay within a memory
+limit. Aggregates are returned as a HazardCube or written incrementally to a Parquet dataset that can be
+read back with store.curves_v4 (or store.sources.ArrowSource).
+"""
+
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, Optional, Protocol, Sequence, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from numpy.typing import NDArray
+
+from nzshm_hazlab.data_functions import aggregate_realizations
+from nzshm_hazlab.hazard_cube import HazardCube
+from nzshm_hazlab.locations import location_codes
+from nzshm_hazlab.store import curves_v4
+from nzshm_hazlab.store.columnar import list_column_to_matrix, matrix_to_list_array
+from nzshm_hazlab.store.sources import OQHDF5Source
+
+MEMORY_LIMIT = 2 * 1024**3
+# copies of the realizations made while aggregating (values, argsort, sorted values, weights, cumulative weights)
+WORKING_COPIES = 5
+
+
+class RealizationReader(Protocol):
+    locations: List[str]
+    imts: List[str]
+    levels: NDArray
+    weights: NDArray
+
+    def read(self, start: int, stop: int) -> NDArray:
+        """realization curves of locations[start:stop], (sites x imts x realizations x levels)"""
+        ...
+
+
+class HazardDataRealizations:
+    """realizations from a HazardData (toshi-hazard-store v2 realization tables)"""
+
+    def __init__(self, hazard_data, locations: Optional[List[str]] = None, imts: Optional[List[str]] = None):
+        self.hazard_data = hazard_data
+        self.locations = list(locations or hazard_data.locs)
+        self.imts = list(imts or hazard_data.imts)
+        self.weights = hazard_data.weights
+        self.levels = hazard_data.rlz_matrix(self.locations[0], self.imts[0]).lvls
+
+    def read(self, start: int, stop: int) -> NDArray:
+        # chunks are read in order: the first is queried in batches and each following one in the background
+        # while the one before it is read
+        if start == 0:
+            self.hazard_data.prefetch(self.locations[start:stop])
+        self.hazard_data.prefetch(self.locations[stop : 2 * stop - start], background=True)
+        return np.array(
+            [[self.hazard_data.rlz_matrix(loc, imt).vals for imt in self.imts] for loc in self.locations[start:stop]],
+            dtype='float64',
+        ).reshape(stop - start, len(self.imts), len(self.weights), len(self.levels))
+
+
+class HDF5Realizations:
+    """realizations from the hcurves-rlzs dataset of an OpenQuake hdf5 file (read a slice of sites at a time)"""
+
+    def __init__(self, source: OQHDF5Source, hazard_id: str, imts: Optional[List[str]] = None):
+        metadata = source.metadata(hazard_id)
+        self.filepath = source.files[hazard_id]
+        self.locations = list(metadata.locations)
+        self.imts = list(imts or metadata.imts)
+        self.levels = metadata.levels
+        self.weights = np.asarray(metadata.weights, dtype='float64')
+        self._imt_idx = [metadata.imts.index(imt) for imt in self.imts]
+
+    def read(self, start: int, stop: int) -> NDArray:
+        import h5py
+
+        with h5py.File(self.filepath, 'r') as hf:
+            # stored as [site, rlz, imt, level]
+            values = hf['hcurves-rlzs'][start:stop]
+        return np.transpose(values[:, :, self._imt_idx, :], (0, 2, 1, 3))
+
+
+class ArrowRealizations:
+    """
+    realizations from a hive partitioned Parquet dataset (fs_specs as for store.curves_v4) with a row per
+    location, imt and branch: nloc_001, imt, values and a branch column (rlz by default). weights maps each
+    branch to its weight; rows of other branches are ignored. partition_values (e.g. {'vs30': [400]}) select
+    the partitions to read.
+    """
+
+    def __init__(
+        self,
+        fs_specs: Dict[str, Any],
+        locs: Sequence,
+        imts: List[str],
+        weights: Dict[Any, float],
+        partition_values: Optional[Dict[str, List[Any]]] = None,
+        levels: NDArray = curves_v4.imtls,
+        branch_column: str = 'rlz',
+    ):
+        self.fs_specs = fs_specs
+        self.locations = location_codes(locs, curves_v4.RESOLUTION)
+        self.imts = list(imts)
+        self.branches = list(weights.keys())
+        self.weights = np.array(list(weights.values()), dtype='float64')
+        self.partition_values = partition_values or {}
+        self.levels = np.asarray(levels, dtype='float64')
+        self.branch_column = branch_column
+
+    def read(self, start: int, stop: int) -> NDArray:
+        codes = self.locations[start:stop]
+        flt = (
+            pc.is_in(pc.field('nloc_001'), pa.array(codes))
+            & pc.is_in(pc.field('imt'), pa.array(self.imts))
+            & pc.is_in(pc.field(self.branch_column), pa.array(self.branches))
+        )
+        for field, values in self.partition_values.items():
+            flt = flt & pc.is_in(pc.field(field), pa.array(values))
+        columns = ['nloc_001', 'imt', self.branch_column, 'values']
+        table = curves_v4.DATASETS.scanner(self.fs_specs, self.partition_values, flt, columns).to_table()
+
+        loc_idx = pc.index_in(table['nloc_001'], value_set=pa.array(codes)).to_numpy(zero_copy_only=False)
+        imt_idx = pc.index_in(table['imt'], value_set=pa.array(self.imts)).to_numpy(zero_copy_only=False)
+        rlz_idx = pc.index_in(table[self.branch_column], value_set=pa.array(self.branches)).to_numpy(zero_copy_only=False)
+        values = np.full((len(codes), len(self.imts), len(self.branches), len(self.levels)), np.nan)
+        values[loc_idx, imt_idx, rlz_idx, :] = list_column_to_matrix(table['values'])
+        return values
+
+
+def sites_per_chunk(reader: RealizationReader, memory_limit: int, workers: int) -> int:
+    """the number of sites to read at a time so that workers + 1 chunks fit within memory_limit bytes"""
+
+    site_bytes = len(reader.imts) * len(reader.weights) * len(reader.levels) * 8 * WORKING_COPIES
+    return int(max(1, min(len(reader.locations), memory_limit // (site_bytes * (workers + 1)))))
+
+
+def iter_aggregates(
+    reader: RealizationReader,
+    aggs: Sequence[str],
+    memory_limit: int = MEMORY_LIMIT,
+    max_workers: Optional[int] = None,
+    chunk_sites: Optional[int] = None,
+) -> Iterator[Tuple[int, int, NDArray]]:
+    """
+    aggregate the realizations of reader chunk by chunk, yielding (start, stop, aggregates) with aggregates
+    the (sites x imts x aggs x levels) array for locations[start:stop], in site order. Chunks are aggregated on
+    a pool of max_workers processes (all cores by default, no pool if max_workers is 1).
+    """
+
+    workers = max_workers or os.cpu_count() or 1
+    chunk_sites = chunk_sites or sites_per_chunk(reader, memory_limit, workers)
+    aggs = [str(agg) for agg in aggs]
+    chunks = [(start, min(start + chunk_sites, len(reader.locations))) for start in range(0, len(reader.locations), chunk_sites)]
+
+    if workers == 1:
+        for start, stop in chunks:
+            yield start, stop, aggregate_realizations(reader.read(start, stop), reader.weights, aggs)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending: Deque[Tuple[int, int, Future]] = deque()
+        for start, stop in chunks:
+            values = reader.read(start, stop)
+            pending.append((start, stop, executor.submit(aggregate_realizations, values, reader.weights, aggs)))
+            del values
+            if len(pending) >= workers:
+                start, stop, future = pending.popleft()
+                yield start, stop, future.result()
+        while pending:
+            start, stop, future = pending.popleft()
+            yield start, stop, future.result()
+
+
+def aggregate(
+    reader: RealizationReader,
+    aggs: Sequence[str],
+    memory_limit: int = MEMORY_LIMIT,
+    max_workers: Optional[int] = None,
+    chunk_sites: Optional[int] = None,
+) -> HazardCube:
+    """aggregate all the realizations of reader (see iter_aggregates) into a HazardCube"""
+
+    aggs = [str(agg) for agg in aggs]
+    values = np.empty((len(reader.locations), len(reader.imts), len(aggs), len(reader.levels)))
+    for start, stop, aggregates in iter_aggregates(reader, aggs, memory_limit, max_workers, chunk_sites):
+        values[start:stop] = aggregates
+    return HazardCube(values, reader.levels, reader.locations, reader.imts, aggs)
+
+
+def aggregate_to_dataset(
+    reader: RealizationReader,
+    aggs: Sequence[str],
+    root: Union[str, Path],
+    hazard_id: str,
+    vs30: int,
+    memory_limit: int = MEMORY_LIMIT,
+    max_workers: Optional[int] = None,
+    chunk_sites: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    aggregate the realizations of reader (locations must be lat~lon codes) writing each chunk as it is done to
+    a Parquet dataset in the layout of store.curves_v4 (<root>/hazard_model_id=<id>/vs30=<vs30>/). Returns the
+    fs_specs to read it. The layout has no levels column (curves_v4 assumes the imtls levels) so the reader must
+    have the imtls levels.
+    """
+
+    levels = np.asarray(reader.levels, dtype='float64')
+    if levels.shape != curves_v4.imtls.shape or not np.allclose(levels, curves_v4.imtls):
+        raise ValueError(
+            f'the curves_v4 layout requires the {len(curves_v4.imtls)} imtls levels, the reader has {len(levels)} '
+            'different levels'
+        )
+
+    aggs = [str(agg) for agg in aggs]
+    partition = Path(root) / f'hazard_model_id={hazard_id}' / f'vs30={vs30}'
+    partition.mkdir(parents=True, exist_ok=True)
+    nimt, nagg = len(reader.imts), len(aggs)
+
+    writer = None
+    try:
+        for start, stop, aggregates in iter_aggregates(reader, aggs, memory_limit, max_workers, chunk_sites):
+            codes = np.array(reader.locations[start:stop], dtype=object)
+            lat_lon = np.array([code.split('~') for code in codes], dtype='float64').reshape(-1, 2)
+            loc_idx = np.repeat(np.arange(stop - start), nimt * nagg)
+            table = pa.table(
+                {
+                    'agg': pa.array(np.tile(aggs, (stop - start) * nimt), pa.string()),
+                    'imt': pa.array(np.tile(np.repeat(reader.imts, nagg), stop - start), pa.string()),
+                    'lat': pa.array(lat_lon[loc_idx, 0]),
+                    'lon': pa.array(lat_lon[loc_idx, 1]),
+                    'nloc_001': pa.array(codes[loc_idx], pa.string()),
+                    'values': matrix_to_list_array(aggregates.reshape(-1, len(reader.levels))),
+                }
+            )
+            if writer is None:
+                writer = pq.ParquetWriter(partition / 'part-0.parquet', table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    curves_v4.DATASETS.clear()
+    return {'arrow_fs': curves_v4.ArrowFS.LOCAL, 'arrow_dir': str(root)}
@@ -1,11 +1,16 @@
 import numpy as np
+from collections import namedtuple
 from toshi_hazard_store import model, query
 from pandas import DataFrame
-from typing import List
+from typing import List, Optional, Sequence, Tuple, Union
 from nzshm_common.location import CodedLocation
 import pandas as pd
 from numpy.typing import NDArray
 
+from nzshm_hazlab.base_functions import acc_to_disp, period_from_imt
+from nzshm_hazlab.hazard_cube import HazardCube
+from nzshm_hazlab.locations import LocationArray
+
 def rp_from_poe(poe, inv_time):
 
     return -inv_time/np.log(1-poe)
@@ -16,51 +21,208 @@ def poe_from_rp(rp, inv_time):
     return 1 - np.exp(-inv_time/rp)
 
 
+RESOLUTION = 0.001
+BLOCK_CURVES = 100_000
+STAT_AGGS = ('mean', 'std', 'cov')
+
+UHS = namedtuple('UHS', 'locations aggs poes imts periods acc disp')
+
+
 def interp_hazard(levels: NDArray, values: NDArray, poe: float, inv_time: float) -> NDArray:
-    
-    rp = -inv_time/np.log(1-poe)
-    try:
-        haz = np.exp( np.interp( np.log(1/rp), np.flip(np.log(values)), np.flip(np.log(levels)) ) )
-    except:
-        breakpoint()
-    return haz
+
+    return compute_hazard_at_poe(levels, values, poe, inv_time)
 
 
 def compute_hazard_at_poe(levels: NDArray,values: NDArray, poe: float, inv_time: float) -> NDArray:
+    """hazard at a single poe for one curve, (L,), or many curves, (..., L) (see compute_hazard_at_poes)"""
 
-    # TODO: fix calls to cast args to NDArray before using this function 
-    if len(values.shape) == 1:
-        return interp_hazard(levels, values, poe, inv_time)
-    else:
-        nrows = values.shape[0]
-        haz = np.empty((nrows,))
-        for row_i in range(values.shape[0]):
-            haz[row_i] = interp_hazard(levels, values[row_i,:], poe, inv_time)
-    return haz
+    return compute_hazard_at_poes(levels, values, [poe], inv_time)[..., 0][()]
+
+
+def _hazard_at_poes_block(log_levels: NDArray, log_values: NDArray, target: NDArray) -> NDArray:
+    """(N, L) log apoe, (K,) log target poe -> (N, K) log hazard"""
+
+    nlevels = len(log_levels)
+    # curves decrease with level so the number of levels with apoe above a target is where it would be
+    # inserted in the (reversed) curve, i.e. a searchsorted done for all curves and targets at once. Zero
+    # and NaN apoe (log -inf and NaN) are never above a target so they are left out of the interpolation.
+    count = np.sum(log_values[:, np.newaxis, :] >= target[:, np.newaxis], axis=-1)  # (N, K)
+    i1 = np.clip(count, 1, nlevels - 1)
+    i0 = i1 - 1
+    v0 = np.take_along_axis(log_values, i0, axis=-1)
+    v1 = np.take_along_axis(log_values, i1, axis=-1)
+    frac = np.clip((target - v0) / (v1 - v0), 0, 1)
+    frac = np.where(np.isfinite(frac), frac, 0)
+    log_haz = log_levels[i0] + frac * (log_levels[i1] - log_levels[i0])
+    log_haz = np.where(count == 0, log_levels[0], log_haz)
+    return np.where(count == nlevels, log_levels[-1], log_haz)
 
 
-def get_poe_df(hazard: DataFrame, locations: List[CodedLocation], imt, agg, poe, inv_time):
+def compute_hazard_at_poes(levels: NDArray, values: NDArray, poes: NDArray, inv_time: float) -> NDArray:
+    """
+    hazard at several poes for many curves in one pass (log-log interpolation). values has the levels along
+    the last axis, (..., L), the result has the poes along the last axis, (..., K). Hazard is clamped to the
+    first and last levels, zero and NaN apoe are masked out and curves that are all NaN (e.g. not loaded)
+    give NaN. Curves are processed in blocks of BLOCK_CURVES to bound the size of the temporary arrays.
+    """
+
+    values = np.asarray(values, dtype='float64')
+    log_levels = np.log(np.asarray(levels, dtype='float64'))
+    target = np.log(1 / rp_from_poe(np.asarray(poes, dtype='float64').reshape(-1), inv_time))
+
+    curves = values.reshape(-1, values.shape[-1])
+    log_haz = np.empty((len(curves), len(target)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, len(curves), BLOCK_CURVES):
+            block = curves[start : start + BLOCK_CURVES]
+            log_haz[start : start + BLOCK_CURVES] = _hazard_at_poes_block(log_levels, np.log(block), target)
+
+    haz = np.exp(log_haz).reshape(values.shape[:-1] + (len(target),))
+    return np.where(np.all(np.isnan(values), axis=-1)[..., np.newaxis], np.nan, haz)
+
+
+def compute_poe_at_intensities(levels: NDArray, values: NDArray, intensities: NDArray) -> NDArray:
+    """
+    probability of exceedance at several intensities for many curves in one pass (log-log interpolation
+    between levels, the inverse of compute_hazard_at_poes). values has the levels along the last axis,
+    (..., L), the result has the intensities along the last axis, (..., M). Intensities outside the levels
+    are clamped to the first and last levels. Zero apoe gives zero between it and the previous level.
+    """
+
+    values = np.asarray(values, dtype='float64')
+    log_levels = np.log(np.asarray(levels, dtype='float64'))
+    log_target = np.log(np.clip(np.asarray(intensities, dtype='float64').reshape(-1), levels[0], levels[-1]))
+
+    # the levels are shared by all curves so the interval of each intensity is found once
+    i1 = np.clip(np.searchsorted(log_levels, log_target), 1, len(log_levels) - 1)
+    i0 = i1 - 1
+    frac = (log_target - log_levels[i0]) / (log_levels[i1] - log_levels[i0])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        v0 = np.log(values[..., i0])
+        v1 = np.log(values[..., i1])
+        log_poe = np.where(v0 == v1, v0, v0 + frac * (v1 - v0))
+        log_poe = np.where(frac == 0, v0, np.where(frac == 1, v1, log_poe))
+    return np.exp(log_poe)
+
+
+def compute_rate_at_intensities(levels: NDArray, values: NDArray, intensities: NDArray, inv_time: float = 1.0) -> NDArray:
+    """
+    annual rate of exceedance at several intensities for many curves (see compute_poe_at_intensities) from
+    probabilities of exceedance in inv_time years
+    """
+
+    poe = compute_poe_at_intensities(levels, values, intensities)
+    return -np.log(1.0 - poe) / inv_time
+
+
+def _location_keys(lat: NDArray, lon: NDArray) -> NDArray:
+    """integer keys identifying locations at RESOLUTION from float lat and lon"""
+
+    lat_i = np.round(np.asarray(lat, dtype='float64') / RESOLUTION).astype('int64')
+    lon_i = np.round(np.asarray(lon, dtype='float64') / RESOLUTION).astype('int64')
+    return lat_i * 1_000_000 + lon_i
+
+
+def _curve_matrix(hazard: DataFrame, imt, agg) -> Tuple[NDArray, NDArray, NDArray]:
+    """location keys, levels and (location x level) apoe of the imt and agg curves in a DataFrame"""
 
     hazard = hazard.loc[(hazard['agg'] == agg) & (hazard['imt'] == imt)]
-    hazard['location_code'] = hazard['lat'] + '~' + hazard['lon']
-    location_codes = [loc.code for loc in locations]
-    hazard = hazard[hazard['location_code'].isin(location_codes)]
-
-    hazard = hazard.drop(labels=['lat','lon','imt','agg'], axis=1)\
-        .pivot(index='location_code', columns='level')
-    ordered_loc_codes = hazard.index
-    hazard = hazard.droplevel(0, axis=1)
-    levels = hazard.columns.to_numpy()
-    hazard.index = range(0,len(locations))
-    hazard.columns.name = None
-    level_at_poe = compute_hazard_at_poe(levels, hazard.to_numpy(), poe, inv_time)
-    
-    haz_poe = pd.DataFrame(columns = ['lat', 'lon', 'level'], index = range(len(ordered_loc_codes)), dtype='float64')
-    haz_poe['level'] = level_at_poe
-    haz_poe['lat'] = [float(loc.split('~')[0]) for loc in ordered_loc_codes]
-    haz_poe['lon'] = [float(loc.split('~')[1]) for loc in ordered_loc_codes]
-    
-    return haz_poe
+    keys = _location_keys(hazard['lat'].to_numpy(dtype='float64'), hazard['lon'].to_numpy(dtype='float64'))
+    if hazard['apoe'].dtype == object:
+        # a row per curve with level and apoe arrays (the store.curves.get_hazard layout)
+        if hazard.empty:
+            return keys, np.empty((0,)), np.empty((0, 0))
+        return keys, np.asarray(hazard['level'].iloc[0], dtype='float64'), np.vstack(hazard['apoe'].to_numpy())
+
+    # a row per curve point (the store.curves.get_hazard_v1 layout)
+    curve_idx, curve_keys = pd.factorize(keys)
+    levels, level_idx = np.unique(hazard['level'].to_numpy(dtype='float64'), return_inverse=True)
+    values = np.full((len(curve_keys), len(levels)), np.nan)
+    values[curve_idx, level_idx] = hazard['apoe'].to_numpy(dtype='float64')
+    return np.asarray(curve_keys), levels, values
+
+
+def get_poe_df(
+    hazard: Union[DataFrame, HazardCube], locations: List[CodedLocation], imt, agg, poe, inv_time
+) -> DataFrame:
+    """
+    hazard at poe for each of the locations, in the order given, as lat, lon and level float columns. hazard is
+    a HazardCube or a DataFrame in the get_hazard or get_hazard_v1 layout. Locations with no curve have a NaN
+    level.
+    """
+
+    if isinstance(locations, LocationArray):
+        lat, lon = locations.lat, locations.lon
+    else:
+        lat = np.fromiter((loc.lat for loc in locations), dtype='float64', count=len(locations))
+        lon = np.fromiter((loc.lon for loc in locations), dtype='float64', count=len(locations))
+
+    if isinstance(hazard, HazardCube):
+        levels = hazard.levels
+        curves = hazard[:, imt, agg]
+        positions = pd.Index(_location_keys(hazard.lat, hazard.lon)).get_indexer(_location_keys(lat, lon))
+    else:
+        keys, levels, curves = _curve_matrix(hazard, imt, agg)
+        positions = pd.Index(keys).get_indexer(_location_keys(lat, lon))
+
+    values = np.full((len(positions), len(levels)), np.nan)
+    found = positions >= 0
+    values[found] = curves[positions[found]]
+    level = compute_hazard_at_poe(levels, values, poe, inv_time) if len(levels) else np.full(len(positions), np.nan)
+    return pd.DataFrame({'lat': lat, 'lon': lon, 'level': level})
+
+
+def compute_uhs(
+    hazard: Union[DataFrame, HazardCube],
+    poes: Sequence[float],
+    inv_time: float,
+    aggs: Optional[Sequence[str]] = None,
+    imts: Optional[Sequence[str]] = None,
+) -> UHS:
+    """
+    uniform hazard spectra of every location, agg and poe in one pass. hazard is a HazardCube or a DataFrame in
+    the get_hazard layout (aggs and imts default to all of those in hazard). acc is the (location x agg x poe x
+    period) array of spectral acceleration with periods in increasing order (period_from_imt) and disp the
+    corresponding spectral displacement (acc_to_disp).
+    """
+
+    if not isinstance(hazard, HazardCube):
+        hazard = HazardCube.from_dataframe(hazard)
+    aggs = hazard.aggs if aggs is None else [str(agg) for agg in aggs]
+    imts = hazard.imts if imts is None else list(imts)
+    poes = np.asarray(poes, dtype='float64').reshape(-1)
+
+    periods = np.array([period_from_imt(imt) for imt in imts], dtype='float64')
+    order = np.argsort(periods, kind='stable')
+    periods = periods[order]
+    imts = [imts[i] for i in order]
+
+    # (location x imt x agg x poe) -> (location x agg x poe x period)
+    acc = compute_hazard_at_poes(hazard.levels, hazard[:, imts, aggs], poes, inv_time)
+    acc = np.ascontiguousarray(np.transpose(acc, (0, 2, 3, 1)))
+    return UHS(list(hazard.locations), aggs, poes, imts, periods, acc, acc_to_disp(acc, periods))
+
+
+def uhs_to_dataframe(uhs: UHS, disp: bool = False) -> DataFrame:
+    """
+    a row per location, agg and poe with lat, lon, agg and poe columns and a column of acceleration (or
+    displacement) per imt
+    """
+
+    nloc, nagg, npoe, _ = uhs.acc.shape
+    loc_idx, agg_idx, poe_idx = (idx.reshape(-1) for idx in np.indices((nloc, nagg, npoe)))
+    lat_lon = np.array([loc.split('~') for loc in uhs.locations], dtype=object).reshape(nloc, 2)
+    spectra = (uhs.disp if disp else uhs.acc).reshape(-1, len(uhs.imts))
+    uhs_df = pd.DataFrame(
+        {
+            'lat': lat_lon[loc_idx, 0],
+            'lon': lat_lon[loc_idx, 1],
+            'agg': np.array(uhs.aggs, dtype=object)[agg_idx],
+            'poe': uhs.poes[poe_idx],
+        }
+    )
+    return pd.concat([uhs_df, pd.DataFrame(spectra, columns=uhs.imts)], axis=1)
 
     
 def weighted_quantile(values, quantiles, sample_weight=None, 
@@ -107,18 +269,91 @@ def weighted_quantile(values, quantiles, sample_weight=None,
 
     
 
-# def calculate_agg(hazard_data, location, imt, agg):
-#     for irlz in range(hazard_data.nrlzs):
-#         if irlz == 0:
-#             levels = np.array(hazard_data.values(location=location,imt=imt,realization=irlz).lvls)
-#             values = np.array(hazard_data.values(location=location,imt=imt,realization=irlz).vals)
-#         else:
-#             values = np.vstack((values,np.array(hazard_data.values(location=location,imt=imt,realization=irlz).vals)))
-
-#     weights = np.array(list(hazard_data.rlz_lt['weight'].values()))
-#     agg_values = np.array([]) #TODO pre-allocate memory
-#     for i,level in enumerate(levels):
-#         quantiles = weighted_quantile(values[:,i],[agg],sample_weight=weights)
-#         agg_values = np.append(agg_values,np.array(quantiles))
-
-#     return agg_values
+def weighted_quantiles(
+    values: NDArray, quantiles: Sequence[float], sample_weight: Optional[NDArray] = None, old_style: bool = False
+) -> NDArray:
+    """
+    weighted quantiles of realizations along the second last axis for every level and site at once (the
+    quantile definition of weighted_quantile). values is (R realizations x L levels) or stacked (..., R, L),
+    the result is (..., Q, L) with the quantiles in the order given. The realizations are sorted once with an
+    argsort along the realization axis.
+    """
+
+    values = np.asarray(values, dtype='float64')
+    nrlz = values.shape[-2]
+    sample_weight = np.ones(nrlz) if sample_weight is None else np.asarray(sample_weight, dtype='float64')
+    quantiles = np.asarray(quantiles, dtype='float64').reshape(-1)
+    assert np.all(quantiles >= 0) and np.all(quantiles <= 1), 'quantiles should be in [0, 1]'
+
+    if nrlz == 1:
+        return np.repeat(values, len(quantiles), axis=-2)
+
+    sorter = np.argsort(values, axis=-2)
+    values = np.take_along_axis(values, sorter, axis=-2)
+    sorted_weight = sample_weight[sorter]
+    cum_weight = np.cumsum(sorted_weight, axis=-2) - 0.5 * sorted_weight
+    if old_style:
+        cum_weight -= cum_weight[..., :1, :]
+        cum_weight /= cum_weight[..., -1:, :]
+    else:
+        cum_weight /= np.sum(sample_weight)
+
+    result = np.empty(values.shape[:-2] + (len(quantiles), values.shape[-1]))
+    for k, quantile in enumerate(quantiles):
+        # interpolate between the realizations either side of the quantile (clamped at the ends like np.interp)
+        i1 = np.clip(np.sum(cum_weight <= quantile, axis=-2, keepdims=True), 1, nrlz - 1)
+        i0 = i1 - 1
+        w0 = np.take_along_axis(cum_weight, i0, axis=-2)
+        w1 = np.take_along_axis(cum_weight, i1, axis=-2)
+        v0 = np.take_along_axis(values, i0, axis=-2)
+        v1 = np.take_along_axis(values, i1, axis=-2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = np.clip((quantile - w0) / (w1 - w0), 0, 1)
+        frac = np.where(np.isfinite(frac), frac, 1)
+        result[..., k, :] = (v0 + frac * (v1 - v0))[..., 0, :]
+    return result
+
+
+def weighted_stats(values: NDArray, sample_weight: Optional[NDArray] = None) -> Tuple[NDArray, NDArray, NDArray]:
+    """weighted mean, standard deviation and coefficient of variation over the realization (second last) axis"""
+
+    values = np.asarray(values, dtype='float64')
+    nrlz = values.shape[-2]
+    sample_weight = np.ones(nrlz) if sample_weight is None else np.asarray(sample_weight, dtype='float64')
+    weight = (sample_weight / np.sum(sample_weight))[:, np.newaxis]
+    mean = np.sum(weight * values, axis=-2)
+    std = np.sqrt(np.sum(weight * (values - mean[..., np.newaxis, :]) ** 2, axis=-2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = std / mean
+    return mean, std, cov
+
+
+def aggregate_realizations(values: NDArray, sample_weight: NDArray, aggs: Sequence[str]) -> NDArray:
+    """
+    aggregate realization curves, (R x L) or (..., R, L), to (..., A, L) for the aggs in the order given:
+    'mean', 'std', 'cov' or a quantile (e.g. '0.1' or 0.1)
+    """
+
+    values = np.asarray(values, dtype='float64')
+    aggs = [str(agg) for agg in aggs]
+    result = np.empty(values.shape[:-2] + (len(aggs), values.shape[-1]))
+
+    stats = [agg for agg in aggs if agg in STAT_AGGS]
+    if stats:
+        stat_values = dict(zip(STAT_AGGS, weighted_stats(values, sample_weight)))
+        for agg in stats:
+            result[..., aggs.index(agg), :] = stat_values[agg]
+
+    quantile_aggs = [agg for agg in aggs if agg not in STAT_AGGS]
+    if quantile_aggs:
+        quantiles = weighted_quantiles(values, [float(agg) for agg in quantile_aggs], sample_weight)
+        for k, agg in enumerate(quantile_aggs):
+            result[..., aggs.index(agg), :] = quantiles[..., k, :]
+    return result
+
+
+def calculate_agg(hazard_data, location, imt, agg):
+    """aggregate ('mean', 'std', 'cov' or a quantile) of the realizations of a HazardData at one location and imt"""
+
+    realizations = hazard_data.rlz_matrix(location, imt)
+    return aggregate_realizations(realizations.vals, realizations.weights, [agg])[0]
@@ -0,0 +1,165 @@
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+from nzshm_common.location import CodedLocation
+from numpy.typing import NDArray
+from pandas import DataFrame
+
+from nzshm_hazlab.locations import LocationArray, location_codes
+from nzshm_hazlab.store.columnar import CurveArrays, format_coords
+
+RESOLUTION = 0.001
+
+Key = Union[str, CodedLocation, Sequence, slice, None]
+
+
+def _location_code(location: Union[str, CodedLocation]) -> str:
+    if isinstance(location, CodedLocation):
+        return location.downsample(RESOLUTION).code
+    return location
+
+
+class HazardCube:
+    """
+    Dense hazard curves indexed [location, imt, agg, level] backed by a single contiguous float array.
+
+    Locations (as lat~lon codes), imts and aggs are mapped to array positions with dictionaries and all
+    curves share one levels vector. Curves that were not loaded are NaN.
+
+    cube['-41.300~174.780', 'PGA', 'mean'] returns a single curve (a view into the array), lists select
+    several entries along an axis and slices or None select the whole axis, e.g. cube[:, 'PGA', ['0.1', '0.9']].
+    """
+
+    def __init__(self, values: NDArray, levels: NDArray, locations: List[str], imts: List[str], aggs: List[str]):
+        values = np.ascontiguousarray(values, dtype='float64')
+        levels = np.asarray(levels, dtype='float64')
+        expected = (len(locations), len(imts), len(aggs), len(levels))
+        if values.shape != expected:
+            raise ValueError(f'values has shape {values.shape}, expected {expected}')
+
+        self.values = values
+        self.levels = levels
+        self.locations = list(locations)
+        self.imts = list(imts)
+        self.aggs = list(aggs)
+        self.location_index: Dict[str, int] = {loc: i for i, loc in enumerate(self.locations)}
+        self.imt_index: Dict[str, int] = {imt: i for i, imt in enumerate(self.imts)}
+        self.agg_index: Dict[str, int] = {agg: i for i, agg in enumerate(self.aggs)}
+
+    def __repr__(self) -> str:
+        return (
+            f'HazardCube(locations={len(self.locations)}, imts={len(self.imts)}, '
+            f'aggs={len(self.aggs)}, levels={len(self.levels)})'
+        )
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def lat(self) -> NDArray:
+        return np.array([float(loc.split('~')[0]) for loc in self.locations])
+
+    @property
+    def lon(self) -> NDArray:
+        return np.array([float(loc.split('~')[1]) for loc in self.locations])
+
+    def _indices(self, axis: int, key: Key):
+        if key is None or isinstance(key, slice):
+            return slice(None) if key is None else key
+        index = (self.location_index, self.imt_index, self.agg_index)[axis]
+        if axis == 0:
+            if isinstance(key, (str, CodedLocation)):
+                return index[_location_code(key)]
+            if isinstance(key, LocationArray):
+                return [index[code] for code in location_codes(key, RESOLUTION)]
+            return [index[_location_code(k)] for k in key]
+        if isinstance(key, str):
+            return index[key]
+        return [index[k] for k in key]
+
+    def __getitem__(self, key) -> NDArray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        idx = [self._indices(axis, k) for axis, k in enumerate(key)]
+
+        values = self.values
+        for axis, i in enumerate(idx):
+            if isinstance(i, list):
+                values = np.take(values, i, axis=axis)
+        basic = tuple(slice(None) if isinstance(i, list) else i for i in idx)
+        return values[basic]
+
+    def curve(self, location: Union[str, CodedLocation], imt: str, agg: str) -> NDArray:
+        return self.values[self.location_index[_location_code(location)], self.imt_index[imt], self.agg_index[agg]]
+
+    def sel(
+        self,
+        locations: Optional[Sequence[Union[str, CodedLocation]]] = None,
+        imts: Optional[Sequence[str]] = None,
+        aggs: Optional[Sequence[str]] = None,
+    ) -> 'HazardCube':
+        """a new cube with a subset of locations, imts and/or aggs (in the order given)"""
+
+        if locations is None:
+            locations = self.locations
+        elif isinstance(locations, LocationArray):
+            locations = location_codes(locations, RESOLUTION)
+        else:
+            locations = [_location_code(loc) for loc in locations]
+        imts = self.imts if imts is None else list(imts)
+        aggs = self.aggs if aggs is None else list(aggs)
+        return HazardCube(self[locations, imts, aggs], self.levels, locations, imts, aggs)
+
+    @classmethod
+    def from_arrays(cls, arrays: CurveArrays) -> 'HazardCube':
+        """build a cube from raw columns (see store.columnar.CurveArrays); all curves must share levels"""
+
+        level = np.asarray(arrays.level, dtype='float64')
+        if len(level) and not np.allclose(level, level[0], equal_nan=True):
+            raise ValueError('all curves in a HazardCube must have the same levels')
+        levels = level[0] if len(level) else np.empty((level.shape[1] if level.ndim == 2 else 0,))
+
+        codes = np.char.add(np.char.add(format_coords(arrays.lat).astype(str), '~'), format_coords(arrays.lon).astype(str))
+        loc_idx, locations = pd.factorize(codes)
+        imt_idx, imts = pd.factorize(np.asarray(arrays.imt, dtype=object))
+        agg_idx, aggs = pd.factorize(np.asarray(arrays.agg, dtype=object))
+
+        values = np.full((len(locations), len(imts), len(aggs), len(levels)), np.nan)
+        values[loc_idx, imt_idx, agg_idx, :] = arrays.apoe
+        return cls(values, levels, list(locations), list(imts), list(aggs))
+
+    @classmethod
+    def from_dataframe(cls, hazard_curves: DataFrame) -> 'HazardCube':
+        """build a cube from the store.curves.get_hazard layout (a row per curve with level and apoe arrays)"""
+
+        hazard_curves = hazard_curves.dropna(subset=['apoe'])
+        if hazard_curves.empty:
+            return cls(np.empty((0, 0, 0, 0)), np.empty((0,)), [], [], [])
+        arrays = CurveArrays(
+            lat=hazard_curves['lat'].astype(float).to_numpy(),
+            lon=hazard_curves['lon'].astype(float).to_numpy(),
+            imt=hazard_curves['imt'].to_numpy(),
+            agg=hazard_curves['agg'].to_numpy(),
+            level=np.vstack(hazard_curves['level'].to_numpy()),
+            apoe=np.vstack(hazard_curves['apoe'].to_numpy()),
+        )
+        return cls.from_arrays(arrays)
+
+    def to_dataframe(self) -> DataFrame:
+        """convert to the store.curves.get_hazard layout, skipping curves that were not loaded"""
+
+        nloc, nimt, nagg, _ = self.values.shape
+        loc_idx, imt_idx, agg_idx = np.nonzero(~np.all(np.isnan(self.values), axis=3))
+        lat_lon = np.array([loc.split('~') for loc in self.locations], dtype=object).reshape(nloc, 2)
+        return pd.DataFrame(
+            {
+                'lat': lat_lon[loc_idx, 0],
+                'lon': lat_lon[loc_idx, 1],
+                'imt': np.array(self.imts, dtype=object)[imt_idx],
+                'agg': np.array(self.aggs, dtype=object)[agg_idx],
+                'level': [self.levels] * len(loc_idx),
+                'apoe': list(self.values[loc_idx, imt_idx, agg_idx]),
+            }
+        )
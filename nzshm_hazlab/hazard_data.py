@@ -1,144 +1,428 @@
 import ast
-from collections import UserDict, namedtuple
-from functools import lru_cache
-
+import json
+import logging
+import threading
+from collections import OrderedDict, UserDict, defaultdict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import cached_property, partial
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
 from toshi_hazard_store import query
 
-def encode_key(imt,location,realization):
-    realization = f'{int(realization):05d}' if str(realization).isdigit() else realization        
-    return ':'.join(map(str,(imt,location,realization)))
+log = logging.getLogger(__name__)
+
+
+RESOLUTION = 0.001
+MEMORY_LIMIT = 1024**3
+BATCH_SIZE = 10
+METADATA_FILE = 'metadata.json'
+METADATA_FIELDS = ['imts', 'vs30', 'aggs', 'haz_sol_id', 'hazsol_vs30_rk', 'locs']
+LOGIC_TREES = ['gsim_lt', 'rlz_lt', 'src_lt']
+
+CacheInfo = namedtuple("CacheInfo","hits misses maxsize currsize nbytes")
+
+
+def _kind(realization):
+    return 'rlz' if str(realization).isdigit() else 'agg'
+
+
+def _location_key(code):
+    """locations are matched at RESOLUTION so that differently formatted codes of a location are the same"""
+    try:
+        lat, lon = code.split('~')
+        return round(float(lat) / RESOLUTION), round(float(lon) / RESOLUTION)
+    except ValueError:
+        return code
+
 
-def decode_key(key):
-    Key = namedtuple("Key","imt location realization")
-    key_tuple = Key(*key.split(':'))
-    return key_tuple
+def _to_json(obj):
+    """
+    a json serialisable copy of metadata that _from_json restores exactly: dicts with keys that are not all
+    strings (e.g. the integer branch indices of the logic trees) become lists of items and tuples and sets (the
+    THS imts, aggs and locs) are tagged
+    """
+    if isinstance(obj, dict):
+        if all(isinstance(key, str) for key in obj):
+            return {key: _to_json(value) for key, value in obj.items()}
+        return {'__items__': [[_to_json(key), _to_json(value)] for key, value in obj.items()]}
+    if isinstance(obj, tuple):
+        return {'__tuple__': [_to_json(value) for value in obj]}
+    if isinstance(obj, (set, frozenset)):
+        # sorted so that a snapshot of the same metadata is always written the same way
+        return {'__set__': [_to_json(value) for value in sorted(obj, key=repr)]}
+    if isinstance(obj, list):
+        return [_to_json(value) for value in obj]
+    return obj
+
+
+def _from_json(obj):
+    if list(obj) == ['__items__']:
+        return {key: value for key, value in obj['__items__']}
+    if list(obj) == ['__tuple__']:
+        return tuple(obj['__tuple__'])
+    if list(obj) == ['__set__']:
+        return set(obj['__set__'])
+    return obj
+
+
+def _realization(realization):
+    """realizations are identified by their integer index and aggregates by name"""
+    return int(realization) if _kind(realization) == 'rlz' else str(realization)
 
 
 class LazyData(UserDict):
+    """
+    Curves of a hazard solution, queried from THS a location at a time as they are first accessed or in
+    batches of locations with prefetch (optionally on a background thread). The realization (or aggregate)
+    curves of a location and imt are stored together as a Curves: the levels, a (curves x levels) array and
+    the row of each realization, keyed by ('rlz' or 'agg', location, imt). Loaded curves are kept in least
+    recently used order and the least recently used are evicted once they take more than memory_limit bytes
+    (no limit if None). hits and misses count the lookups served from memory (or a prefetch) and those that
+    needed a query.
+    """
 
     Values = namedtuple("Values","lvls vals")
+    Curves = namedtuple("Curves","lvls vals index")
 
-    def __init__(self,hazard_id):
+    def __init__(self,hazard_id,memory_limit: Optional[int] = MEMORY_LIMIT):
         self._hazard_id = hazard_id 
+        self.memory_limit = memory_limit
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
         super().__init__()
+        self.data = OrderedDict()
+        self._lock = threading.RLock()
+        self._pending: Dict[Tuple[str, str], Future] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
 
     def __getitem__(self, key):
-        if not self.data.get(key):
-            q = self._run_query(key)
-            k = decode_key(key)
-
-            if k.realization.isdigit():
-                self._load_all_rlz(q,k)
-            else:
-                self._load_all_agg(q,k)
-
-        return self.data[key]
+        kind, location, _ = key
+        with self._lock:
+            if key in self.data:
+                self.hits += 1
+                return self._use(key)
+            future = self._pending.get((kind, location))
+
+        if future:
+            future.result()
+            with self._lock:
+                if key in self.data:
+                    self.hits += 1
+                    return self._use(key)
+
+        entries = self._query(kind, [location])
+        # stored and marked most recently used in one hold of the lock so a background prefetch cannot evict
+        # the requested curves in between
+        with self._lock:
+            self.misses += 1
+            self._insert(entries)
+            return self._use(key)
 
     def __setitem__(self, key, item) -> None:
         raise Exception("LazyData: cannot set items")
 
-    def _load_all_rlz(self,q,k):
-        for re in q:
-            for val_imt in re.values:
-                new_key = encode_key(val_imt.imt, k.location, re.rlz)
-                self.data[new_key] = self.Values(lvls=val_imt.lvls,vals=val_imt.vals)
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.memory_limit, len(self.data), self.nbytes)
+
+    def clear(self):
+        with self._lock:
+            self.data.clear()
+            self.nbytes = 0
+
+    def prefetch(
+        self,
+        locations: Sequence[str],
+        realizations: bool = True,
+        background: bool = False,
+        batch_size: int = BATCH_SIZE,
+    ) -> List[Future]:
+        """
+        load the realization (or aggregate) curves of locations with a query per batch_size locations. If
+        background, the batches are queried in order on a background thread and the futures returned; looking
+        up a curve of a location that is in flight waits for its batch. Locations already loaded are skipped
+        and only as many curves as fit in memory_limit are kept.
+        """
+
+        kind = 'rlz' if realizations else 'agg'
+        with self._lock:
+            loaded = {(k, loc) for k, loc, _ in self.data} | set(self._pending)
+        locations = [loc for loc in dict.fromkeys(locations) if (kind, loc) not in loaded]
+        batches = [locations[i : i + batch_size] for i in range(0, len(locations), batch_size)]
+        if not background:
+            for batch in batches:
+                self._load(kind, batch)
+            return []
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='LazyData')
+        futures = []
+        for batch in batches:
+            future = self._executor.submit(self._load, kind, batch)
+            with self._lock:
+                for loc in batch:
+                    self._pending[(kind, loc)] = future
+            future.add_done_callback(partial(self._done, kind, batch))
+            futures.append(future)
+        return futures
+
+    def close(self):
+        """stop the background prefetch thread (after the batches in flight)"""
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def save(self, path: Union[str, Path], kind: str):
+        """write the loaded realization ('rlz') or aggregate ('agg') curves to an npz file of flat arrays"""
+
+        with self._lock:
+            entries = [(key, curves) for key, curves in self.data.items() if key[0] == kind]
+        nlvls = [len(curves.lvls) for _, curves in entries]
+        nrows = [len(curves.index) for _, curves in entries]
+        rows = [list(curves.index) for _, curves in entries]
+        np.savez(
+            path,
+            locations=np.array([key[1] for key, _ in entries], dtype=str),
+            imts=np.array([key[2] for key, _ in entries], dtype=str),
+            nlvls=np.array(nlvls, dtype='int64'),
+            nrows=np.array(nrows, dtype='int64'),
+            realizations=np.array([str(r) for row in rows for r in row], dtype=str),
+            lvls=np.concatenate([curves.lvls for _, curves in entries] or [np.empty(0)]),
+            vals=np.concatenate([curves.vals.reshape(-1) for _, curves in entries] or [np.empty(0)]),
+        )
+
+    def load(self, path: Union[str, Path], kind: str):
+        """load curves written by save (in the order they were used, evicting as for curves that are queried)"""
+
+        with np.load(path) as snapshot:
+            nlvls, nrows = snapshot['nlvls'], snapshot['nrows']
+            lvl_offsets = np.concatenate([[0], np.cumsum(nlvls)])
+            row_offsets = np.concatenate([[0], np.cumsum(nrows)])
+            val_offsets = np.concatenate([[0], np.cumsum(nlvls * nrows)])
+            lvls, vals, realizations = snapshot['lvls'], snapshot['vals'], snapshot['realizations']
+            with self._lock:
+                for i, (location, imt) in enumerate(zip(snapshot['locations'], snapshot['imts'])):
+                    rows = realizations[row_offsets[i] : row_offsets[i + 1]]
+                    self._store(
+                        (kind, str(location), str(imt)),
+                        # copies, so evicting an entry frees it rather than keeping the whole snapshot alive
+                        self.Curves(
+                            lvls=lvls[lvl_offsets[i] : lvl_offsets[i + 1]].copy(),
+                            vals=vals[val_offsets[i] : val_offsets[i + 1]].reshape(nrows[i], nlvls[i]).copy(),
+                            index={_realization(r): j for j, r in enumerate(rows)},
+                        ),
+                    )
+                self._evict()
+
+    def _done(self, kind, batch, future):
+        with self._lock:
+            for loc in batch:
+                if self._pending.get((kind, loc)) is future:
+                    del self._pending[(kind, loc)]
+
+    def _store(self, key, curves):
+        if key in self.data:
+            self.nbytes -= self.data[key].lvls.nbytes + self.data[key].vals.nbytes
+        self.data[key] = curves
+        self.nbytes += curves.lvls.nbytes + curves.vals.nbytes
+
+    def _evict(self):
+        # the most recently used curve (the one just requested) is always kept
+        if self.memory_limit is None:
+            return
+        while self.nbytes > self.memory_limit and len(self.data) > 1:
+            _, curves = self.data.popitem(last=False)
+            self.nbytes -= curves.lvls.nbytes + curves.vals.nbytes
+
+    def _use(self, key):
+        # call holding the lock; the most recently used curves (key) are never evicted
+        self.data.move_to_end(key)
+        self._evict()
+        return self.data[key]
+
+    def _query(self, kind, locations):
+        """query the curves of locations, returning a Curves per (kind, location, imt) key"""
 
-    def _load_all_agg(self,q,k):
+        # curves are stored under the code each location was requested with
+        requested = {_location_key(loc): loc for loc in locations}
+        rows = defaultdict(list)
+        q = self._run_query(kind, locations)
         for re in q:
+            location = requested.get(_location_key(re.loc))
+            if location is None:
+                log.warning(f'{self._hazard_id}: ignoring curves for {re.loc}, which was not requested')
+                continue
+            realization = _realization(re.rlz if kind == 'rlz' else re.agg)
             for val_imt in re.values:
-                new_key = encode_key(val_imt.imt, k.location, re.agg)
-                self.data[new_key] = self.Values(lvls=val_imt.lvls,vals=val_imt.vals)
-
-    def _run_query(self,key):
-        print('retrieve_data')
-        k = decode_key(key)
-        if k.realization.isdigit():
-            q = query.get_hazard_rlz_curves_v2(self._hazard_id,None,[k.location],None)
+                rows[(location, val_imt.imt)].append((realization, val_imt.lvls, val_imt.vals))
+
+        entries = {}
+        for (location, imt), curves in rows.items():
+            if kind == 'rlz':
+                curves.sort(key=lambda curve: curve[0])
+            entries[(kind, location, imt)] = self.Curves(
+                lvls=np.asarray(curves[0][1], dtype='float64'),
+                vals=np.array([curve[2] for curve in curves], dtype='float64'),
+                index={curve[0]: i for i, curve in enumerate(curves)},
+            )
+        return entries
+
+    def _insert(self, entries):
+        # call holding the lock
+        for key, curves in entries.items():
+            self._store(key, curves)
+
+    def _load(self, kind, locations):
+        entries = self._query(kind, locations)
+        with self._lock:
+            self._insert(entries)
+            self._evict()
+
+    def _run_query(self, kind, locations):
+        log.debug(f'retrieve {kind} curves for {len(locations)} locations')
+        if kind == 'rlz':
+            q = query.get_hazard_rlz_curves_v2(self._hazard_id,None,list(locations),None)
         else:
-            q = query.get_hazard_stats_curves_v2(self._hazard_id,None,[k.location],None)
+            q = query.get_hazard_stats_curves_v2(self._hazard_id,None,list(locations),None)
         return q
 
             
 class HazardData:
 
-    def __init__(self,hazard_id):
+    Realizations = namedtuple("Realizations","lvls vals weights")
+
+    def __init__(
+        self,
+        hazard_id,
+        memory_limit: Optional[int] = MEMORY_LIMIT,
+        locations: Optional[Sequence[str]] = None,
+        background: bool = False,
+        cache_dir: Optional[Union[str, Path]] = None,
+    ):
+        """
+        realization curves of locations (if given) are prefetched in batches (see prefetch). If cache_dir has a
+        snapshot of the hazard solution (see save) the metadata and curves are loaded from it first.
+        """
         self._hazard_id = hazard_id
-        self._data = LazyData(self._hazard_id) 
-    
+        self._data = LazyData(self._hazard_id,memory_limit) 
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir and (self.snapshot_dir / METADATA_FILE).exists():
+            self.load_snapshot()
+        if locations:
+            self.prefetch(locations, background=background)
+
     @property
-    @lru_cache(maxsize=None)
+    def snapshot_dir(self) -> Path:
+        if not self.cache_dir:
+            raise ValueError('HazardData: no cache_dir')
+        return self.cache_dir / f'hazard_id={self._hazard_id}'
+
+    def save(self):
+        """
+        write a snapshot of the metadata and the curves loaded so far to <cache_dir>/hazard_id=<id>/: the
+        metadata, including the parsed logic trees, as json and the realization and aggregate curves as npz arrays
+        """
+
+        snapshot_dir = self.snapshot_dir
+        snapshot_dir.mkdir(parents=True, exist_ok=True)
+        metadata = {field: getattr(self, field) for field in METADATA_FIELDS + LOGIC_TREES}
+        with open(snapshot_dir / METADATA_FILE, 'w') as metadata_file:
+            json.dump(_to_json(metadata), metadata_file)
+        for kind in ('rlz', 'agg'):
+            self._data.save(snapshot_dir / f'curves-{kind}.npz', kind)
+
+    def load_snapshot(self):
+        """load the metadata and curves saved by save (the metadata is then not queried)"""
+
+        snapshot_dir = self.snapshot_dir
+        with open(snapshot_dir / METADATA_FILE) as metadata_file:
+            metadata = json.load(metadata_file, object_hook=_from_json)
+        for field in METADATA_FIELDS + LOGIC_TREES:
+            setattr(self, field, metadata[field])
+        for kind in ('rlz', 'agg'):
+            if (snapshot_dir / f'curves-{kind}.npz').exists():
+                self._data.load(snapshot_dir / f'curves-{kind}.npz', kind)
+
+    def prefetch(self, locations, realizations=True, background=False, batch_size=BATCH_SIZE):
+        """query the curves of several locations in batches, optionally on a background thread (see LazyData.prefetch)"""
+        return self._data.prefetch(locations, realizations, background, batch_size)
+
+    def close(self):
+        self._data.close()
+
+    def cache_info(self):
+        """hits, misses and size of the curve cache (see LazyData)"""
+        return self._data.cache_info()
+
+    @cached_property
     def _hazard_meta(self):
-        print('get_hazard_metadata')
+        log.debug('get_hazard_metadata')
         return self.get_hazard_metadata()
 
-    @property
-    @lru_cache(maxsize=None)
+    @cached_property
     def imts(self):
-        print('imts')
         return self._hazard_meta.imts
 
-    @property
-    @lru_cache(maxsize=None)
+    @cached_property
     def vs30(self):
         return self._hazard_meta.vs30
 
-    @property
-    @lru_cache(maxsize=None)
+    @cached_property
     def aggs(self):
         return self._hazard_meta.aggs
 
-    @property
-    @lru_cache(maxsize=None)
+    @cached_property
     def gsim_lt(self):
         return ast.literal_eval(self._hazard_meta.gsim_lt)
 
-    @property
-    @lru_cache(maxsize=None)
+    @cached_property
     def haz_sol_id(self):
         return self._hazard_meta.haz_sol_id
 
-    @property
-    @lru_cache(maxsize=None)
+    @cached_property
     def hazsol_vs30_rk(self):
         return self._hazard_meta.hazsol_vs30_rk
 
-    @property
-    @lru_cache(maxsize=None)
+    @cached_property
     def locs(self):
         return self._hazard_meta.locs
 
-    @property
-    @lru_cache(maxsize=None)
+    @cached_property
     def rlz_lt(self):
         return ast.literal_eval(self._hazard_meta.rlz_lt)
 
-    @property
-    @lru_cache(maxsize=None)
+    @cached_property
     def src_lt(self):
         return ast.literal_eval(self._hazard_meta.src_lt)
 
-    @property
-    @lru_cache(maxsize=None)
+    @cached_property
     def nrlzs(self):
         return len(self.rlz_lt['weight'])
 
+    @cached_property
+    def weights(self):
+        return np.array(list(self.rlz_lt['weight'].values()), dtype='float64')
+
     
     
     
     def values(self, location, imt, realization):
+        """levels and values (arrays) of one realization (an integer index) or aggregate (by name)"""
 
         #TODO check location and imt agianst avaialable list
-        # if str(realization).isdigit():
-        #     nrlz = len(self.rlz_lt['weight'])
-        #     for rlz in range(nrlz):
-        #         key = encode_key(location=location,imt=imt,realization=rlz)
-        #         _ = self._data[key].values[0]
-                
-        key = encode_key(location=location,imt=imt,realization=realization)
-        #lvls = self._data[key].values[0].lvls
-        #vals = self._data[key].values[0].vals
-        
-        return self._data[key]
+        curves = self._data[(_kind(realization), location, imt)]
+        return LazyData.Values(lvls=curves.lvls, vals=curves.vals[curves.index[_realization(realization)]])
+
+    def rlz_matrix(self, location, imt):
+        """levels, the (realizations x levels) array of all realizations in order and their weights"""
+
+        curves = self._data[('rlz', location, imt)]
+        if len(curves.index) != len(self.weights):
+            raise ValueError(f'{location} {imt}: {len(curves.index)} realizations, {len(self.weights)} weights')
+        return self.Realizations(lvls=curves.lvls, vals=curves.vals, weights=self.weights)
 
 
     def get_hazard_metadata(self):
@@ -1,12 +1,21 @@
 import csv
-from typing import List, Tuple
+import math
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union, overload
 from pathlib import Path
 from collections import namedtuple
+from collections.abc import Sequence
+
+import numpy as np
+from numpy.typing import ArrayLike, NDArray
 
 from nzshm_common.location.code_location import CodedLocation
 from nzshm_common.grids.region_grid import load_grid
 from nzshm_common.location.location import location_by_id, LOCATION_LISTS
 
+from nzshm_hazlab.store.columnar import format_coords
+
+RESOLUTION = 0.001
+
 def transpower_locs() -> List[Tuple[float, float]]:
 
     return [
@@ -209,60 +218,169 @@ def transpower_locs() -> List[Tuple[float, float]]:
     ]
 
 
-def locations_from_csv(locations_filepath) -> List[CodedLocation]:
+class LocationArray(Sequence):
+    """
+    Array-backed set of locations: lat and lon float arrays rounded to a resolution, with vectorised location
+    codes and a hash index from code to position. Items are CodedLocations, built only when they are accessed,
+    so a LocationArray can be passed anywhere a list of CodedLocations is expected.
+    """
+
+    def __init__(self, lat: ArrayLike, lon: ArrayLike, resolution: float = RESOLUTION):
+        lat = np.asarray(lat, dtype='float64').reshape(-1)
+        lon = np.asarray(lon, dtype='float64').reshape(-1)
+        if lat.shape != lon.shape:
+            raise ValueError(f'lat and lon must be the same length, got {len(lat)} and {len(lon)}')
+        self.resolution = resolution
+        # rounded as CodedLocation rounds so that lat and lon are the same floats as CodedLocation.lat and lon
+        div_res = 1 / resolution
+        self.lat = np.round(lat * div_res) / div_res
+        self.lon = np.round(lon * div_res) / div_res
+        self._codes: Optional[NDArray] = None
+        self._code_index: Optional[Dict[str, int]] = None
+
+    def __repr__(self) -> str:
+        return f'LocationArray({len(self)} locations, resolution={self.resolution})'
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    @overload
+    def __getitem__(self, i: int) -> CodedLocation: ...
+
+    @overload
+    def __getitem__(self, i: Union[slice, ArrayLike]) -> 'LocationArray': ...
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            return CodedLocation(self.lat[i], self.lon[i], self.resolution)
+        return LocationArray(self.lat[i], self.lon[i], self.resolution)
+
+    def __iter__(self) -> Iterator[CodedLocation]:
+        for lat, lon in zip(self.lat, self.lon):
+            yield CodedLocation(lat, lon, self.resolution)
+
+    def __contains__(self, location) -> bool:
+        code = location if isinstance(location, str) else location.downsample(self.resolution).code
+        return code in self.code_index
+
+    def __add__(self, other) -> 'LocationArray':
+        other = LocationArray.from_locations(other, self.resolution)
+        return LocationArray(np.concatenate((self.lat, other.lat)), np.concatenate((self.lon, other.lon)), self.resolution)
+
+    def __radd__(self, other) -> 'LocationArray':
+        return LocationArray.from_locations(other, self.resolution) + self
+
+    @property
+    def codes(self) -> NDArray:
+        """the lat~lon code of every location (as CodedLocation.code)"""
+
+        if self._codes is None:
+            decimals = max(0, -math.floor(math.log10(self.resolution)))
+            lat = format_coords(self.lat, decimals).astype(str)
+            lon = format_coords(self.lon, decimals).astype(str)
+            self._codes = np.char.add(np.char.add(lat, '~'), lon).astype(object)
+        return self._codes
 
-    locations = []
+    @property
+    def code_index(self) -> Dict[str, int]:
+        """map from location code to position (the first position if a location is repeated)"""
+
+        if self._code_index is None:
+            codes = self.codes
+            self._code_index = {code: i for i, code in reversed(list(enumerate(codes)))}
+        return self._code_index
+
+    def position(self, location: Union[str, CodedLocation]) -> int:
+        code = location if isinstance(location, str) else location.downsample(self.resolution).code
+        return self.code_index[code]
+
+    def resample(self, resolution: float) -> 'LocationArray':
+        return LocationArray(self.lat, self.lon, resolution)
+
+    def downsample(self, resolution: float) -> 'LocationArray':
+        return self.resample(resolution)
+
+    @classmethod
+    def from_locations(cls, locations: Iterable, resolution: float = RESOLUTION) -> 'LocationArray':
+        """from CodedLocations or (lat, lon) pairs"""
+
+        if isinstance(locations, LocationArray):
+            return locations if locations.resolution == resolution else locations.resample(resolution)
+        latlon = [(loc.lat, loc.lon) if isinstance(loc, CodedLocation) else loc for loc in locations]
+        latlon = np.array(latlon, dtype='float64').reshape(-1, 2)
+        return cls(latlon[:, 0], latlon[:, 1], resolution)
+
+    @classmethod
+    def from_grid(cls, grid_name: str, resolution: float = RESOLUTION) -> 'LocationArray':
+        latlon = np.array(load_grid(grid_name), dtype='float64').reshape(-1, 2)
+        return cls(latlon[:, 0], latlon[:, 1], resolution)
+
+
+def location_codes(locs: Iterable, resolution: float = RESOLUTION) -> List[str]:
+    """the codes of the locations at a resolution, vectorised for a LocationArray"""
+
+    if isinstance(locs, LocationArray):
+        return list(locs.resample(resolution).codes)
+    return [loc.downsample(resolution).code for loc in locs]
+
+
+def _latlon_from_csv(locations_filepath) -> List[Tuple[float, float]]:
+
+    latlon = []
     locations_filepath = Path(locations_filepath)
     with locations_filepath.open('r') as locations_file:
         reader = csv.reader(locations_file)
         Location = namedtuple("Location", next(reader), rename=True)
         for row in reader:
             location = Location(*row)
-            locations.append(
-                CodedLocation(lat=float(location.lat), lon=float(location.lon), resolution=0.001)
-            )
-    return locations
+            latlon.append((float(location.lat), float(location.lon)))
+    return latlon
+
+
+def locations_from_csv(locations_filepath) -> LocationArray:
+
+    return LocationArray.from_locations(_latlon_from_csv(locations_filepath))
 
 
 def lat_lon(id):
     return (location_by_id(id)['latitude'], location_by_id(id)['longitude'])
 
-def get_locations(location_names: List[str]) -> List[CodedLocation]:
+def get_locations(location_names: List[str]) -> LocationArray:
     """
     given a list of location keys return a list of coded locations. Keys can be any combination of valid
     location_by_id() keys, grid strings, or `lat~lon` location codes.
+
+    The locations are returned as a LocationArray so that the CodedLocation objects are only built if needed.
     """
 
     locations: List[Tuple[float, float]] = []
     for location_spec in location_names:
         if '~' in location_spec:
             lat, lon = location_spec.split('~')
-            locations.append(CodedLocation(float(lat), float(lon), 0.001))
+            locations.append((float(lat), float(lon)))
         elif '_intersect_' in location_spec:
             spec0, spec1 = location_spec.split('_intersect_')
             loc0 = set(load_grid(spec0))
             loc1 = set(load_grid(spec1))
             loc01 = list(loc0.intersection(loc1))
             loc01.sort()
-            locations += [CodedLocation(*loc, 0.001) for loc in loc01]
+            locations += loc01
         elif '_diff_' in location_spec:
             spec0, spec1 = location_spec.split('_diff_')
             loc0 = set(load_grid(spec0))
             loc1 = set(load_grid(spec1))
             loc01 = list(loc0.difference(loc1))
             loc01.sort()
-            locations += [CodedLocation(*loc, 0.001) for loc in loc01]
+            locations += loc01
         elif location_by_id(location_spec):
-            locations.append(
-                CodedLocation(*lat_lon(location_spec), 0.001)
-                )
+            locations.append(lat_lon(location_spec))
         elif LOCATION_LISTS.get(location_spec):
             location_ids = LOCATION_LISTS[location_spec]["locations"]
-            locations += [CodedLocation(*lat_lon(id),0.001) for id in location_ids]
+            locations += [lat_lon(id) for id in location_ids]
         elif location_spec == 'TP':
-            locations += [CodedLocation(*loc, 0.001,) for loc in transpower_locs()]
+            locations += transpower_locs()
         elif Path(location_spec).exists():
-            locations += locations_from_csv(location_spec)
+            locations += _latlon_from_csv(location_spec)
         else:
-            locations += [CodedLocation(*loc, 0.001) for loc in load_grid(location_spec)]
-    return locations
\ No newline at end of file
+            locations += load_grid(location_spec)
+    return LocationArray.from_locations(locations)
@@ -7,8 +7,9 @@ from nzshm_common.location import CodedLocation
 from nzshm_hazlab.base_functions import period_from_imt, imt_from_period
 from nzshm_hazlab.data_functions import ( 
 
-    # calculate_agg,
+    calculate_agg,
     compute_hazard_at_poe,
+    compute_uhs,
     rp_from_poe,
     poe_from_rp,
     rp_from_poe
@@ -207,21 +208,12 @@ def plot_spectrum(
         bandw: bool=False,
         color: str='b'
 ):
-    #TODO: this is slow!
-
     lat, lon = location.split('~')
 
     hd_filt = hazard_data.loc[ (hazard_data['lat'] == lat) & (hazard_data['lon'] == lon)]
-
-
-    imts = set(hazard_data['imt'])
-    periods = [period_from_imt(imt) for imt in imts]
-    periods.sort()
-    imts = [imt_from_period(period) for period in periods]
-
-    # lvls = list(set(hazard_data['level']))
-    # lvls.sort()
-
+    spectra = compute_uhs(hd_filt, [poe], inv_time)
+    periods = spectra.periods
+    agg_index = {agg: i for i, agg in enumerate(spectra.aggs)}
 
     if bandw:
         quantiles = dict(
@@ -230,43 +222,12 @@ def plot_spectrum(
                         upper2 = 0.975,
                         lower2 = 0.025,
                         )
-        hazard = {}
-        for k,quant in quantiles.items():
-            haz = []
-            for imt in imts:
-                # vals = calculate_agg(hazard_data,location,imt,quant)
-                vals = hd_filt.loc[(hd_filt['imt'] == imt) & (hd_filt['agg'] == str(quant)),'apoe'].to_numpy()[0]
-                lvls = hd_filt.loc[(hd_filt['imt'] == imt) & (hd_filt['agg'] == str(quant)),'level'].to_numpy()[0]
-                haz.append(compute_hazard_at_poe(lvls,vals,poe,inv_time))
-            hazard[k] = haz
+        hazard = {k: spectra.acc[0, agg_index[str(quant)], 0] for k, quant in quantiles.items()}
         ax.fill_between(periods,hazard['upper1'],hazard['lower1'],alpha = 0.5, color=color)
         ax.plot(periods, hazard['upper2'],color=color,lw=1)
         ax.plot(periods, hazard['lower2'],color=color,lw=1)
-    # else:
-    #     da = 0.01
-    #     aggs = np.arange(0,1.0+da,da)
-    #     for i,agg in enumerate(aggs):
-    #         # alpha = min(1.0,(len(aggs)/2.0 - np.abs(len(aggs)/2.0 - i)) / (len(aggs)/2.0)+0.25)
-    #         # alpha = min(1.0,-(2.0/len(aggs))**2 * (i-len(aggs)/2.0)**2  + 1.2)
-    #         # alpha = max(0.0,(len(aggs)/2.0 - np.abs(len(aggs)/2.0 - i)) / (len(aggs)/2.0)-0.1)
-    #         alpha = max(0.0,(len(aggs)/2.0 - np.abs(len(aggs)/2.0 - i)) / (len(aggs)/2.0))
-    #         hazard = []
-    #         for imt in imts:
-    #             breakpoint()
-    #             lvls = hd_filt.loc[(hd_filt['imt'] == imt) & (hd_filt['agg'] == str(quant)),'level']
-    #             lvls = hd_filt.loc[(hd_filt['imt'] == imt) & (hd_filt['agg'] == str(quant)),'level']
-    #             # vals = calculate_agg(hazard_data,location,imt,agg)
-    #             hazard.append(compute_hazard_at_poe(lvls,vals,poe,inv_time))
-    #         ax.plot(periods,hazard,color=str(alpha),alpha=0.6,lw=1)
-
 
-    hazard = []
-    for imt in imts:
-        values = hd_filt.loc[(hd_filt['imt'] == imt) & (hd_filt['agg'] == central),'apoe'].item()
-        levels = hd_filt.loc[(hd_filt['imt'] == imt) & (hd_filt['agg'] == central),'level'].item()
-        hazard.append(compute_hazard_at_poe(levels,values,poe,inv_time))
-    print(periods)
-    print(hazard)
+    hazard = spectra.acc[0, agg_index[central], 0]
 
     lh = ax.plot(periods, hazard, color=color, alpha=0.8,lw=2)
     lh = lh[0]
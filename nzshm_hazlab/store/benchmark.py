@@ -0,0 +1,229 @@
+"""
+Offline throughput benchmarks for the curve loaders.
+
+THS is replaced by an in-process fake of toshi_hazard_store.query.get_hazard_curves (with a configurable
+latency per query) and the arrow and OpenQuake csv loaders read synthetic files written to a temporary
+directory, so the loaders can be timed repeatably without network access:
+
+    python -m nzshm_hazlab.store.benchmark --sites 100 1000 --latency 0.05
+"""
+
+import argparse
+import itertools
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas import DataFrame
+
+from nzshm_hazlab.locations import LocationArray
+from nzshm_hazlab.store import curves, curves_v4
+from nzshm_hazlab.store.columnar import format_coords, matrix_to_list_array
+
+HAZARD_ID = 'SYNTHETIC'
+VS30 = 400
+IMTS = ['PGA', 'SA(0.5)', 'SA(1.0)']
+AGGS = ['mean', '0.1', '0.5', '0.9']
+
+LevelValue = namedtuple('LevelValue', 'lvl val')
+HazardRecord = namedtuple('HazardRecord', 'hazard_model_id vs30 lat lon imt agg values')
+
+
+def synthetic_locations(nsites: int) -> LocationArray:
+    """nsites locations on a regular 0.1 degree grid"""
+
+    ncols = int(np.ceil(np.sqrt(nsites)))
+    index = np.arange(nsites)
+    return LocationArray(-41.0 + 0.1 * (index // ncols), 172.0 + 0.1 * (index % ncols))
+
+
+def synthetic_curves(nrows: int, levels: np.ndarray = curves_v4.imtls, seed: int = 0) -> np.ndarray:
+    """(nrows x nlevels) decreasing hazard curves"""
+
+    rng = np.random.default_rng(seed)
+    scale = rng.uniform(0.1, 1.0, size=(nrows, 1))
+    return np.exp(-levels[np.newaxis, :] / scale) * rng.uniform(0.5, 1.0, size=(nrows, 1))
+
+
+class FakeTHS:
+    """
+    Stand-in for toshi_hazard_store.query.get_hazard_curves returning synthetic records. Each call sleeps for
+    latency seconds (the round trip) plus record_latency seconds per record yielded (paging).
+    """
+
+    def __init__(self, latency: float = 0.0, record_latency: float = 0.0, levels: np.ndarray = curves_v4.imtls):
+        self.latency = latency
+        self.record_latency = record_latency
+        self.levels = levels
+        self.calls = 0
+
+    def get_hazard_curves(
+        self, locs: List[str], vs30s: List[int], hazard_model_ids: List[str], imts: List[str], aggs: List[str]
+    ) -> Iterator[HazardRecord]:
+        self.calls += 1
+        time.sleep(self.latency)
+        keys = list(itertools.product(hazard_model_ids, vs30s, locs, imts, aggs))
+        apoe = synthetic_curves(len(keys), self.levels, seed=self.calls)
+        for (hazard_id, vs30, loc, imt, agg), values in zip(keys, apoe):
+            if self.record_latency:
+                time.sleep(self.record_latency)
+            lat, lon = map(float, loc.split('~'))
+            yield HazardRecord(
+                hazard_id, vs30, lat, lon, imt, agg, [LevelValue(lvl, val) for lvl, val in zip(self.levels, values)]
+            )
+
+
+@contextmanager
+def fake_ths(fake: FakeTHS):
+    """patch the THS query used by store.curves with a FakeTHS"""
+
+    get_hazard_curves = curves.query.get_hazard_curves
+    curves.query.get_hazard_curves = fake.get_hazard_curves
+    try:
+        yield fake
+    finally:
+        curves.query.get_hazard_curves = get_hazard_curves
+
+
+def write_synthetic_dataset(
+    root: Path, hazard_id: str, vs30: int, locs: LocationArray, imts: List[str], aggs: List[str]
+) -> Dict:
+    """
+    write a hive partitioned (hazard_model_id=/vs30=) Parquet dataset of aggregate curves in the layout read
+    by curves_v4 and return the fs_specs to read it
+    """
+
+    nloc, nimt, nagg = len(locs), len(imts), len(aggs)
+    loc_idx = np.repeat(np.arange(nloc), nimt * nagg)
+    table = pa.table(
+        {
+            'agg': pa.array(np.tile(aggs, nloc * nimt), pa.string()),
+            'imt': pa.array(np.tile(np.repeat(imts, nagg), nloc), pa.string()),
+            'lat': pa.array(locs.lat[loc_idx]),
+            'lon': pa.array(locs.lon[loc_idx]),
+            'nloc_001': pa.array(locs.codes[loc_idx], pa.string()),
+            'values': matrix_to_list_array(synthetic_curves(len(loc_idx))),
+        }
+    )
+    partition = Path(root) / f'hazard_model_id={hazard_id}' / f'vs30={vs30}'
+    partition.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table, partition / 'part-0.parquet')
+    return {'arrow_fs': curves_v4.ArrowFS.LOCAL, 'arrow_dir': str(root)}
+
+
+def write_synthetic_oqcsv(root: Path, locs: LocationArray, imts: List[str], agg: str = 'mean') -> str:
+    """write an OpenQuake hazard curve csv for each imt and return the file pattern (with IMT placeholder)"""
+
+    poe_columns = [f'poe-{level}' for level in curves_v4.imtls]
+    for i, imt in enumerate(imts):
+        oq_output = pd.DataFrame(synthetic_curves(len(locs), seed=i), columns=poe_columns)
+        oq_output.insert(0, 'lon', format_coords(locs.lon))
+        oq_output.insert(1, 'lat', format_coords(locs.lat))
+        oq_output.insert(2, 'depth', 0.0)
+        filepath = Path(root) / f'hazard_curve-{agg}-{imt}_1.csv'
+        with open(filepath, 'w') as csv_file:
+            csv_file.write(f"#,,,,\"generated_by='synthetic', imt='{imt}', investigation_time=1.0\"\n")
+            oq_output.to_csv(csv_file, index=False)
+    return str(Path(root) / f'hazard_curve-{agg}-IMT_1.csv')
+
+
+def measure(fn: Callable, repeat: int = 1) -> Dict:
+    """
+    run fn repeat times, returning the best time, rows returned and rows per second, then once more with
+    tracemalloc running (which slows it down) for the peak memory (python and numpy allocations, arrow memory
+    still held after the run is reported separately)
+    """
+
+    times = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        rows = len(fn())
+        times.append(time.perf_counter() - tic)
+
+    arrow_bytes = pa.total_allocated_bytes()
+    tracemalloc.start()
+    try:
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    arrow_bytes = pa.total_allocated_bytes() - arrow_bytes
+    del result
+
+    seconds = min(times)
+    return dict(
+        seconds=seconds,
+        rows=rows,
+        rows_per_second=rows / seconds if seconds > 0 else float('nan'),
+        peak_memory_mb=peak / 1e6,
+        arrow_memory_mb=arrow_bytes / 1e6,
+    )
+
+
+def run(
+    site_counts: Sequence[int] = (100, 1000),
+    imts: List[str] = IMTS,
+    aggs: List[str] = AGGS,
+    latency: float = 0.0,
+    record_latency: float = 0.0,
+    max_workers: Optional[int] = None,
+    chunk_size: int = 100,
+    repeat: int = 1,
+) -> DataFrame:
+    """time each loader for each number of sites, returning a row of measurements per loader and site count"""
+
+    results = []
+    for nsites in site_counts:
+        locs = synthetic_locations(nsites)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fs_specs = write_synthetic_dataset(Path(tmp_dir) / 'arrow', HAZARD_ID, VS30, locs, imts, aggs)
+            oq_dir = Path(tmp_dir) / 'oq'
+            oq_dir.mkdir()
+            oq_pattern = write_synthetic_oqcsv(oq_dir, locs, imts)
+
+            ths_args = (HAZARD_ID, VS30, locs, imts, aggs)
+            ths_kwargs = dict(chunk_size=chunk_size, max_workers=max_workers)
+            loaders = {
+                'curves.get_hazard': partial(curves.get_hazard, *ths_args, **ths_kwargs),
+                'curves.get_hazard_v1': partial(curves.get_hazard_v1, *ths_args, **ths_kwargs),
+                'curves_v4.get_hazard': partial(curves_v4.get_hazard, *ths_args, fs_specs),
+                'curves.get_hazard_from_oqcsv': partial(curves.get_hazard_from_oqcsv, oq_pattern, imts),
+            }
+            with fake_ths(FakeTHS(latency, record_latency)):
+                for name, loader in loaders.items():
+                    curves_v4.DATASETS.clear()
+                    results.append(dict(loader=name, sites=nsites, **measure(loader, repeat)))
+
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='time the curve loaders against synthetic data')
+    parser.add_argument('--sites', type=int, nargs='+', default=[100, 1000], help='numbers of sites to load')
+    parser.add_argument('--latency', type=float, default=0.0, help='fake THS round trip time (s)')
+    parser.add_argument('--record-latency', type=float, default=0.0, help='fake THS time per record (s)')
+    parser.add_argument('--max-workers', type=int, default=None, help='concurrent THS queries')
+    parser.add_argument('--chunk-size', type=int, default=100, help='locations per THS query')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each loader (the best time is reported)')
+    args = parser.parse_args()
+
+    benchmarks = run(
+        args.sites,
+        latency=args.latency,
+        record_latency=args.record_latency,
+        max_workers=args.max_workers,
+        chunk_size=args.chunk_size,
+        repeat=args.repeat,
+    )
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(benchmarks)
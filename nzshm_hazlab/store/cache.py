@@ -0,0 +1,279 @@
+import os
+import shutil
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from nzshm_common.location import CodedLocation
+from pandas import DataFrame
+
+from nzshm_hazlab.hazard_cube import HazardCube
+from nzshm_hazlab.locations import LocationArray, location_codes
+from nzshm_hazlab.store.columnar import list_column_to_matrix, matrix_to_list_array
+from nzshm_hazlab.store.curves import get_hazard as get_hazard_ths
+from nzshm_hazlab.store.metrics import FetchMetrics, Timer
+
+RESOLUTION = 0.001
+PARTITION_FILE = 'curves.parquet'
+COLUMNS = ['lat', 'lon', 'imt', 'agg', 'level', 'apoe']
+
+FetchFunction = Callable[[str, int, List[CodedLocation], List[str], List[str]], DataFrame]
+
+
+class CurveCache:
+    """
+    Persistent on-disk cache of aggregate hazard curves keyed by (hazard model, vs30, location, imt, agg).
+
+    Curves are stored in one Parquet file per partition:
+    <cache_dir>/hazard_model_id=<id>/vs30=<vs30>/imt=<imt>/agg=<agg>/curves.parquet
+    with one row per location. Curves that the source does not have are recorded as rows with null level and
+    apoe (see write_absent) so that they are not requested again. If max_bytes is set, the least recently used
+    partitions are evicted when the cache grows beyond it (partition file modification times are used to
+    track use).
+    """
+
+    def __init__(self, cache_dir: Union[str, Path], max_bytes: Optional[int] = None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._invalidation_hooks: List[Callable[[str], None]] = []
+
+    def _model_dir(self, hazard_id: str) -> Path:
+        return self.cache_dir / f'hazard_model_id={hazard_id}'
+
+    def partition_path(self, hazard_id: str, vs30: int, imt: str, agg: str) -> Path:
+        return self._model_dir(hazard_id) / f'vs30={vs30}' / f'imt={imt}' / f'agg={agg}' / PARTITION_FILE
+
+    def _read_partition(self, hazard_id: str, vs30: int, imt: str, agg: str) -> Optional[pa.Table]:
+        path = self.partition_path(hazard_id, vs30, imt, agg)
+        if not path.exists():
+            return None
+        os.utime(path)
+        return pq.read_table(path)
+
+    def read(
+        self, hazard_id: str, vs30: int, loc_codes: List[str], imts: List[str], aggs: List[str]
+    ) -> Tuple[DataFrame, Dict[Tuple[str, str], Set[str]]]:
+        """
+        read all the requested curves that are in the cache. Returns the curves (in location, imt, agg order)
+        and the location codes that are missing for each (imt, agg). Curves recorded as absent from the source
+        are not missing but are not returned.
+        """
+
+        tables = []
+        missing = {}
+        for imt in imts:
+            for agg in aggs:
+                table = self._read_partition(hazard_id, vs30, imt, agg)
+                if table is None:
+                    found: Set[str] = set()
+                else:
+                    table = table.filter(pc.is_in(table['location'], pa.array(loc_codes)))
+                    found = set(table['location'].to_pylist())
+                    tables.append(table.filter(pc.is_valid(table['apoe'])))
+                if len(found) < len(loc_codes):
+                    missing[(imt, agg)] = set(loc_codes) - found
+                self.hits += len(found)
+                self.misses += len(loc_codes) - len(found)
+
+        if not tables:
+            return pd.DataFrame({c: pd.Series(dtype=object) for c in COLUMNS}), missing
+
+        table = pa.concat_tables(tables)
+        order = np.lexsort(
+            (
+                _positions(table['agg'], aggs),
+                _positions(table['imt'], imts),
+                _positions(table['location'], loc_codes),
+            )
+        )
+        table = table.take(pa.array(order))
+        hazard_curves = table.select(['lat', 'lon', 'imt', 'agg']).to_pandas()
+        hazard_curves['level'] = list(list_column_to_matrix(table['level']))
+        hazard_curves['apoe'] = list(list_column_to_matrix(table['apoe']))
+        return hazard_curves, missing
+
+    def _write_partition(self, hazard_id: str, vs30: int, imt: str, agg: str, table: pa.Table) -> None:
+        existing = self._read_partition(hazard_id, vs30, imt, agg)
+        if existing is not None:
+            keep = pc.invert(pc.is_in(existing['location'], table['location']))
+            table = pa.concat_tables([existing.filter(keep), table])
+
+        path = self.partition_path(hazard_id, vs30, imt, agg)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+    def write(self, hazard_id: str, vs30: int, hazard_curves: DataFrame) -> None:
+        """add curves (in the store.curves.get_hazard layout) to the cache, replacing any existing entries"""
+
+        if hazard_curves.empty:
+            return
+        hazard_curves = hazard_curves.dropna(subset=['apoe'])
+        for (imt, agg), curves in hazard_curves.groupby(['imt', 'agg'], sort=False):
+            location = (curves['lat'] + '~' + curves['lon']).to_numpy()
+            table = pa.table(
+                {
+                    'location': pa.array(location, pa.string()),
+                    'lat': pa.array(curves['lat'].to_numpy(), pa.string()),
+                    'lon': pa.array(curves['lon'].to_numpy(), pa.string()),
+                    'imt': pa.array([imt] * len(curves), pa.string()),
+                    'agg': pa.array([agg] * len(curves), pa.string()),
+                    'level': matrix_to_list_array(np.vstack(curves['level'].to_numpy())),
+                    'apoe': matrix_to_list_array(np.vstack(curves['apoe'].to_numpy())),
+                }
+            )
+            self._write_partition(hazard_id, vs30, imt, agg, table)
+        self.evict()
+
+    def write_absent(self, hazard_id: str, vs30: int, absent: Dict[Tuple[str, str], Set[str]]) -> None:
+        """
+        record the location codes of curves that the source does not have for each (imt, agg), so that a
+        warm cache does not request them again. A curve written later replaces its marker.
+        """
+
+        for (imt, agg), loc_codes in absent.items():
+            if not loc_codes:
+                continue
+            location = sorted(loc_codes)
+            lat, lon = zip(*(code.split('~') for code in location))
+            table = pa.table(
+                {
+                    'location': pa.array(location, pa.string()),
+                    'lat': pa.array(lat, pa.string()),
+                    'lon': pa.array(lon, pa.string()),
+                    'imt': pa.array([imt] * len(location), pa.string()),
+                    'agg': pa.array([agg] * len(location), pa.string()),
+                    'level': pa.nulls(len(location), pa.list_(pa.float64())),
+                    'apoe': pa.nulls(len(location), pa.list_(pa.float64())),
+                }
+            )
+            self._write_partition(hazard_id, vs30, imt, agg, table)
+        self.evict()
+
+    def size(self) -> int:
+        """total size of the cache in bytes"""
+
+        return sum(path.stat().st_size for path in self.cache_dir.rglob(PARTITION_FILE))
+
+    def evict(self) -> None:
+        """remove least recently used partitions until the cache is within max_bytes"""
+
+        if self.max_bytes is None:
+            return
+        partitions = [(path.stat().st_mtime, path.stat().st_size, path) for path in self.cache_dir.rglob(PARTITION_FILE)]
+        partitions.sort()
+        total = sum(size for _, size, _ in partitions)
+        # never evict the most recently used partition, it has just been written or read
+        for _, size, path in partitions[:-1]:
+            if total <= self.max_bytes:
+                break
+            path.unlink()
+            total -= size
+
+    def add_invalidation_hook(self, hook: Callable[[str], None]) -> None:
+        """register a function to be called with the hazard model id whenever a model is invalidated"""
+
+        self._invalidation_hooks.append(hook)
+
+    def invalidate(self, hazard_id: str) -> None:
+        """remove all cached curves for a hazard model"""
+
+        shutil.rmtree(self._model_dir(hazard_id), ignore_errors=True)
+        for hook in self._invalidation_hooks:
+            hook(hazard_id)
+
+    def clear(self) -> None:
+        for model_dir in self.cache_dir.glob('hazard_model_id=*'):
+            self.invalidate(model_dir.name.split('=', 1)[1])
+
+
+def _positions(column: pa.ChunkedArray, keys: List[str]) -> np.ndarray:
+    return pc.index_in(column, value_set=pa.array(keys)).to_numpy(zero_copy_only=False)
+
+
+def get_hazard(
+    cache: CurveCache,
+    hazard_id: str,
+    vs30: int,
+    locs: List[CodedLocation],
+    imts: List[str],
+    aggs: List[str],
+    fetch: FetchFunction = get_hazard_ths,
+    as_cube: bool = False,
+    metrics: Optional[FetchMetrics] = None,
+) -> Union[DataFrame, HazardCube]:
+    """
+    get all locations, imts and aggs for a particular hazard_id and vs30 from the cache, fetching only
+    the missing curves (from THS by default, or e.g. functools.partial(curves_v4.get_hazard, fs_specs=...))
+    and adding them to the cache. Requested curves that the fetch does not return are recorded in the cache as
+    absent, so a warm cache does not touch the network. If as_cube is set the curves are returned as a
+    HazardCube rather than a DataFrame.
+
+    Missing curves are fetched as one request for all missing locations, imts and aggs so some curves that
+    are already cached may be fetched again when only part of the request is missing.
+
+    If metrics is given the cache read is recorded as a chunk along with the cache hits and misses, and
+    metrics is passed on to fetch (which must then accept a metrics keyword argument).
+    """
+
+    codes = location_codes(locs, RESOLUTION)
+    # first position of each location, in the order requested
+    positions: Dict[str, int] = {}
+    for i, code in enumerate(codes):
+        positions.setdefault(code, i)
+    loc_codes = list(positions.keys())
+    hits, misses = cache.hits, cache.misses
+    with Timer() as timer:
+        hazard_curves, missing = cache.read(hazard_id, vs30, loc_codes, imts, aggs)
+    if metrics:
+        nbytes = int(sum(curve.nbytes for curve in hazard_curves['apoe'])) * 2
+        metrics.record_chunk('cache', timer.elapsed, len(hazard_curves), nbytes)
+        metrics.record_cache('cache', cache.hits - hits, cache.misses - misses)
+    if not missing:
+        return HazardCube.from_dataframe(hazard_curves) if as_cube else hazard_curves
+
+    missing_codes = set.union(*missing.values())
+    missing_positions = [positions[code] for code in loc_codes if code in missing_codes]
+    if isinstance(locs, LocationArray):
+        missing_locs = locs[missing_positions]
+    else:
+        missing_locs = [locs[i] for i in missing_positions]
+    missing_imts = [imt for imt in imts if any((imt, agg) in missing for agg in aggs)]
+    missing_aggs = [agg for agg in aggs if any((imt, agg) in missing for imt in imts)]
+    fetch_kwargs = {'metrics': metrics} if metrics else {}
+    fetched = fetch(hazard_id, vs30, missing_locs, missing_imts, missing_aggs, **fetch_kwargs)[COLUMNS]
+    fetched = fetched.dropna(subset=['apoe'])
+    cache.write(hazard_id, vs30, fetched)
+
+    # only take the curves that were missing from the fetched data, the rest came from the cache
+    fetched_codes = (fetched['lat'] + '~' + fetched['lon']).to_numpy()
+    keep = [
+        code in missing.get((imt, agg), ())
+        for code, imt, agg in zip(fetched_codes, fetched['imt'], fetched['agg'])
+    ]
+    absent = {key: set(loc_codes) for key, loc_codes in missing.items()}
+    for code, imt, agg in zip(fetched_codes, fetched['imt'], fetched['agg']):
+        absent.get((imt, agg), set()).discard(code)
+    cache.write_absent(hazard_id, vs30, absent)
+    hazard_curves = pd.concat([hazard_curves, fetched[keep]], ignore_index=True)
+
+    loc_pos = {code: i for i, code in enumerate(loc_codes)}
+    imt_pos = {imt: i for i, imt in enumerate(imts)}
+    agg_pos = {agg: i for i, agg in enumerate(aggs)}
+    order = np.lexsort(
+        (
+            hazard_curves['agg'].map(agg_pos).to_numpy(),
+            hazard_curves['imt'].map(imt_pos).to_numpy(),
+            (hazard_curves['lat'] + '~' + hazard_curves['lon']).map(loc_pos).to_numpy(),
+        )
+    )
+    hazard_curves = hazard_curves.iloc[order].reset_index(drop=True)
+    return HazardCube.from_dataframe(hazard_curves) if as_cube else hazard_curves
@@ -0,0 +1,189 @@
+from collections import namedtuple
+from enum import Enum, auto
+from operator import attrgetter
+from typing import Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from numpy.typing import NDArray
+from pandas import DataFrame
+
+CurveArrays = namedtuple('CurveArrays', 'lat lon imt agg level apoe')
+
+
+class BatchFormat(Enum):
+    NUMPY = auto()
+    ARROW = auto()
+
+
+_get_lvl = attrgetter('lvl')
+_get_val = attrgetter('val')
+
+
+def format_coords(values: Union[NDArray, pa.Array, pa.ChunkedArray], decimals: int = 3) -> NDArray:
+    """
+    format lat or lon values as fixed point strings (matching CodedLocation codes) using arrow compute
+    kernels rather than formatting one float at a time in python.
+    """
+
+    if not isinstance(values, (pa.Array, pa.ChunkedArray)):
+        values = pa.array(np.asarray(values, dtype='float64'))
+    scale = 10**decimals
+    scaled = pc.cast(pc.round(pc.multiply(pc.cast(values, pa.float64()), scale)), pa.int64())
+    absval = pc.abs(scaled)
+    whole = pc.divide(absval, scale)
+    sign = pc.if_else(pc.less(scaled, 0), '-', '')
+    strings = pc.binary_join_element_wise(sign, pc.cast(whole, pa.string()), '')
+    if decimals > 0:
+        frac = pc.subtract(absval, pc.multiply(whole, scale))
+        frac = pc.utf8_lpad(pc.cast(frac, pa.string()), width=decimals, padding='0')
+        strings = pc.binary_join_element_wise(strings, frac, '.')
+    return strings.to_numpy(zero_copy_only=False)
+
+
+def list_column_to_matrix(column: Union[pa.Array, pa.ChunkedArray]) -> NDArray:
+    """convert an arrow list<double> column where every list has the same length to a 2-D float array"""
+
+    nrows = len(column)
+    flat = pc.list_flatten(column)
+    if isinstance(flat, pa.ChunkedArray):
+        flat = flat.combine_chunks()
+    return flat.to_numpy(zero_copy_only=False).reshape(nrows, -1)
+
+
+def matrix_to_list_array(matrix: NDArray) -> pa.ListArray:
+    """convert a 2-D float array to an arrow list<double> array with one list per row"""
+
+    matrix = np.ascontiguousarray(matrix, dtype='float64')
+    nrows, ncols = matrix.shape
+    offsets = pa.array(np.arange(0, (nrows + 1) * ncols, ncols, dtype='int32'))
+    return pa.ListArray.from_arrays(offsets, pa.array(matrix.ravel()))
+
+
+class CurveAccumulator:
+    """
+    Collects hazard curve records into typed column arrays. lat/lon are held as floats, imt/agg as
+    object arrays and levels/apoe in preallocated 2-D float arrays (one row per record). The frame is
+    only built once, when all records have been collected.
+    """
+
+    def __init__(self, nrecords: int, nlevels: Optional[int] = None):
+        self._size = 0
+        self._lat = np.full(nrecords, np.nan)
+        self._lon = np.full(nrecords, np.nan)
+        self._imt = np.empty(nrecords, dtype=object)
+        self._agg = np.empty(nrecords, dtype=object)
+        self._level: Optional[NDArray] = None
+        self._apoe: Optional[NDArray] = None
+        if nlevels is not None:
+            self._allocate_curves(nlevels)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def nlevels(self) -> Optional[int]:
+        return None if self._level is None else self._level.shape[1]
+
+    def _allocate_curves(self, nlevels: int) -> None:
+        self._level = np.full((len(self._lat), nlevels), np.nan)
+        self._apoe = np.full((len(self._lat), nlevels), np.nan)
+
+    def _grow(self) -> None:
+        capacity = max(1, 2 * len(self._lat))
+        self._lat = np.resize(self._lat, capacity)
+        self._lon = np.resize(self._lon, capacity)
+        self._imt = np.resize(self._imt, capacity)
+        self._agg = np.resize(self._agg, capacity)
+        if self._level is not None:
+            self._level = np.resize(self._level, (capacity, self._level.shape[1]))
+            self._apoe = np.resize(self._apoe, (capacity, self._apoe.shape[1]))
+
+    def _next_row(self, nlevels: int) -> int:
+        if self._level is None:
+            self._allocate_curves(nlevels)
+        elif nlevels != self._level.shape[1]:
+            raise ValueError(f'expected curves with {self._level.shape[1]} levels, got {nlevels}')
+        if self._size == len(self._lat):
+            self._grow()
+        i = self._size
+        self._size += 1
+        return i
+
+    def append(self, lat: float, lon: float, imt: str, agg: str, levels: Sequence[float], apoe: Sequence[float]) -> None:
+        i = self._next_row(len(levels))
+        self._lat[i] = lat
+        self._lon[i] = lon
+        self._imt[i] = imt
+        self._agg[i] = agg
+        self._level[i, :] = levels
+        self._apoe[i, :] = apoe
+
+    def append_ths(self, res) -> None:
+        """add a toshi-hazard-store hazard aggregation record (values are objects with lvl and val)"""
+
+        nlevels = len(res.values)
+        i = self._next_row(nlevels)
+        self._lat[i] = res.lat
+        self._lon[i] = res.lon
+        self._imt[i] = res.imt
+        self._agg[i] = res.agg
+        self._level[i, :] = np.fromiter(map(_get_lvl, res.values), dtype='float64', count=nlevels)
+        self._apoe[i, :] = np.fromiter(map(_get_val, res.values), dtype='float64', count=nlevels)
+
+    def to_arrays(self) -> CurveArrays:
+        """the raw columns, trimmed to the number of records collected"""
+
+        n = self._size
+        nlevels = self.nlevels or 0
+        level = self._level[:n] if self._level is not None else np.empty((0, nlevels))
+        apoe = self._apoe[:n] if self._apoe is not None else np.empty((0, nlevels))
+        return CurveArrays(self._lat[:n], self._lon[:n], self._imt[:n], self._agg[:n], level, apoe)
+
+    def to_record_batch(self) -> pa.RecordBatch:
+        """the collected records as an arrow record batch (level and apoe as list<double> columns)"""
+
+        arrays = self.to_arrays()
+        return pa.RecordBatch.from_pydict(
+            {
+                'lat': pa.array(arrays.lat),
+                'lon': pa.array(arrays.lon),
+                'imt': pa.array(arrays.imt, pa.string()),
+                'agg': pa.array(arrays.agg, pa.string()),
+                'level': matrix_to_list_array(arrays.level),
+                'apoe': matrix_to_list_array(arrays.apoe),
+            }
+        )
+
+    def to_dataframe(self) -> DataFrame:
+        """one row per curve with level and apoe arrays in each row (the store.curves.get_hazard layout)"""
+
+        arrays = self.to_arrays()
+        return pd.DataFrame(
+            {
+                'lat': format_coords(arrays.lat),
+                'lon': format_coords(arrays.lon),
+                'imt': arrays.imt,
+                'agg': arrays.agg,
+                'level': list(arrays.level),
+                'apoe': list(arrays.apoe),
+            }
+        )
+
+    def to_long_dataframe(self) -> DataFrame:
+        """one row per curve point with float level and apoe (the store.curves.get_hazard_v1 layout)"""
+
+        arrays = self.to_arrays()
+        nlevels = arrays.level.shape[1]
+        return pd.DataFrame(
+            {
+                'lat': np.repeat(format_coords(arrays.lat), nlevels),
+                'lon': np.repeat(format_coords(arrays.lon), nlevels),
+                'imt': np.repeat(arrays.imt, nlevels),
+                'agg': np.repeat(arrays.agg, nlevels),
+                'level': arrays.level.ravel(),
+                'apoe': arrays.apoe.ravel(),
+            }
+        )
@@ -2,16 +2,25 @@ import pandas as pd
 from zipfile import ZIP_BZIP2, ZipFile
 from pandas import DataFrame
 from pathlib import Path
-import math
-import csv
-from typing import List, Any
+from pyarrow import csv as arrow_csv
+from typing import List, Any, Optional, Iterator, Iterable, Deque, Union, Tuple
+from numpy.typing import NDArray
 import os
-from collections import namedtuple
+import logging
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, Future
 from itertools import product
 # import toshi_hazard_store
 import numpy as np
+import pyarrow as pa
 from toshi_hazard_store import query
 import time
+import random
+
+from nzshm_hazlab.store.columnar import BatchFormat, CurveAccumulator, CurveArrays, format_coords
+from nzshm_hazlab.hazard_cube import HazardCube
+from nzshm_hazlab.locations import LocationArray, location_codes
+from nzshm_hazlab.store.metrics import FetchMetrics, Timer
 
 from nzshm_common.location.location import LOCATION_LISTS, location_by_id, LOCATIONS_BY_ID
 from nzshm_common.grids import RegionGrid
@@ -21,6 +30,9 @@ DTYPE = {'lat':'str', 'lon':'str', 'imt':'str', 'agg':'str', 'level':'str', 'apo
 SITE_LIST = 'NZ_0_1_NB_1_1'
 COLUMNS = ['lat', 'lon', 'imt', 'agg', 'level', 'apoe']
 RESOLUTION = 0.001
+THROTTLE_ERRORS = ('ProvisionedThroughputExceeded', 'ThrottlingException', 'RequestLimitExceeded')
+
+log = logging.getLogger(__name__)
 
 RecordIdentifier = namedtuple('RecordIdentifier', 'location imt agg')
 
@@ -32,20 +44,15 @@ def chunks(lst, n):
 def lat_lon(id):
     return location_by_id(id)['latitude'], location_by_id(id)['longitude']
 
-def all_locations() -> List[CodedLocation]:
+def all_locations() -> LocationArray:
     """all locations in NZ35 and 0.1 deg grid"""
 
-    locations_nz35 = [
-        CodedLocation( *lat_lon(id), RESOLUTION)
-        for id in LOCATION_LISTS["NZ"]["locations"]
-    ]
+    locations_nz35 = LocationArray.from_locations(
+        [lat_lon(id) for id in LOCATION_LISTS["NZ"]["locations"]], RESOLUTION
+    )
 
     grid = RegionGrid[SITE_LIST]
-    grid_locs = grid.load()
-    locations_grid = [
-        CodedLocation( *loc, RESOLUTION)
-        for loc in grid_locs
-    ]
+    locations_grid = LocationArray.from_locations(grid.load(), RESOLUTION)
     return locations_nz35 + locations_grid
 
 
@@ -55,6 +62,227 @@ def clean_df(hazard_curves: DataFrame) -> DataFrame:
     return hazard_curves.dropna()
 
 
+def _is_throttled(err: BaseException) -> bool:
+    """True if the error (or the error that caused it) is a DynamoDB throttling error"""
+
+    seen = set()
+    while err is not None and id(err) not in seen:
+        if any(code in f'{type(err).__name__} {err}' for code in THROTTLE_ERRORS):
+            return True
+        seen.add(id(err))
+        err = err.__cause__ or err.__context__
+    return False
+
+
+def _fetch_chunk(
+        hazard_id: str,
+        vs30: int,
+        loc_strs: List[str],
+        imts: List[str],
+        aggs: List[str],
+        max_retries: int,
+        backoff: float,
+        metrics: Optional[FetchMetrics] = None,
+) -> list:
+    """
+    retrieve all records for a chunk of locations, retrying with exponential backoff (and jitter) when
+    THS is throttling requests. Records are sorted into location, imt, agg order so that results do not
+    depend on the order DynamoDB returns them in.
+    """
+
+    for attempt in range(max_retries + 1):
+        try:
+            with Timer() as timer:
+                records = list(query.get_hazard_curves(loc_strs, [vs30], [hazard_id], imts, aggs))
+            break
+        except Exception as err:
+            if attempt == max_retries or not _is_throttled(err):
+                raise
+            delay = backoff * 2**attempt * (1 + random.random())
+            if metrics:
+                metrics.record_retry('ths', err, delay)
+            time.sleep(delay)
+
+    if metrics:
+        metrics.record_chunk('ths', timer.elapsed, len(records), sum(map(_record_bytes, records)))
+
+    loc_order = {loc: i for i, loc in enumerate(loc_strs)}
+    imt_order = {imt: i for i, imt in enumerate(imts)}
+    agg_order = {agg: i for i, agg in enumerate(aggs)}
+
+    def sort_key(res):
+        return (
+            loc_order.get(f'{res.lat:0.3f}~{res.lon:0.3f}', len(loc_order)),
+            imt_order.get(res.imt, len(imt_order)),
+            agg_order.get(res.agg, len(agg_order)),
+        )
+
+    return sorted(records, key=sort_key)
+
+
+def _record_bytes(res) -> int:
+    """the size of the decoded curve of a THS record (a float level and value per point)"""
+
+    return 16 * len(res.values)
+
+
+def _timed_chunk(records: Iterable, metrics: FetchMetrics, source: str = 'ths') -> Iterator:
+    """yield the records of one chunk, recording the time spent waiting on them"""
+
+    records = iter(records)
+    latency = 0.0
+    nrecords = nbytes = 0
+    while True:
+        with Timer() as timer:
+            res = next(records, None)
+        latency += timer.elapsed
+        if res is None:
+            break
+        nrecords += 1
+        nbytes += _record_bytes(res)
+        yield res
+    metrics.record_chunk(source, latency, nrecords, nbytes)
+
+
+def fetch_concurrent(
+        hazard_id: str,
+        vs30: int,
+        loc_strs: List[str],
+        imts: List[str],
+        aggs: List[str],
+        chunk_size: int=100,
+        max_workers: int=8,
+        max_retries: int=5,
+        backoff: float=0.5,
+        metrics: Optional[FetchMetrics]=None,
+) -> Iterator:
+    """
+    split the locations into chunks and query THS for the chunks concurrently on a thread pool. At most
+    max_workers queries are in flight (and at most 2*max_workers chunks held in memory). Records are
+    yielded in chunk order so the output is deterministic regardless of which queries finish first.
+    """
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending: Deque[Future] = deque()
+        for loc_chunk in chunks(loc_strs, chunk_size):
+            pending.append(
+                executor.submit(
+                    _fetch_chunk, hazard_id, vs30, loc_chunk, imts, aggs, max_retries, backoff, metrics
+                )
+            )
+            if len(pending) >= 2 * max_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _iter_records(
+        hazard_id: str,
+        vs30: int,
+        loc_strs: List[str],
+        imts: List[str],
+        aggs: List[str],
+        chunk_size: Optional[int] = None,
+        max_workers: Optional[int] = None,
+        metrics: Optional[FetchMetrics] = None,
+) -> Iterator:
+    """
+    query THS (in location chunks if chunk_size is given, concurrently if max_workers is given), recording
+    each chunk in metrics if given
+    """
+
+    if max_workers:
+        return fetch_concurrent(
+            hazard_id, vs30, loc_strs, imts, aggs, chunk_size or 100, max_workers, metrics=metrics
+        )
+
+    def chunk_records(loc_chunk):
+        records = query.get_hazard_curves(loc_chunk, [vs30], [hazard_id], imts, aggs)
+        return _timed_chunk(records, metrics) if metrics else records
+
+    return (
+        res
+        for loc_chunk in chunks(loc_strs, chunk_size or max(len(loc_strs), 1))
+        for res in chunk_records(loc_chunk)
+    )
+
+
+def _collect_curves(
+        hazard_id: str,
+        vs30: int,
+        loc_strs: List[str],
+        imts: List[str],
+        aggs: List[str],
+        chunk_size: Optional[int] = None,
+        max_workers: Optional[int] = None,
+        metrics: Optional[FetchMetrics] = None,
+) -> CurveAccumulator:
+    """query THS, collecting the records into a columnar accumulator"""
+
+    total_records = len(loc_strs) * len(imts) * len(aggs)
+    curves = CurveAccumulator(total_records)
+    log.info(f'retrieving {total_records} records from THS')
+    for res in _iter_records(hazard_id, vs30, loc_strs, imts, aggs, chunk_size, max_workers, metrics):
+        curves.append_ths(res)
+    return curves
+
+
+def iter_hazard(
+        hazard_id: str,
+        vs30: int,
+        locs: List[CodedLocation],
+        imts: List[str],
+        aggs: List[str],
+        batch_size: int=1000,
+        batch_format: BatchFormat=BatchFormat.NUMPY,
+        chunk_size: int=100,
+        max_workers: Optional[int]=None,
+        metrics: Optional[FetchMetrics]=None,
+) -> Iterator[Union[CurveArrays, pa.RecordBatch]]:
+    """
+    stream all locations, imts and aggs for a particular hazard_id and vs30 in batches of (up to) batch_size
+    curves so that memory use is bounded by the batch size rather than the size of the request. Batches
+    are CurveArrays (numpy blocks with their lat, lon, imt, agg index columns) or arrow RecordBatches.
+    """
+
+    loc_strs = location_codes(locs, RESOLUTION)
+    curves = CurveAccumulator(batch_size)
+    for res in _iter_records(hazard_id, vs30, loc_strs, imts, aggs, chunk_size, max_workers, metrics):
+        curves.append_ths(res)
+        if len(curves) == batch_size:
+            yield _batch(curves, batch_format)
+            curves = CurveAccumulator(batch_size, curves.nlevels)
+    if len(curves):
+        yield _batch(curves, batch_format)
+
+
+def _batch(curves: CurveAccumulator, batch_format: BatchFormat) -> Union[CurveArrays, pa.RecordBatch]:
+    if batch_format is BatchFormat.ARROW:
+        return curves.to_record_batch()
+    return curves.to_arrays()
+
+
+def get_hazard_arrays(
+        hazard_id: str,
+        vs30: int,
+        locs: List[CodedLocation],
+        imts: List[str],
+        aggs: List[str],
+        chunk_size: int=100,
+        max_workers: Optional[int]=None,
+        metrics: Optional[FetchMetrics]=None,
+) -> CurveArrays:
+    """
+    download all locations, imts and aggs for a particular hazard_id and vs30 as raw columns: lat, lon
+    (float), imt, agg (object) and level, apoe (2-D float, one row per curve). If max_workers is set the
+    locations are fetched in chunks of chunk_size concurrently.
+    """
+
+    loc_strs = location_codes(locs, RESOLUTION)
+    curves = _collect_curves(hazard_id, vs30, loc_strs, imts, aggs, chunk_size, max_workers, metrics)
+    return curves.to_arrays()
+
+
 def get_hazard_v1(
         hazard_id: str,
         vs30: int,
@@ -62,86 +290,89 @@ def get_hazard_v1(
         imts: List[str],
         aggs: List[str],
         chunk_size: int=100,
+        max_workers: Optional[int]=None,
+        metrics: Optional[FetchMetrics]=None,
 ) -> DataFrame:
     """download all locations, imts and aggs for a particular hazard_id and vs30."""
 
-    loc_strs = [loc.downsample(RESOLUTION).code for loc in locs]
-    naggs = len(aggs)
-    nimts = len(imts)
-    hazards = query.get_hazard_curves(
-        hazard_model_ids=[hazard_id],
-        vs30s = [vs30],
-        locs = loc_strs[:1],
-        imts = imts,
-        aggs = aggs,
-    )
-    res = next(hazards)
-    nlevels = len(res.values)
-
-    index = range(len(locs) * nimts * naggs * nlevels)
-    dtype = {'lat':'str', 'lon':'str', 'imt':'str', 'agg':'str', 'level':'float64', 'apoe':'float64'}
-    hazard_curves = pd.DataFrame({c: pd.Series(dtype=t) for c, t in dtype.items()}, index=index)
-    ind = 0
-    total_records = len(locs) * len(imts) * len(aggs)
-    print(f'retrieving {total_records} records from THS')
-    print_step = math.ceil(total_records / 10) 
-    # for i,res in enumerate(toshi_hazard_store.query_v3.get_hazard_curves(loc_strs, [vs30], [hazard_id], imts, aggs)):
-    i = 0
-    tic = time.perf_counter()
-    for loc_chunks in chunks(loc_strs, chunk_size):
-        for res in query.get_hazard_curves(loc_chunks, [vs30], [hazard_id], imts, aggs):
-            if i%print_step == 0:
-                toc = time.perf_counter()
-                print(f'retrieved {i / total_records * 100:.0f}% of records from THS in {toc-tic:.1f} seconds') 
-                tic = time.perf_counter()
-            lat = f'{res.lat:0.3f}'
-            lon = f'{res.lon:0.3f}'
-            for value in res.values:
-                hazard_curves.loc[ind,'lat'] = lat
-                hazard_curves.loc[ind,'lon'] = lon
-                hazard_curves.loc[ind,'imt'] = res.imt
-                hazard_curves.loc[ind,'agg'] = res.agg
-                hazard_curves.loc[ind,'level'] = float(value.lvl)
-                hazard_curves.loc[ind,'apoe'] = float(value.val)
-                ind += 1
-            i += 1
-
-
+    loc_strs = location_codes(locs, RESOLUTION)
+    curves = _collect_curves(hazard_id, vs30, loc_strs, imts, aggs, chunk_size, max_workers, metrics)
+    hazard_curves = curves.to_long_dataframe()
     hazard_curves = clean_df(hazard_curves)
 
     return hazard_curves
 
-def get_hazard_from_oqcsv(filepath_pattern: str, imts: List[str]):
-    """assumes loading individual realizations (could be used for aggregates, but the 'agg' column will be inccorect)"""
-    
-    def count_lines(filepath):
-        return sum(1 for _ in filepath.open())
+def _read_oqcsv(filepath: Path) -> Tuple[NDArray, NDArray, NDArray, NDArray]:
+    """read an OpenQuake hazard curve csv: returns lat, lon, levels and the (nsites x nlevels) apoe array"""
+
+    # the first line is OpenQuake metadata, the second the column names
+    oq_output = arrow_csv.read_csv(filepath, read_options=arrow_csv.ReadOptions(skip_rows=1))
+    poe_columns = [name for name in oq_output.column_names if name.startswith('poe-')]
+    levels = np.array([float(name.replace('poe-', '')) for name in poe_columns])
+    apoe = np.column_stack(
+        [oq_output[name].to_numpy().astype('float64', copy=False) for name in poe_columns]
+    )
+    return oq_output['lat'].to_numpy(), oq_output['lon'].to_numpy(), levels, apoe
+
+
+def get_hazard_from_oqcsv(
+        filepath_pattern: str,
+        imts: List[str],
+        as_cube: bool=False,
+        max_workers: Optional[int]=None,
+        metrics: Optional[FetchMetrics]=None,
+) -> Union[DataFrame, HazardCube]:
+    """
+    assumes loading individual realizations (could be used for aggregates, but the 'agg' column will be inccorect)
+
+    The csv file for each IMT is parsed once with the arrow csv reader and the files are read in parallel.
+    If metrics is given each file is recorded as a chunk.
+    """
 
     filepath = Path(filepath_pattern.replace('IMT', imts[0]))
-    nsites = count_lines(filepath) - 2
-    nimts = len(imts)
-    index = range(nsites * nimts)
-    hazard_curves = pd.DataFrame({c: pd.Series(dtype=t) for c, t in DTYPE.items()}, index=index)
     filepath_head = filepath.name[:filepath.name.index(imts[0])]
     agg = filepath_head.replace('hazard_curve', '').replace('-', '')
 
-    i_row = 0
-    for imt in imts:
-        filepath = Path(filepath_pattern.replace('IMT', imt))
-        oq_output = pd.read_csv(filepath, skiprows=1)
-        columns = oq_output.columns
-        hazard_idxs = [i for i in range(len(columns)) if 'poe-' in columns[i]]
-        levels = np.array([float(columns[idx].replace('poe-', '')) for idx in hazard_idxs])
-        for index, row in oq_output.iterrows():
-            apoe = row[hazard_idxs].to_numpy()
-            loc_code = CodedLocation(row['lat'], row['lon'], 0.001).code
-            hazard_curves.loc[i_row, 'lat'] = loc_code.split('~')[0]
-            hazard_curves.loc[i_row, 'lon'] = loc_code.split('~')[1]
-            hazard_curves.loc[i_row, 'imt'] = imt
-            hazard_curves.loc[i_row, 'agg'] = agg
-            hazard_curves.loc[i_row, 'level'] = levels
-            hazard_curves.loc[i_row, 'apoe'] = apoe
-            i_row += 1
+    def read(filepath):
+        with Timer() as timer:
+            curves = _read_oqcsv(filepath)
+        if metrics:
+            metrics.record_chunk('oqcsv', timer.elapsed, len(curves[0]), sum(a.nbytes for a in curves))
+        return curves
+
+    filepaths = [Path(filepath_pattern.replace('IMT', imt)) for imt in imts]
+    with ThreadPoolExecutor(max_workers=max_workers or len(imts)) as executor:
+        imt_curves = list(executor.map(read, filepaths))
+
+    nsites = [len(lat) for lat, _, _, _ in imt_curves]
+    lat = np.concatenate([lat for lat, _, _, _ in imt_curves])
+    lon = np.concatenate([lon for _, lon, _, _ in imt_curves])
+    imt = np.repeat(np.array(imts, dtype=object), nsites)
+    if as_cube:
+        arrays = CurveArrays(
+            lat=lat,
+            lon=lon,
+            imt=imt,
+            agg=np.full(len(imt), agg, dtype=object),
+            level=np.vstack([np.broadcast_to(levels, imt_apoe.shape) for _, _, levels, imt_apoe in imt_curves]),
+            apoe=np.vstack([imt_apoe for _, _, _, imt_apoe in imt_curves]),
+        )
+        return HazardCube.from_arrays(arrays)
+
+    # each row refers to the levels vector of its IMT rather than holding a copy
+    level = [levels for n, (_, _, levels, _) in zip(nsites, imt_curves) for _ in range(n)]
+    apoe = [row for _, _, _, imt_apoe in imt_curves for row in imt_apoe]
+
+    hazard_curves = pd.DataFrame(
+        {
+            'lat': format_coords(lat),
+            'lon': format_coords(lon),
+            'imt': imt,
+            'agg': np.full(len(imt), agg, dtype=object),
+            'level': level,
+            'apoe': apoe,
+        }
+    )
     return hazard_curves
 
 
@@ -152,36 +383,24 @@ def get_hazard(
         imts: List[str],
         aggs: List[str],
         chunk_size: int=100,
-) -> DataFrame:
-    """download all locations, imts and aggs for a particular hazard_id and vs30."""
+        max_workers: Optional[int]=None,
+        as_cube: bool=False,
+        metrics: Optional[FetchMetrics]=None,
+) -> Union[DataFrame, HazardCube]:
+    """
+    download all locations, imts and aggs for a particular hazard_id and vs30. If max_workers is set the
+    locations are fetched in chunks of chunk_size concurrently (see fetch_concurrent). If as_cube is set
+    the curves are returned as a HazardCube rather than a DataFrame. Pass a FetchMetrics to record the
+    latency and size of each chunk and any retries.
+    """
 
-    loc_strs = [loc.downsample(RESOLUTION).code for loc in locs]
-    naggs = len(aggs)
-    nimts = len(imts)
-
-    index = range(len(locs) * nimts * naggs)
-    hazard_curves = pd.DataFrame({c: pd.Series(dtype=t) for c, t in DTYPE.items()}, index=index)
-    total_records = len(locs) * len(imts) * len(aggs)
-    print(f'retrieving {total_records} records from THS')
-    print_step = math.ceil(total_records / 10) 
-    # for i,res in enumerate(toshi_hazard_store.query_v3.get_hazard_curves(loc_strs, [vs30], [hazard_id], imts, aggs)):
-    tic = time.perf_counter()
-    # for loc_chunks in chunks(loc_strs, chunk_size):
-    for i, res in enumerate(query.get_hazard_curves(loc_strs, [vs30], [hazard_id], imts, aggs)):
-        if i%print_step == 0:
-            toc = time.perf_counter()
-            print(f'retrieved {i / total_records * 100:.0f}% of records from THS in {toc-tic:.1f} seconds') 
-            tic = time.perf_counter()
-        lat = f'{res.lat:0.3f}'
-        lon = f'{res.lon:0.3f}'
-        hazard_curves.loc[i,'lat'] = lat
-        hazard_curves.loc[i,'lon'] = lon
-        hazard_curves.loc[i,'imt'] = res.imt
-        hazard_curves.loc[i,'agg'] = res.agg
-        hazard_curves.loc[i,'level'] = np.array([float(item.lvl) for item in res.values])
-        hazard_curves.loc[i,'apoe'] = np.array([float(item.val) for item in res.values])
-
-    return hazard_curves
+    loc_strs = location_codes(locs, RESOLUTION)
+    if not max_workers:
+        chunk_size = None
+    curves = _collect_curves(hazard_id, vs30, loc_strs, imts, aggs, chunk_size, max_workers, metrics)
+    if as_cube:
+        return HazardCube.from_arrays(curves.to_arrays())
+    return curves.to_dataframe()
 
 if __name__ == "__main__":
 
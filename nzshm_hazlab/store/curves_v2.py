@@ -1,15 +1,16 @@
-import time
 import logging
 import pandas as pd
 from pandas import DataFrame
-from typing import List, Any
+from typing import List, Any, Optional, Sequence
 from collections import namedtuple
-from toshi_hazard_store import query
 
 from nzshm_common.location.location import LOCATION_LISTS, location_by_id, LOCATIONS_BY_ID
 from nzshm_common.grids import RegionGrid
 from nzshm_common.location import CodedLocation
 
+from nzshm_hazlab.store.curves import get_hazard_arrays
+from nzshm_hazlab.store.metrics import FetchMetrics, log_event
+
 DTYPE = {'lat':'str', 'lon':'str', 'imt':'str', 'agg':'str', 'level':'str', 'apoe':'str'}
 SITE_LIST = 'NZ_0_1_NB_1_1'
 COLUMNS = ['lat', 'lon', 'imt', 'agg', 'level', 'apoe']
@@ -55,33 +56,39 @@ def get_hazard(
         vs30: int,
         locs: List[CodedLocation],
         imts: List[str],
-        aggs: List[str]
+        aggs: List[str],
+        chunk_sizes: Sequence[int] = (5,),
+        nlocs: int = 25,
+        max_workers: Optional[int] = None,
 ) -> DataFrame:
-    """download all locations, imts and aggs for a particular hazard_id and vs30."""
-
-    loc_strs = [loc.downsample(RESOLUTION).code for loc in locs]
-    naggs = len(aggs)
-    nimts = len(imts)
-
-    index = range(len(locs) * nimts * naggs)
-    hazard_curves = pd.DataFrame({c: pd.Series(dtype=t) for c, t in DTYPE.items()}, index=index)
-    total_records = len(locs) * len(imts) * len(aggs)
-    print(f'retrieving {total_records} records from THS')
-    csize = 5
-    print(f'timing retrival in location chunks of {csize}')
-    t0 = time.perf_counter()
-    cnt = 0
-    for loc_chunks in chunks(loc_strs[:25], csize):
-        print("get_hazard_curves", loc_chunks, [vs30], [hazard_id], imts, aggs)
-        for res in query.get_hazard_curves(loc_chunks, [vs30], [hazard_id], imts, aggs):
-            cnt = cnt+1
-            log.debug(res)
-            print(res)
-
-    t1 = time.perf_counter()
-    print(f'retrieved {cnt} records in {t1 - t0} seconds')
-
-    return hazard_curves
+    """
+    time retrieval of the first nlocs locations in location chunks of each of chunk_sizes (concurrently if
+    max_workers is set). Returns a row of metrics for each chunk size.
+    """
+
+    timings = []
+    for csize in chunk_sizes:
+        print(f'timing retrival in location chunks of {csize}')
+        metrics = FetchMetrics(callback=log_event)
+        get_hazard_arrays(
+            hazard_id, vs30, locs[:nlocs], imts, aggs, chunk_size=csize, max_workers=max_workers, metrics=metrics
+        )
+        metrics.print_summary()
+        latency = metrics.latency_percentiles((50, 90))
+        timings.append(
+            dict(
+                chunk_size=csize,
+                chunks=len(metrics.chunks),
+                records=metrics.records,
+                wall_time=metrics.wall_time,
+                records_per_second=metrics.records_per_second,
+                latency_p50=latency[50],
+                latency_p90=latency[90],
+                retries=metrics.retries,
+            )
+        )
+
+    return pd.DataFrame(timings)
 
 def grid_locations(site_list):
 
@@ -117,5 +124,5 @@ if __name__ == "__main__":
         [CodedLocation( *lat_lon(id), RESOLUTION) for id in LOCATIONS_BY_ID.keys()]
     
     for vs30 in vs30s[:1]:
-        hazard = get_hazard(hazard_id, vs30, locations, imts, aggs)
-        print(hazard)
+        timings = get_hazard(hazard_id, vs30, locations, imts, aggs, chunk_sizes=[5, 10, 25])
+        print(timings)
@@ -1,7 +1,9 @@
 import math
+import operator
 
 from itertools import product
-from typing import List, Tuple, Optional, Dict, Any
+from functools import reduce
+from typing import List, Tuple, Optional, Dict, Any, Union, Iterator
 from nzshm_common.location import CodedLocation
 from enum import Enum, auto
 
@@ -14,6 +16,12 @@ import pyarrow.compute as pc
 
 from pyarrow import fs
 
+from nzshm_hazlab.hazard_cube import HazardCube
+from nzshm_hazlab.locations import location_codes
+from nzshm_hazlab.store.fs_cache import CachingFileSystemHandler, caching_filesystem
+from nzshm_hazlab.store.metrics import FetchMetrics, Timer
+from nzshm_hazlab.store.columnar import BatchFormat, CurveArrays, format_coords, list_column_to_matrix
+
 imtls = np.array([
     0.0001, 0.0002, 0.0004, 0.0006, 0.0008,
     0.001, 0.002, 0.004, 0.006, 0.008,
@@ -23,6 +31,7 @@ imtls = np.array([
 ])
 
 RESOLUTION = 0.001
+COLUMNS = ['agg', 'values', 'vs30', 'imt', 'lat', 'lon']
 
 class ArrowFS(Enum):
     LOCAL = auto()
@@ -61,52 +70,371 @@ def get_arrow_filesystem(
     return filesystem, root
 
 
-def get_aggs_dataset(fs_specs):
+def _discover_aggs_dataset(fs_specs: Dict[str, Any]) -> ds.Dataset:
+    """
+    fs_specs may include a 'cache_dir' (and 'cache_bytes' size limit) to keep the fragments read from
+    the dataset on local disk (see fs_cache.CachingFileSystemHandler)
+    """
 
     if fs_specs['arrow_fs'] == ArrowFS.LOCAL:
         filesystem, root = get_arrow_filesystem(ArrowFS.LOCAL, local_dir=fs_specs['arrow_dir'])
     elif fs_specs['arrow_fs'] == ArrowFS.AWS:
-        filesystem, root = get_arrow_filesystem(ArrowFS.LOCAL, aws_region=fs_specs['aws_region'], s3_bucket=fs_specs['s3_bucket'])
+        filesystem, root = get_arrow_filesystem(ArrowFS.AWS, aws_region=fs_specs['aws_region'], s3_bucket=fs_specs['s3_bucket'])
     
+    if fs_specs.get('cache_dir'):
+        filesystem = caching_filesystem(filesystem, fs_specs['cache_dir'], fs_specs.get('cache_bytes'))
+
     dataset = ds.dataset(root, format='parquet', filesystem=filesystem, partitioning='hive')
     return dataset
 
-    
 
-def get_hazard(
+class ScanStats:
+    """what a scan touched: the fragments (files) left after partition pruning and their total size in bytes"""
+
+    def __init__(self, fragments: int, fragments_total: int, fragment_bytes: int):
+        self.fragments = fragments
+        self.fragments_total = fragments_total
+        self.fragment_bytes = fragment_bytes
+
+    def __repr__(self) -> str:
+        return (
+            f'ScanStats(fragments={self.fragments}, fragments_total={self.fragments_total}, '
+            f'fragment_bytes={self.fragment_bytes})'
+        )
+
+
+class DatasetRegistry:
+    """
+    Caches discovered arrow datasets per filesystem and root so that the hive fragments are only listed once
+    (expensive on S3 with thousands of files). The fragments matching a set of partition values, and their
+    sizes, are also cached so that repeated queries against the same model skip pruning as well as discovery.
+    """
+
+    def __init__(self):
+        self._datasets: Dict[Tuple, ds.Dataset] = {}
+        self._fragments: Dict[Tuple, List[ds.Fragment]] = {}
+        self._fragment_bytes: Dict[str, int] = {}
+        self.last_scan: Optional[ScanStats] = None
+
+    @staticmethod
+    def _key(fs_specs: Dict[str, Any]) -> Tuple:
+        return (
+            fs_specs['arrow_fs'],
+            fs_specs.get('arrow_dir'),
+            fs_specs.get('aws_region'),
+            fs_specs.get('s3_bucket'),
+            fs_specs.get('cache_dir'),
+        )
+
+    def dataset(self, fs_specs: Dict[str, Any]) -> ds.Dataset:
+        key = self._key(fs_specs)
+        if key not in self._datasets:
+            self._datasets[key] = _discover_aggs_dataset(fs_specs)
+        return self._datasets[key]
+
+    def clear(self) -> None:
+        """forget all datasets (e.g. if new files have been written)"""
+
+        self._datasets.clear()
+        self._fragments.clear()
+        self._fragment_bytes.clear()
+
+    def fragments(self, fs_specs: Dict[str, Any], partition_values: Dict[str, List[Any]]) -> List[ds.Fragment]:
+        """
+        the fragments of the dataset that can contain rows with the partition values. Values for fields that
+        are not partition keys of the dataset are ignored.
+        """
+
+        dataset = self.dataset(fs_specs)
+        partition_fields = set(dataset.partitioning.schema.names) if dataset.partitioning else set()
+        partition_values = {
+            field: tuple(sorted(values)) for field, values in partition_values.items() if field in partition_fields
+        }
+        key = (self._key(fs_specs), tuple(sorted(partition_values.items())))
+        if key not in self._fragments:
+            expressions = [
+                reduce(operator.or_, (pc.field(field) == pc.scalar(value) for value in values))
+                for field, values in partition_values.items()
+            ]
+            if expressions:
+                fragments = dataset.get_fragments(filter=reduce(operator.and_, expressions))
+            else:
+                fragments = dataset.get_fragments()
+            self._fragments[key] = list(fragments)
+        return self._fragments[key]
+
+    def _bytes(self, dataset: ds.Dataset, fragments: List[ds.Fragment]) -> int:
+        unknown = [fragment.path for fragment in fragments if fragment.path not in self._fragment_bytes]
+        if unknown:
+            for info in dataset.filesystem.get_file_info(unknown):
+                self._fragment_bytes[info.path] = info.size
+        return sum(self._fragment_bytes[fragment.path] for fragment in fragments)
+
+    def scanner(
+        self,
+        fs_specs: Dict[str, Any],
+        partition_values: Dict[str, List[Any]],
+        flt: pc.Expression,
+        columns: List[str],
+        **kwargs,
+    ) -> ds.Scanner:
+        """
+        a scanner over only the fragments matching the partition values. The fragments and bytes the scan
+        covers are recorded in last_scan.
+        """
+
+        dataset = self.dataset(fs_specs)
+        fragments = self.fragments(fs_specs, partition_values)
+        pruned = ds.FileSystemDataset(
+            fragments, schema=dataset.schema, format=dataset.format, filesystem=dataset.filesystem
+        )
+        self.last_scan = ScanStats(
+            fragments=len(fragments),
+            fragments_total=len(dataset.files),
+            fragment_bytes=self._bytes(dataset, fragments),
+        )
+        return ds.Scanner.from_dataset(pruned, filter=flt, columns=columns, **kwargs)
+
+
+DATASETS = DatasetRegistry()
+
+
+def get_aggs_dataset(fs_specs):
+    """the aggregate curves dataset, discovered once per filesystem and root (see DatasetRegistry)"""
+
+    return DATASETS.dataset(fs_specs)
+
+
+def _fs_cache(fs_specs: Dict[str, Any]) -> Optional[CachingFileSystemHandler]:
+    handler = getattr(DATASETS.dataset(fs_specs).filesystem, 'handler', None)
+    return handler if isinstance(handler, CachingFileSystemHandler) else None
+
+
+def _to_table(arrow_scanner: ds.Scanner, fs_specs: Dict[str, Any], metrics: Optional[FetchMetrics]) -> pa.Table:
+    """run a scan, recording it as one chunk (and any hits and misses of the fragment cache) in metrics"""
+
+    if metrics is None:
+        return arrow_scanner.to_table()
+
+    cache = _fs_cache(fs_specs)
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    with Timer() as timer:
+        table = arrow_scanner.to_table()
+    metrics.record_chunk('arrow', timer.elapsed, table.num_rows, table.nbytes)
+    if cache:
+        metrics.record_cache('arrow', cache.hits - hits, cache.misses - misses)
+    return table
+
+
+def hazard_filter(
         hazard_id: str,
         vs30: int,
         locs: List[CodedLocation],
         imts: List[str],
         aggs: List[str],
-        fs_specs: Dict[str, Any],
-) -> pd.DataFrame:
-    """download all locations, imts and aggs for a particular hazard_id and vs30."""
+) -> pc.Expression:
+
+    return multi_hazard_filter([hazard_id], [vs30], locs, imts, aggs)
 
-    dataset = get_aggs_dataset(fs_specs)
 
-    loc_strs = [loc.downsample(RESOLUTION).code for loc in locs]
-    naggs = len(aggs)
-    nimts = len(imts)
+def multi_hazard_filter(
+        hazard_ids: List[str],
+        vs30s: List[int],
+        locs: List[CodedLocation],
+        imts: List[str],
+        aggs: List[str],
+) -> pc.Expression:
 
-    location = locs[0]
-    imt = imts[0]
-    nloc_001s = [loc.downsample(0.001).code for loc in locs]
-    flt = (
+    nloc_001s = location_codes(locs, 0.001)
+    return (
         (pc.is_in(pc.field('agg'), pa.array(aggs)))
         & (pc.is_in(pc.field('imt'), pa.array(imts)))
         & (pc.is_in(pc.field('nloc_001'), pa.array(nloc_001s)))
-        & (pc.field('vs30') == pc.scalar(vs30))
-        & (pc.field('hazard_model_id') == pc.scalar(hazard_id))
+        & (pc.is_in(pc.field('vs30'), pa.array(vs30s)))
+        & (pc.is_in(pc.field('hazard_model_id'), pa.array(hazard_ids)))
     )
-    columns = ['agg', 'values', 'vs30', 'imt', 'lat', 'lon']
-    arrow_scanner = ds.Scanner.from_dataset(dataset, filter=flt, columns=columns)
-    table = arrow_scanner.to_table()
-    hazard_curves = table.to_pandas()
-    hazard_curves[['lat', 'lon']] = hazard_curves[['lat', 'lon']].applymap(lambda x: '{0:.3f}'.format(x))
-    hazard_curves['level'] = pd.NA
-    for i in range(len(hazard_curves)):
-        hazard_curves['level'].iloc[i] = imtls
-    hazard_curves.rename({'values': 'apoe'}, axis='columns', inplace=True)
-
-    return hazard_curves
\ No newline at end of file
+
+
+def iter_hazard(
+        hazard_id: str,
+        vs30: int,
+        locs: List[CodedLocation],
+        imts: List[str],
+        aggs: List[str],
+        fs_specs: Dict[str, Any],
+        batch_size: int = 10_000,
+        batch_format: BatchFormat = BatchFormat.NUMPY,
+        metrics: Optional[FetchMetrics] = None,
+) -> Iterator[Union[CurveArrays, pa.RecordBatch]]:
+    """
+    stream all locations, imts and aggs for a particular hazard_id and vs30 in batches of (up to) batch_size
+    curves so that memory use is bounded by the batch size rather than the size of the request. Batches are
+    arrow RecordBatches straight from the scanner or CurveArrays (numpy blocks with their lat, lon, imt, agg
+    index columns, the levels of every row are a read-only view of imtls). If metrics is given each batch is
+    recorded as a chunk.
+    """
+
+    flt = hazard_filter(hazard_id, vs30, locs, imts, aggs)
+    partition_values = {'hazard_model_id': [hazard_id], 'vs30': [vs30]}
+    arrow_scanner = DATASETS.scanner(fs_specs, partition_values, flt, COLUMNS, batch_size=batch_size)
+    batches = _rebatch(arrow_scanner.to_batches(), batch_size)
+    while True:
+        with Timer() as timer:
+            batch = next(batches, None)
+        if batch is None:
+            break
+        if metrics:
+            metrics.record_chunk('arrow', timer.elapsed, batch.num_rows, batch.nbytes)
+        if batch_format is BatchFormat.ARROW:
+            yield batch
+        else:
+            yield _table_to_arrays(batch)
+
+
+def _rebatch(batches: Iterator[pa.RecordBatch], batch_size: int) -> Iterator[pa.RecordBatch]:
+    """
+    the scanner applies batch_size before filtering so most batches are smaller than requested; combine them
+    into batches of exactly batch_size rows (apart from the last)
+    """
+
+    pending: List[pa.RecordBatch] = []
+    nrows = 0
+    for batch in batches:
+        if batch.num_rows == 0:
+            continue
+        pending.append(batch)
+        nrows += batch.num_rows
+        if nrows >= batch_size:
+            table = pa.Table.from_batches(pending).combine_chunks()
+            start = 0
+            while nrows - start >= batch_size:
+                yield table.slice(start, batch_size).to_batches()[0]
+                start += batch_size
+            pending = table.slice(start).to_batches()
+            nrows -= start
+    if nrows:
+        yield pa.Table.from_batches(pending).combine_chunks().to_batches()[0]
+
+
+def _scan_table(
+        hazard_id: str,
+        vs30: int,
+        locs: List[CodedLocation],
+        imts: List[str],
+        aggs: List[str],
+        fs_specs: Dict[str, Any],
+        metrics: Optional[FetchMetrics] = None,
+) -> pa.Table:
+
+    flt = hazard_filter(hazard_id, vs30, locs, imts, aggs)
+    partition_values = {'hazard_model_id': [hazard_id], 'vs30': [vs30]}
+    arrow_scanner = DATASETS.scanner(fs_specs, partition_values, flt, COLUMNS)
+    return _to_table(arrow_scanner, fs_specs, metrics)
+
+
+def _table_to_arrays(table: Union[pa.Table, pa.RecordBatch]) -> CurveArrays:
+    """
+    the values list column is flattened straight into an (n_rows x n_levels) array (without copying when the
+    table has a single chunk); every row shares the imtls levels vector (a read-only broadcast view)
+    """
+
+    apoe = list_column_to_matrix(table['values'])
+    return CurveArrays(
+        lat=table['lat'].to_numpy(zero_copy_only=False),
+        lon=table['lon'].to_numpy(zero_copy_only=False),
+        imt=table['imt'].to_numpy(zero_copy_only=False),
+        agg=table['agg'].to_numpy(zero_copy_only=False),
+        level=np.broadcast_to(imtls, apoe.shape),
+        apoe=apoe,
+    )
+
+
+def get_hazard_arrays(
+        hazard_id: str,
+        vs30: int,
+        locs: List[CodedLocation],
+        imts: List[str],
+        aggs: List[str],
+        fs_specs: Dict[str, Any],
+        metrics: Optional[FetchMetrics] = None,
+) -> CurveArrays:
+    """
+    download all locations, imts and aggs for a particular hazard_id and vs30 as raw columns: lat, lon
+    (float), imt, agg (object) and level, apoe (2-D float, one row per curve).
+    """
+
+    return _table_to_arrays(_scan_table(hazard_id, vs30, locs, imts, aggs, fs_specs, metrics))
+
+
+def get_hazard(
+        hazard_id: str,
+        vs30: int,
+        locs: List[CodedLocation],
+        imts: List[str],
+        aggs: List[str],
+        fs_specs: Dict[str, Any],
+        as_cube: bool = False,
+        metrics: Optional[FetchMetrics] = None,
+) -> Union[pd.DataFrame, HazardCube]:
+    """
+    download all locations, imts and aggs for a particular hazard_id and vs30. If as_cube is set the curves
+    are returned as a HazardCube rather than a DataFrame. Pass a FetchMetrics to record the scan time and
+    size (and fragment cache hits and misses).
+    """
+
+    table = _scan_table(hazard_id, vs30, locs, imts, aggs, fs_specs, metrics)
+    if as_cube:
+        return HazardCube.from_arrays(_table_to_arrays(table))
+    return _table_to_frame(table)
+
+
+def _table_to_frame(table: pa.Table) -> pd.DataFrame:
+
+    arrays = _table_to_arrays(table)
+    hazard_curves = pd.DataFrame(
+        {
+            'agg': arrays.agg,
+            'apoe': list(arrays.apoe),
+            'vs30': table['vs30'].to_numpy(zero_copy_only=False),
+            'imt': arrays.imt,
+            'lat': format_coords(table['lat']),
+            'lon': format_coords(table['lon']),
+            'level': [imtls] * len(table),
+        }
+    )
+    return hazard_curves
+
+
+def get_hazard_multi(
+        hazard_ids: List[str],
+        vs30s: List[int],
+        locs: List[CodedLocation],
+        imts: List[str],
+        aggs: List[str],
+        fs_specs: Dict[str, Any],
+        as_cube: bool = False,
+        metrics: Optional[FetchMetrics] = None,
+) -> Dict[Tuple[str, int], Union[pd.DataFrame, HazardCube]]:
+    """
+    download all locations, imts and aggs for several hazard models and vs30s with a single scan of the
+    dataset (rather than one scan per model and vs30). Returns the curves for each (hazard_id, vs30); any
+    combination with no curves in the dataset is missing from the result.
+    """
+
+    flt = multi_hazard_filter(hazard_ids, vs30s, locs, imts, aggs)
+    partition_values = {'hazard_model_id': hazard_ids, 'vs30': vs30s}
+    columns = COLUMNS + ['hazard_model_id']
+    table = _to_table(DATASETS.scanner(fs_specs, partition_values, flt, columns), fs_specs, metrics)
+
+    hazard = {}
+    for hazard_id in hazard_ids:
+        model_mask = pc.equal(table['hazard_model_id'], hazard_id)
+        for vs30 in vs30s:
+            group = table.filter(pc.and_(model_mask, pc.equal(table['vs30'], vs30)))
+            if group.num_rows == 0:
+                continue
+            if as_cube:
+                hazard[(hazard_id, vs30)] = HazardCube.from_arrays(_table_to_arrays(group))
+            else:
+                hazard[(hazard_id, vs30)] = _table_to_frame(group)
+    return hazard
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, Optional, Union
+
+import pyarrow as pa
+from pyarrow import fs
+
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+class CachingFileSystemHandler(fs.FileSystemHandler):
+    """
+    Read-through cache in front of an arrow filesystem (e.g. S3). Files opened for reading are copied whole
+    to a local directory the first time and served from local disk after that. Each cached file is validated
+    against the size and modification time reported by the underlying filesystem (S3 does not expose the
+    ETag through arrow, the last-modified time changes whenever the object does). When the cache grows past
+    max_bytes the least recently used files are removed, apart from files that are being opened (arrow reads
+    fragments on several threads).
+
+    All other operations are passed through to the underlying filesystem. Use it with
+    pyarrow.fs.PyFileSystem(CachingFileSystemHandler(...)), or see caching_filesystem().
+    """
+
+    def __init__(
+        self,
+        base: fs.FileSystem,
+        cache_dir: Union[str, Path],
+        max_bytes: Optional[int] = None,
+        validate: bool = True,
+    ):
+        self.base = base
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.validate = validate
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # local copies being fetched or opened, with the number of readers of each
+        self._in_use: Dict[Path, int] = {}
+
+    def __eq__(self, other):
+        if isinstance(other, CachingFileSystemHandler):
+            return self.base.equals(other.base) and self.cache_dir == other.cache_dir
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def _local_paths(self, path: str):
+        name = hashlib.sha1(path.encode()).hexdigest()
+        return self.cache_dir / f'{name}.data', self.cache_dir / f'{name}.json'
+
+    @staticmethod
+    def _signature(info: fs.FileInfo) -> dict:
+        return {'size': info.size, 'mtime_ns': info.mtime_ns}
+
+    def _acquire(self, data_path: Path) -> None:
+        self._in_use[data_path] = self._in_use.get(data_path, 0) + 1
+
+    def _release(self, data_path: Path) -> None:
+        with self._lock:
+            self._in_use[data_path] -= 1
+            if not self._in_use[data_path]:
+                del self._in_use[data_path]
+
+    def _cached_file(self, path: str) -> Path:
+        """
+        the local copy of path, fetching it if it is missing or out of date. The copy is not evicted until it
+        is released with _release.
+        """
+
+        data_path, meta_path = self._local_paths(path)
+        signature = None
+        if self.validate or not data_path.exists():
+            signature = self._signature(self.base.get_file_info(path))
+
+        with self._lock:
+            if data_path.exists() and meta_path.exists():
+                meta = json.loads(meta_path.read_text())
+                if signature is None or meta['signature'] == signature:
+                    self.hits += 1
+                    os.utime(data_path)
+                    self._acquire(data_path)
+                    return data_path
+            self.misses += 1
+            self._acquire(data_path)
+
+        try:
+            tmp_path = data_path.with_suffix(f'.{uuid.uuid4().hex}.tmp')
+            with self.base.open_input_stream(path) as source, open(tmp_path, 'wb') as target:
+                while chunk := source.read(COPY_BUFFER_SIZE):
+                    target.write(chunk)
+            with self._lock:
+                os.replace(tmp_path, data_path)
+                meta_path.write_text(json.dumps({'path': path, 'signature': signature}))
+            self.evict()
+        except BaseException:
+            self._release(data_path)
+            raise
+        return data_path
+
+    def _open(self, path: str, open_local: Callable[[str], pa.NativeFile]) -> pa.NativeFile:
+        data_path = self._cached_file(path)
+        try:
+            return open_local(str(data_path))
+        finally:
+            # once open the file can be evicted, the open file keeps its data
+            self._release(data_path)
+
+    def size(self) -> int:
+        """total size of the cached files in bytes"""
+
+        return sum(path.stat().st_size for path in self.cache_dir.glob('*.data'))
+
+    def evict(self) -> None:
+        """remove least recently used files until the cache is within max_bytes"""
+
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            files = []
+            for path in self.cache_dir.glob('*.data'):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+            files.sort()
+            total = sum(size for _, size, _ in files)
+            for _, size, path in files:
+                if total <= self.max_bytes:
+                    break
+                if path in self._in_use:
+                    continue
+                path.unlink(missing_ok=True)
+                path.with_suffix('.json').unlink(missing_ok=True)
+                total -= size
+
+    def clear(self) -> None:
+        with self._lock:
+            for path in self.cache_dir.glob('*.data'):
+                if path in self._in_use:
+                    continue
+                path.unlink(missing_ok=True)
+                path.with_suffix('.json').unlink(missing_ok=True)
+
+    # reading goes through the cache
+    def open_input_file(self, path):
+        return self._open(path, lambda local_path: pa.memory_map(local_path, 'r'))
+
+    def open_input_stream(self, path):
+        return self._open(path, lambda local_path: pa.OSFile(local_path, 'rb'))
+
+    # everything else is passed through
+    def get_type_name(self):
+        return f'caching+{self.base.type_name}'
+
+    def normalize_path(self, path):
+        return self.base.normalize_path(path)
+
+    def get_file_info(self, paths):
+        return self.base.get_file_info(paths)
+
+    def get_file_info_selector(self, selector):
+        return self.base.get_file_info(selector)
+
+    def create_dir(self, path, recursive):
+        self.base.create_dir(path, recursive=recursive)
+
+    def delete_dir(self, path):
+        self.base.delete_dir(path)
+
+    def delete_dir_contents(self, path, missing_dir_ok=False):
+        self.base.delete_dir_contents(path, missing_dir_ok=missing_dir_ok)
+
+    def delete_root_dir_contents(self):
+        self.base.delete_dir_contents('/', accept_root_dir=True)
+
+    def delete_file(self, path):
+        self.base.delete_file(path)
+
+    def move(self, src, dest):
+        self.base.move(src, dest)
+
+    def copy_file(self, src, dest):
+        self.base.copy_file(src, dest)
+
+    def open_output_stream(self, path, metadata):
+        return self.base.open_output_stream(path, metadata=metadata)
+
+    def open_append_stream(self, path, metadata):
+        return self.base.open_append_stream(path, metadata=metadata)
+
+
+def caching_filesystem(
+    base: fs.FileSystem,
+    cache_dir: Union[str, Path],
+    max_bytes: Optional[int] = None,
+    validate: bool = True,
+) -> fs.PyFileSystem:
+    """wrap an arrow filesystem in a local read-through cache (see CachingFileSystemHandler)"""
+
+    return fs.PyFileSystem(CachingFileSystemHandler(base, cache_dir, max_bytes, validate))
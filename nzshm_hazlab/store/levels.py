@@ -1,15 +1,19 @@
 from pathlib import Path
+from collections import namedtuple
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
 import time
 
 import pandas as pd
 from pandas import DataFrame
 import numpy as np
 
-from nzshm_common.location import CodedLocation
 from nzshm_common.grids import RegionGrid
 
 from nzshm_hazlab.store.curves import get_hazard_v1, get_hazard
-from nzshm_hazlab.data_functions import get_poe_df, compute_hazard_at_poe
+from nzshm_hazlab.data_functions import get_poe_df, compute_hazard_at_poe, compute_hazard_at_poes
+from nzshm_hazlab.hazard_cube import HazardCube
+from nzshm_hazlab.locations import LocationArray
 from toshi_hazard_store import query
 
 
@@ -18,11 +22,11 @@ RESOLUTION = 0.001
 SITE_LIST = 'NZ_0_1_NB_1_1'
 INV_TIME = 50
 
+GridGeometry = namedtuple('GridGeometry', 'lat lon locations')
+
 def grid_locations(site_list):
 
-    grid = RegionGrid[site_list].load()
-    for loc in grid:
-        yield CodedLocation(loc[0], loc[1], RESOLUTION)
+    yield from LocationArray.from_locations(RegionGrid[site_list].load(), RESOLUTION)
 
 
 # def poe_archive_filepath(hazard_id, imt, agg, poe, vs30):
@@ -36,49 +40,71 @@ def grid_locations(site_list):
 #     haz_poe.to_json(poe_archive_filepath(hazard_id, imt, agg, poe, vs30))
 
     
-def get_hazard_at_poe(hazard_id, vs30, imt, agg, poe):
-
-    ghaz = next(query.get_gridded_hazard([hazard_id], [SITE_LIST], [vs30], [imt], [agg], [poe]))
-    grid = RegionGrid[SITE_LIST]
-    locations = list(
-        map(lambda grd_loc: CodedLocation(grd_loc[0], grd_loc[1], resolution=grid.resolution), grid.load())
-    )
-    lat = [loc.lat for loc in locations]
-    lon = [loc.lon for loc in locations]
-    haz_poe = pd.DataFrame( data={'lat': lat, 'lon': lon, 'level': ghaz.grid_poes})
-    return haz_poe
-
-    # fp = poe_archive_filepath(hazard_id, imt, agg, poe, vs30)
-    # if fp.exists():
-    #     print('loading hazard at poe from archive')
-    #     return pd.read_json(fp, dtype = POE_DTYPE)
-    # else:
-    # print('calculating hazard at poe')
-    # hazard = get_hazard(hazard_id, vs30, list(grid_locations(SITE_LIST)), [imt], [agg])
-    # hazard = get_hazard_v1(hazard_id, vs30, list(grid_locations(SITE_LIST)), [imt], [agg])
-    # haz_poe = get_poe_df(hazard, list(grid_locations(SITE_LIST)), imt, agg, poe, INV_TIME)
-    # save_hazard_poe(haz_poe, hazard_id, imt, agg, poe, vs30)
-
-    # haz_poe = pd.DataFrame(
-    #     columns = ['lat', 'lon', 'level'],
-    #     index = range(len(list(grid_locations(SITE_LIST)))),
-    #     dtype='float64'
-    # )
-    # ind = 0
-    # tic = time.perf_counter()
-    # loc_strs = [loc.code for loc in grid_locations(SITE_LIST)]
-    # for loc in grid_locations(SITE_LIST):
-    #     if ind%100 == 0:
-    #         toc = time.perf_counter()
-    #         print(f'time to load 100 sites {toc-tic:.1f} seconds')
-    #         tic = time.perf_counter()
-    #     res = next(query.get_hazard_curves([loc.code], [vs30], [hazard_id], [imt], [agg]))
-    #     levels = np.array([float(item.lvl) for item in res.values])
-    #     values = np.array([float(item.val) for item in res.values])
-    #     hazard = compute_hazard_at_poe(levels, values, poe, INV_TIME)
-    #     haz_poe.loc[ind, 'lat'] = loc.lat
-    #     haz_poe.loc[ind, 'lon'] = loc.lon
-    #     haz_poe.loc[ind,'level'] = hazard
-    #     ind += 1
-        
-    return haz_poe
+@lru_cache(maxsize=None)
+def grid_geometry(site_list: str) -> GridGeometry:
+    """
+    lat and lon of the grid points (rounded to the grid resolution) and their locations (a LocationArray at
+    RESOLUTION). Loading the grid and coding the locations is only done once per site list.
+    """
+
+    grid = RegionGrid[site_list]
+    locations = LocationArray.from_locations(grid.load(), RESOLUTION)
+    grid_locations = locations.resample(grid.resolution)
+    return GridGeometry(grid_locations.lat, grid_locations.lon, locations)
+
+
+def get_hazard_at_poe(hazard_id, vs30, imt, agg, poe, local=False, fetch: Optional[Callable]=None):
+    """
+    hazard at poe for every point of the grid. By default this is the GriddedHazard record from THS, if local is
+    set (or there is no record for the poe) it is calculated from the curves (see compute_gridded_hazard).
+    """
+
+    if not local:
+        ghaz = next(query.get_gridded_hazard([hazard_id], [SITE_LIST], [vs30], [imt], [agg], [poe]), None)
+        if ghaz is not None:
+            geometry = grid_geometry(SITE_LIST)
+            return pd.DataFrame( data={'lat': geometry.lat, 'lon': geometry.lon, 'level': ghaz.grid_poes})
+
+    gridded = compute_gridded_hazard(hazard_id, vs30, imt, [agg], [poe], fetch=fetch)
+    return gridded[(agg, poe)]
+
+
+def compute_gridded_hazard(
+        hazard_id: str,
+        vs30: int,
+        imt: str,
+        aggs: List[str],
+        poes: List[float],
+        inv_time: float = INV_TIME,
+        site_list: str = SITE_LIST,
+        fetch: Optional[Callable] = None,
+) -> Dict[Tuple[str, float], DataFrame]:
+    """
+    calculate hazard at poe grids locally from the hazard curves at every grid point, for all aggs and poes
+    in one vectorised interpolation. Returns a lat, lon, level DataFrame (the get_hazard_at_poe layout) for
+    each (agg, poe); grid points with no curve have a NaN level.
+
+    fetch is called as fetch(hazard_id, vs30, locations, [imt], aggs) and returns a DataFrame (in the
+    store.curves.get_hazard layout) or a HazardCube. The default is store.curves.get_hazard; use e.g.
+    functools.partial(store.cache.get_hazard, cache) to use cached curves.
+    """
+
+    fetch = fetch or get_hazard
+    geometry = grid_geometry(site_list)
+    hazard = fetch(hazard_id, vs30, geometry.locations, [imt], aggs)
+    cube = hazard if isinstance(hazard, HazardCube) else HazardCube.from_dataframe(hazard)
+
+    levels = np.full((len(geometry.locations), len(aggs), len(poes)), np.nan)  # (site, agg, poe)
+    found_aggs = [i for i, agg in enumerate(aggs) if agg in cube.agg_index]
+    if imt in cube.imt_index and found_aggs and len(cube.levels):
+        loc_idx = np.array([cube.location_index.get(code, -1) for code in geometry.locations.codes])
+        agg_idx = [cube.agg_index[aggs[i]] for i in found_aggs]
+        values = cube.values[loc_idx][:, cube.imt_index[imt], agg_idx, :]  # (site, agg, level)
+        values[loc_idx == -1] = np.nan
+        levels[:, found_aggs, :] = compute_hazard_at_poes(cube.levels, values, poes, inv_time)
+
+    gridded = {}
+    for i, agg in enumerate(aggs):
+        for j, poe in enumerate(poes):
+            gridded[(agg, poe)] = pd.DataFrame(data={'lat': geometry.lat, 'lon': geometry.lon, 'level': levels[:, i, j]})
+    return gridded
@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Callable, Dict, List, Optional
+
+log = logging.getLogger(__name__)
+
+ChunkRecord = namedtuple('ChunkRecord', 'source latency records nbytes')
+
+EventCallback = Callable[[str, Dict[str, Any]], None]
+
+
+class FetchMetrics:
+    """
+    Instrumentation for the curve loaders. Loaders that take a metrics argument record the latency, number
+    of records and bytes decoded for every chunk they fetch, every retry, and cache hits and misses. Each
+    event is also passed to the optional callback as callback(event, data) where event is one of 'chunk',
+    'retry' or 'cache'.
+
+    The same object can be passed to several loaders (and is safe to use from the fetch threads) to collect
+    metrics for a whole session; summary() reports the totals.
+    """
+
+    def __init__(self, callback: Optional[EventCallback] = None):
+        self.callback = callback
+        self.chunks: List[ChunkRecord] = []
+        self.retries = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _emit(self, event: str, data: Dict[str, Any]) -> None:
+        if self.callback:
+            self.callback(event, data)
+
+    def record_chunk(self, source: str, latency: float, records: int, nbytes: int = 0) -> None:
+        with self._lock:
+            self.chunks.append(ChunkRecord(source, latency, records, nbytes))
+        self._emit('chunk', dict(source=source, latency=latency, records=records, nbytes=nbytes))
+
+    def record_retry(self, source: str, error: BaseException, delay: float) -> None:
+        with self._lock:
+            self.retries += 1
+        self._emit('retry', dict(source=source, error=error, delay=delay))
+
+    def record_cache(self, source: str, hits: int, misses: int) -> None:
+        with self._lock:
+            self.cache_hits += hits
+            self.cache_misses += misses
+        self._emit('cache', dict(source=source, hits=hits, misses=misses))
+
+    @property
+    def records(self) -> int:
+        return sum(chunk.records for chunk in self.chunks)
+
+    @property
+    def bytes_decoded(self) -> int:
+        return sum(chunk.nbytes for chunk in self.chunks)
+
+    @property
+    def fetch_time(self) -> float:
+        """total time spent waiting on chunks (more than the wall time if chunks are fetched concurrently)"""
+
+        return sum(chunk.latency for chunk in self.chunks)
+
+    @property
+    def wall_time(self) -> float:
+        """time since the metrics were created"""
+
+        return time.perf_counter() - self._start
+
+    @property
+    def records_per_second(self) -> float:
+        wall_time = self.wall_time
+        return self.records / wall_time if wall_time > 0 else float('nan')
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        lookups = self.cache_hits + self.cache_misses
+        return self.cache_hits / lookups if lookups else float('nan')
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)) -> Dict[int, float]:
+        latencies = sorted(chunk.latency for chunk in self.chunks)
+        if not latencies:
+            return {p: float('nan') for p in percentiles}
+        return {p: latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] for p in percentiles}
+
+    def summary(self) -> str:
+        latency = self.latency_percentiles()
+        lines = [
+            f'chunks: {len(self.chunks)}, records: {self.records}, bytes decoded: {self.bytes_decoded}',
+            f'wall time: {self.wall_time:.2f} s, records/s: {self.records_per_second:.1f}',
+            'chunk latency (s): ' + ', '.join(f'p{p} {t:.3f}' for p, t in latency.items()),
+            f'retries: {self.retries}',
+            f'cache hits: {self.cache_hits}, misses: {self.cache_misses}, hit ratio: {self.cache_hit_ratio:.2f}',
+        ]
+        return '\n'.join(lines)
+
+    def print_summary(self) -> None:
+        print(self.summary())
+
+
+def log_event(event: str, data: Dict[str, Any]) -> None:
+    """a FetchMetrics callback that logs every event (at DEBUG, retries at WARNING)"""
+
+    if event == 'retry':
+        log.warning(f"{data['source']}: retrying in {data['delay']:.1f} s after {data['error']}")
+    else:
+        log.debug(f'{event}: {data}')
+
+
+class Timer:
+    """context manager measuring elapsed time, for timing chunks"""
+
+    def __enter__(self):
+        self._tic = time.perf_counter()
+        self.elapsed = 0.0
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self._tic
+        return False
@@ -0,0 +1,365 @@
+"""
+A common interface to the hazard curve backends (THS, arrow datasets, OpenQuake csv and hdf5 outputs).
+
+Every source has the get_hazard signature of the store loaders and returns the same structure: a DataFrame
+with a row per curve (lat, lon, imt, agg, level, apoe) in the requested location, imt, agg order, or a
+HazardCube with its axes in that order. Sources
+can be wrapped in a CachedSource or ConcurrentSource, combined with a SourceRouter that sends each request to
+the fastest source holding the model, and built from a config dict (see source_from_config) so that switching
+e.g. from THS to a local Parquet mirror is a config change.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Protocol, Tuple, Union, runtime_checkable
+
+import numpy as np
+import pandas as pd
+from nzshm_common.location import CodedLocation
+from numpy.typing import NDArray
+from pandas import DataFrame
+
+from nzshm_hazlab.hazard_cube import HazardCube
+from nzshm_hazlab.locations import LocationArray, location_codes
+from nzshm_hazlab.store import cache, curves, curves_v4
+from nzshm_hazlab.store.metrics import FetchMetrics
+
+RESOLUTION = 0.001
+COLUMNS = ['lat', 'lon', 'imt', 'agg', 'level', 'apoe']
+
+CalcMetadata = namedtuple('CalcMetadata', 'locations levels imts aggs weights')
+SourceCapabilities = namedtuple('SourceCapabilities', 'batch_size pushdown realizations local')
+SourceCapabilities.__doc__ = """
+what a source can do: the number of locations it fetches per request (None if unbounded), whether filters
+are pushed down to the storage (only the requested curves are read), whether it can return individual
+realizations and whether it reads local files (no network round trips)
+"""
+
+
+@runtime_checkable
+class HazardSource(Protocol):
+    capabilities: SourceCapabilities
+
+    def available(self, hazard_id: str, vs30: int) -> bool:
+        """True if the source holds curves for the hazard model and vs30"""
+        ...
+
+    def get_hazard(
+        self,
+        hazard_id: str,
+        vs30: int,
+        locs: List[CodedLocation],
+        imts: List[str],
+        aggs: List[str],
+        as_cube: bool = False,
+    ) -> Union[DataFrame, HazardCube]:
+        ...
+
+
+def select_curves(hazard_curves: DataFrame, locs: List[CodedLocation], imts: List[str], aggs: List[str]) -> DataFrame:
+    """the requested curves in location, imt, agg order (the store.curves.get_hazard layout)"""
+
+    codes = location_codes(locs, RESOLUTION)
+    loc_pos = {code: i for i, code in reversed(list(enumerate(codes)))}
+    imt_pos = {imt: i for i, imt in enumerate(imts)}
+    agg_pos = {agg: i for i, agg in enumerate(aggs)}
+
+    loc_idx = (hazard_curves['lat'] + '~' + hazard_curves['lon']).map(loc_pos).to_numpy(dtype='float64')
+    imt_idx = hazard_curves['imt'].map(imt_pos).to_numpy(dtype='float64')
+    agg_idx = hazard_curves['agg'].map(agg_pos).to_numpy(dtype='float64')
+    keep = np.flatnonzero(~(np.isnan(loc_idx) | np.isnan(imt_idx) | np.isnan(agg_idx)))
+    order = keep[np.lexsort((agg_idx[keep], imt_idx[keep], loc_idx[keep]))]
+    return hazard_curves.iloc[order][COLUMNS].reset_index(drop=True)
+
+
+def _as_output(hazard_curves: DataFrame, as_cube: bool) -> Union[DataFrame, HazardCube]:
+    return HazardCube.from_dataframe(hazard_curves) if as_cube else hazard_curves
+
+
+def _run_available(source, hazard_id: str, vs30: int) -> bool:
+    """whether an OpenQuake output source has a run for hazard_id at vs30"""
+    return hazard_id in source.files and source.vs30s.get(hazard_id) == vs30
+
+
+def _check_run(source, hazard_id: str, vs30: int) -> None:
+    if not _run_available(source, hazard_id, vs30):
+        raise ValueError(f'{type(source).__name__} has no run for {hazard_id} at vs30 {vs30}')
+
+
+class THSSource:
+    """aggregate curves from toshi-hazard-store (DynamoDB), see store.curves.get_hazard"""
+
+    def __init__(self, chunk_size: int = 100, max_workers: Optional[int] = None, metrics: Optional[FetchMetrics] = None):
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.metrics = metrics
+        self.capabilities = SourceCapabilities(
+            batch_size=chunk_size if max_workers else None, pushdown=True, realizations=False, local=False
+        )
+
+    def available(self, hazard_id: str, vs30: int) -> bool:
+        return True
+
+    def get_hazard(self, hazard_id, vs30, locs, imts, aggs, as_cube=False):
+        return curves.get_hazard(
+            hazard_id,
+            vs30,
+            locs,
+            imts,
+            aggs,
+            chunk_size=self.chunk_size,
+            max_workers=self.max_workers,
+            as_cube=as_cube,
+            metrics=self.metrics,
+        )
+
+
+class ArrowSource:
+    """aggregate curves from a hive partitioned Parquet dataset (local or S3), see store.curves_v4"""
+
+    def __init__(self, fs_specs: Dict[str, Any], metrics: Optional[FetchMetrics] = None):
+        self.fs_specs = fs_specs
+        self.metrics = metrics
+        self.capabilities = SourceCapabilities(
+            batch_size=None, pushdown=True, realizations=False, local=fs_specs['arrow_fs'] is curves_v4.ArrowFS.LOCAL
+        )
+
+    def available(self, hazard_id: str, vs30: int) -> bool:
+        partition_values = {'hazard_model_id': [hazard_id], 'vs30': [vs30]}
+        return bool(curves_v4.DATASETS.fragments(self.fs_specs, partition_values))
+
+    def get_hazard(self, hazard_id, vs30, locs, imts, aggs, as_cube=False):
+        hazard_curves = curves_v4.get_hazard(hazard_id, vs30, locs, imts, aggs, self.fs_specs, metrics=self.metrics)
+        # the scan returns curves in file order
+        return _as_output(select_curves(hazard_curves, locs, imts, aggs), as_cube)
+
+
+class OQCSVSource:
+    """
+    curves from OpenQuake csv outputs. files maps each hazard_id to a file pattern with IMT in place of the
+    imt (see store.curves.get_hazard_from_oqcsv) and vs30s to the vs30 of that run (each OpenQuake run is for a
+    single vs30); the curves are only available for that vs30.
+    """
+
+    def __init__(
+        self,
+        files: Dict[str, str],
+        vs30s: Dict[str, int],
+        max_workers: Optional[int] = None,
+        metrics: Optional[FetchMetrics] = None,
+    ):
+        self.files = files
+        self.vs30s = vs30s
+        self.max_workers = max_workers
+        self.metrics = metrics
+        self.capabilities = SourceCapabilities(batch_size=None, pushdown=False, realizations=False, local=True)
+
+    def available(self, hazard_id: str, vs30: int) -> bool:
+        return _run_available(self, hazard_id, vs30)
+
+    def get_hazard(self, hazard_id, vs30, locs, imts, aggs, as_cube=False):
+        _check_run(self, hazard_id, vs30)
+        hazard_curves = curves.get_hazard_from_oqcsv(
+            self.files[hazard_id], imts, max_workers=self.max_workers, metrics=self.metrics
+        )
+        return _as_output(select_curves(hazard_curves, locs, imts, aggs), as_cube)
+
+
+class OQHDF5Source:
+    """
+    curves from OpenQuake hdf5 calculation files (requires openquake and h5py). files maps each hazard_id to
+    an hdf5 file and vs30s to the vs30 of that run (as for OQCSVSource). The aggs are 'mean' and the
+    quantiles (e.g. '0.1'). Individual realizations are available with get_realizations.
+    """
+
+    def __init__(self, files: Dict[str, Union[str, Path]], vs30s: Dict[str, int]):
+        self.files = files
+        self.vs30s = vs30s
+        self.capabilities = SourceCapabilities(batch_size=None, pushdown=False, realizations=True, local=True)
+        self._metadata: Dict[str, CalcMetadata] = {}
+
+    def available(self, hazard_id: str, vs30: int) -> bool:
+        return _run_available(self, hazard_id, vs30)
+
+    def metadata(self, hazard_id: str) -> CalcMetadata:
+        """location codes, levels, imts, aggs and realization weights of a calculation"""
+
+        if hazard_id not in self._metadata:
+            import h5py
+            from openquake.commonlib import datastore
+
+            dstore = datastore.read(str(self.files[hazard_id]))
+            oqparam = vars(dstore['oqparam'])
+            sitecol = dstore.read_df('sitecol')
+            dstore.close()
+
+            imtls = oqparam['hazard_imtls']
+            imts = list(imtls.keys())
+            levels = np.array(imtls[imts[0]], dtype='float64')
+            if any(len(imtls[imt]) != len(levels) or not np.allclose(imtls[imt], levels) for imt in imts):
+                raise ValueError(f'all imts of {hazard_id} must have the same levels')
+            aggs = ['mean'] + [str(q) for q in oqparam['quantiles']]
+            codes = list(LocationArray(sitecol['lat'].to_numpy(), sitecol['lon'].to_numpy(), RESOLUTION).codes)
+            with h5py.File(self.files[hazard_id], 'r') as hf:
+                weights = hf['weights'][:]
+            self._metadata[hazard_id] = CalcMetadata(codes, levels, imts, aggs, weights)
+        return self._metadata[hazard_id]
+
+    def _read_cube(self, hazard_id: str, dataset: str, aggs: List[str]) -> HazardCube:
+        import h5py
+
+        metadata = self.metadata(hazard_id)
+        with h5py.File(self.files[hazard_id], 'r') as hf:
+            # stored as [site, stat or rlz, imt, level]
+            values = np.transpose(hf[dataset][:], (0, 2, 1, 3))
+        return HazardCube(values, metadata.levels, metadata.locations, metadata.imts, aggs)
+
+    def get_hazard(self, hazard_id, vs30, locs, imts, aggs, as_cube=False):
+        _check_run(self, hazard_id, vs30)
+        cube = self._read_cube(hazard_id, 'hcurves-stats', self.metadata(hazard_id).aggs)
+        cube = cube.sel(locs, imts, aggs)
+        return cube if as_cube else cube.to_dataframe()
+
+    def get_realizations(
+        self, hazard_id: str, vs30: int, locs: List[CodedLocation], imts: List[str]
+    ) -> Tuple[HazardCube, NDArray]:
+        """the realization curves (the aggs axis of the cube is the realization index) and their weights"""
+
+        _check_run(self, hazard_id, vs30)
+        weights = self.metadata(hazard_id).weights
+        rlzs = [str(i) for i in range(len(weights))]
+        cube = self._read_cube(hazard_id, 'hcurves-rlzs', rlzs)
+        return cube.sel(locs, imts), weights
+
+
+class CachedSource:
+    """
+    a source behind a persistent local CurveCache: only curves missing from the cache are requested. The source
+    is local only if the wrapped source is (a cold cache in front of a remote source still goes to the network).
+    """
+
+    def __init__(self, source: HazardSource, curve_cache: cache.CurveCache, metrics: Optional[FetchMetrics] = None):
+        self.source = source
+        self.cache = curve_cache
+        self.metrics = metrics
+        self.capabilities = source.capabilities._replace(realizations=False)
+
+    def available(self, hazard_id: str, vs30: int) -> bool:
+        return self.source.available(hazard_id, vs30)
+
+    def _fetch(self, hazard_id, vs30, locs, imts, aggs, metrics=None):
+        return self.source.get_hazard(hazard_id, vs30, locs, imts, aggs)
+
+    def get_hazard(self, hazard_id, vs30, locs, imts, aggs, as_cube=False):
+        return cache.get_hazard(
+            self.cache, hazard_id, vs30, locs, imts, aggs, fetch=self._fetch, as_cube=as_cube, metrics=self.metrics
+        )
+
+
+class ConcurrentSource:
+    """
+    a source that splits the locations of each request into chunks of chunk_size fetched concurrently, for
+    backends with no concurrency of their own
+    """
+
+    def __init__(self, source: HazardSource, chunk_size: int = 100, max_workers: int = 8):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.capabilities = source.capabilities._replace(batch_size=chunk_size, realizations=False)
+
+    def available(self, hazard_id: str, vs30: int) -> bool:
+        return self.source.available(hazard_id, vs30)
+
+    def get_hazard(self, hazard_id, vs30, locs, imts, aggs, as_cube=False):
+        loc_chunks = [locs[i : i + self.chunk_size] for i in range(0, len(locs), self.chunk_size)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            frames = list(
+                executor.map(lambda loc_chunk: self.source.get_hazard(hazard_id, vs30, loc_chunk, imts, aggs), loc_chunks)
+            )
+        if frames:
+            hazard_curves = pd.concat(frames, ignore_index=True)
+        else:
+            hazard_curves = pd.DataFrame({c: pd.Series(dtype=object) for c in COLUMNS})
+        return _as_output(hazard_curves, as_cube)
+
+
+def _preference(source: HazardSource) -> Tuple[bool, bool, bool]:
+    capabilities = source.capabilities
+    return (not capabilities.local, not isinstance(source, CachedSource), not capabilities.pushdown)
+
+
+class SourceRouter:
+    """
+    sends each request to the fastest source that holds the hazard model: local sources, then remote sources
+    behind a cache, then other remote sources, and sources that push filters down to storage before those that
+    read whole outputs (the order given breaks ties)
+    """
+
+    def __init__(self, sources: List[HazardSource]):
+        self.sources = sorted(sources, key=_preference)
+        self.capabilities = SourceCapabilities(
+            batch_size=None,
+            pushdown=any(source.capabilities.pushdown for source in sources),
+            realizations=any(source.capabilities.realizations for source in sources),
+            local=any(source.capabilities.local for source in sources),
+        )
+
+    def source_for(self, hazard_id: str, vs30: int, realizations: bool = False) -> HazardSource:
+        for source in self.sources:
+            if (source.capabilities.realizations or not realizations) and source.available(hazard_id, vs30):
+                return source
+        raise KeyError(f'no source has curves for hazard model {hazard_id} and vs30 {vs30}')
+
+    def available(self, hazard_id: str, vs30: int) -> bool:
+        return any(source.available(hazard_id, vs30) for source in self.sources)
+
+    def get_hazard(self, hazard_id, vs30, locs, imts, aggs, as_cube=False):
+        return self.source_for(hazard_id, vs30).get_hazard(hazard_id, vs30, locs, imts, aggs, as_cube=as_cube)
+
+    def get_realizations(self, hazard_id, vs30, locs, imts):
+        return self.source_for(hazard_id, vs30, realizations=True).get_realizations(hazard_id, vs30, locs, imts)
+
+
+def source_from_config(config: Dict[str, Any], metrics: Optional[FetchMetrics] = None) -> HazardSource:
+    """
+    build a source from a config dict (e.g. a table loaded from a toml file):
+
+        {'type': 'ths', 'chunk_size': 100, 'max_workers': 8}
+        {'type': 'arrow', 'arrow_fs': 'LOCAL', 'arrow_dir': '/data/aggs'}
+        {'type': 'arrow', 'arrow_fs': 'AWS', 'aws_region': ..., 's3_bucket': ..., 'cache_dir': ...}
+        {'type': 'oqcsv', 'files': {'my_model': 'oq_output/hazard_curve-mean-IMT_1.csv'}, 'vs30s': {'my_model': 400}}
+        {'type': 'oqhdf5', 'files': {'my_model': 'oq_output/calc_1.hdf5'}, 'vs30s': {'my_model': 400}}
+        {'type': 'router', 'sources': [<source config>, ...]}
+
+    Any source config may also have 'cache': {'cache_dir': ..., 'max_bytes': ...} to put a CurveCache in front
+    of it, and 'concurrency': {'chunk_size': ..., 'max_workers': ...} to fetch chunks of locations concurrently.
+    """
+
+    config = dict(config)
+    source_type = config.pop('type')
+    cache_config = config.pop('cache', None)
+    concurrency_config = config.pop('concurrency', None)
+
+    source: HazardSource
+    if source_type == 'ths':
+        source = THSSource(metrics=metrics, **config)
+    elif source_type == 'arrow':
+        if isinstance(config['arrow_fs'], str):
+            config['arrow_fs'] = curves_v4.ArrowFS[config['arrow_fs'].upper()]
+        source = ArrowSource(config, metrics=metrics)
+    elif source_type == 'oqcsv':
+        source = OQCSVSource(metrics=metrics, **config)
+    elif source_type == 'oqhdf5':
+        source = OQHDF5Source(**config)
+    elif source_type == 'router':
+        source = SourceRouter([source_from_config(source_config, metrics) for source_config in config['sources']])
+    else:
+        raise ValueError(f'unknown hazard source type {source_type}')
+
+    if concurrency_config:
+        source = ConcurrentSource(source, **concurrency_config)
+    if cache_config:
+        source = CachedSource(source, cache.CurveCache(**cache_config), metrics=metrics)
+    return source
@@ -2,7 +2,7 @@ import numpy as np
 import time
 
 from nzshm_hazlab.hazard_data import HazardData
-from nzshm_hazlab.data_functions import weighted_quantile
+from nzshm_hazlab.data_functions import aggregate_realizations
 
 import runzi.automation.scaling.hazard_output_helper
 from runzi.automation.scaling.toshi_api import ToshiApi
@@ -28,19 +28,9 @@ imt = 'PGA'
 def aggrigate_realizations_1ID(hazard_id):
 
     hd = HazardData(hazard_id)
-    for irlz in range(hd.nrlzs):
-        if irlz == 0:
-            levels = np.array(hd.values(location=location,imt=imt,realization=irlz).lvls)
-            values = np.array(hd.values(location=location,imt=imt,realization=irlz).vals)
-        else:
-            values = np.vstack((values,np.array(hd.values(location=location,imt=imt,realization=irlz).vals)))
-
-    weights = np.array(list(hd.rlz_lt['weight'].values()))
-    median = np.array([])
-    for i,level in enumerate(levels):
-        # quantiles = weighted_quantile(values[:,i],[0.5],sample_weight=weights)
-        quantiles = weighted_quantile(values[:,i],'mean',sample_weight=weights)
-        median = np.append(median,np.array(quantiles))
+    realizations = hd.rlz_matrix(location, imt)
+    # median = aggregate_realizations(realizations.vals, realizations.weights, ['0.5'])[0]
+    median = aggregate_realizations(realizations.vals, realizations.weights, ['mean'])[0]
 
     return median
 
@@ -48,27 +38,20 @@ def aggrigate_realizations_1ID(hazard_id):
 def aggrigate_realizations_multID(gt_id):
 
     hazard_ids = get_hazard_ids(gt_id)
-    weights = np.array([])
-    for i,hazard_id in enumerate(hazard_ids):
-        hd = HazardData(hazard_id)
-        for irlz in range(hd.nrlzs):
-            if irlz == 0 and i == 0:
-                levels = np.array(hd.values(location=location,imt=imt,realization=irlz).lvls)
-                values = np.array(hd.values(location=location,imt=imt,realization=irlz).vals)
-            else:
-                values = np.vstack((values,np.array(hd.values(location=location,imt=imt,realization=irlz).vals)))
-
-        weights = np.append(weights,np.array(list(hd.rlz_lt['weight'].values())))
-        
-    # breakpoint()
+    values = []
+    weights = []
+    for hazard_id in hazard_ids:
+        realizations = HazardData(hazard_id).rlz_matrix(location, imt)
+        values.append(realizations.vals)
+        weights.append(realizations.weights)
+
+    values = np.vstack(values)
+    weights = np.concatenate(weights)
     weights = weights/np.sum(weights)
 
     tic = time.perf_counter()
-    median = np.array([])
-    for i,level in enumerate(levels):
-        # quantiles = weighted_quantile(values[:,i],[0.5],sample_weight=weights)
-        quantiles = weighted_quantile(values[:,i],'mean',sample_weight=weights)
-        median = np.append(median,np.array(quantiles))
+    # median = aggregate_realizations(values, weights, ['0.5'])[0]
+    median = aggregate_realizations(values, weights, ['mean'])[0]
     toc = time.perf_counter()
     print(f'seconds to calculate median {toc-tic}')
 
@@ -3,13 +3,11 @@ from pathlib import Path
 from collections import namedtuple
 
 import pandas as pd
-import numpy as np
 
 from nzshm_common.location.code_location import CodedLocation
 from nzshm_hazlab.locations import get_locations
 from nzshm_hazlab.store.curves import get_hazard
-from nzshm_hazlab.data_functions import compute_hazard_at_poe
-from nzshm_hazlab.base_functions import period_from_imt, imt_from_period
+from nzshm_hazlab.data_functions import compute_uhs, uhs_to_dataframe
 
 
 location_list = ["/home/chrisdc/NSHM/oqruns/RUNZI-MAIN-HAZARD/WeakMotionSiteLocs_SHORT.csv"]
@@ -20,7 +18,6 @@ imts = ['PGA']
 aggs = ["mean", "0.005", "0.01", "0.025", "0.05", "0.1", "0.2", "0.3", "0.4", "0.5", "0.6", "0.7", "0.8", "0.9", "0.95", "0.975", "0.99", "0.995"]
 poes = [0.02, 0.1]
 INV_TIME = 50
-DTYPE = {'lat':'str', 'lon':'str', 'poe': 'str', 'agg':'str', 'imt':'str', 'acc':'str'}
 
 n_records = len(locations) * len(aggs) * len(imts)
 
@@ -35,42 +32,16 @@ for vs30 in vs30s:
 
 # calculate UHS
 uhs = {}
-index = range(len(locations) * len(aggs) * len(poes))
 for vs30 in vs30s:
-    hazard_curves[vs30]['location_code'] = hazard_curves[vs30]['lat'] + '~' + hazard_curves[vs30]['lon']
-    uhs[vs30] = pd.DataFrame({c: pd.Series(dtype=t) for c, t in DTYPE.items()}, index=index)
-    idx = 0
-    for agg in aggs:
-        for loc in locations:
-            ind = (hazard_curves[vs30]['location_code'] == loc.code) & (hazard_curves[vs30]['agg'] == agg)
-            lat, lon = loc.code.split('~')
-            levels = hazard_curves[vs30][ind]['level'].iloc[0]
-            imt = list(hazard_curves[vs30][ind]['imt'])
-            apoe = np.empty((len(imt), len(hazard_curves[vs30][ind]['apoe'].iloc[0])))
-            for i in range(len(imt)):
-                apoe[i,:] = hazard_curves[vs30][ind]['apoe'].iloc[i]
-            
-            period = np.array([period_from_imt(im) for im in imt])
-            sorter = np.argsort(period)
-            apoe = apoe[sorter, :]
-            period = period[sorter]
-            imt = [imt_from_period(p) for p in period]
-            for poe in poes:
-                uhs[vs30].loc[idx, 'lat'] = lat
-                uhs[vs30].loc[idx, 'lon'] = lon
-                uhs[vs30].loc[idx, 'poe'] = poe
-                uhs[vs30].loc[idx, 'agg'] = agg
-                uhs[vs30].loc[idx, 'imt'] = np.array(imt)
-                uhs[vs30].loc[idx, 'acc'] = compute_hazard_at_poe(levels, apoe, poe, INV_TIME)
-                idx += 1
+    spectra = compute_uhs(hazard_curves[vs30], poes, INV_TIME, aggs=aggs, imts=imts)
+    uhs[vs30] = uhs_to_dataframe(spectra)
 
 for vs30 in vs30s:
-    uhs[vs30][imts] = pd.DataFrame(uhs[vs30].acc.tolist(), index=uhs[vs30].index)
-    uhs[vs30].drop(labels = ['imt', 'acc'], axis=1, inplace=True)
     uhs[vs30].sort_values(by=['lat', 'lon','poe','agg'], inplace=True)
 
+    levels = hazard_curves[vs30]['level'].iloc[0]
     hazard_curves[vs30][levels] = pd.DataFrame(hazard_curves[vs30].apoe.tolist(), index=hazard_curves[vs30].index)
-    hazard_curves[vs30].drop(labels = ['level', 'apoe', 'location_code'], axis=1, inplace=True)
+    hazard_curves[vs30].drop(labels = ['level', 'apoe'], axis=1, inplace=True)
 
 # add to csvs
 for vs30 in vs30s:
@@ -5,7 +5,6 @@ from math import copysign
 
 import pandas as pd
 import matplotlib.pyplot as plt
-import numpy as np
 
 import toshi_hazard_store
 from nzshm_common.location.location import location_by_id, LOCATION_LISTS
@@ -14,6 +13,8 @@ from nzshm_common.grids.region_grid import load_grid
 
 from nzshm_hazlab.store.curves import get_hazard
 from nzshm_hazlab.disagg_data_functions import prob_to_rate
+from nzshm_hazlab.data_functions import compute_poe_at_intensities
+from nzshm_hazlab.hazard_cube import HazardCube
 from nzshm_hazlab.locations import get_locations
 
 PLOT_WIDTH = 12
@@ -26,20 +27,10 @@ XLABEL_FONTSIZE = 12
 def get_rate_at_imtl(hazard_data, locations, imt, imtl) -> pd.DataFrame:
     location_strs = [loc.code for loc in locations]
     col_name = f'{imt}_{imtl}'
-    hazard_at_imtl = pd.DataFrame(index=location_strs, columns=[col_name])
-    for loc in location_strs:
-        lat, lon = loc.split('~')
-        col = (
-            (hazard_data['lat'] == lat) &
-            (hazard_data['lon'] == lon) &
-            (hazard_data['imt'] == imt) &
-            (hazard_data['agg'] == 'mean')
-        )
-        levels = hazard_data.loc[col, 'level'].iloc[0]
-        values = hazard_data.loc[col, 'apoe'].iloc[0]
-        hazard_at_imtl.loc[loc, col_name] = prob_to_rate(values[np.where(levels == imtl)][0])
-
-    return hazard_at_imtl
+    cube = HazardCube.from_dataframe(hazard_data)
+    values = cube[location_strs, imt, 'mean']
+    rate = prob_to_rate(compute_poe_at_intensities(cube.levels, values, [imtl])[:, 0])
+    return pd.DataFrame({col_name: rate}, index=location_strs)
 
 def load_data(hazard_model_groups, vs30, locations, imt) -> Dict[str,pd.DataFrame]:
 
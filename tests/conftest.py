@@ -0,0 +1,157 @@
+import sys
+from types import ModuleType, SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nzshm_hazlab import hazard_data
+from nzshm_hazlab.data_functions import aggregate_realizations
+from nzshm_hazlab.store import curves_v4
+from nzshm_hazlab.store.benchmark import synthetic_curves, synthetic_locations
+
+
+class FakeHDF5File:
+    """the datasets of an OpenQuake calculation file that store.sources.OQHDF5Source reads (h5py.File)"""
+
+    def __init__(self, calc):
+        self.calc = calc
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __getitem__(self, name):
+        return {'weights': self.calc.weights, 'hcurves-rlzs': self.calc.rlzs, 'hcurves-stats': self.calc.stats}[name]
+
+
+class FakeDataStore:
+    """an OpenQuake datastore (openquake.commonlib.datastore.read) with the oqparam and sitecol of a calculation"""
+
+    def __init__(self, calc):
+        self.calc = calc
+
+    def __getitem__(self, name):
+        assert name == 'oqparam'
+        imtls = {imt: list(self.calc.levels) for imt in self.calc.imts}
+        return SimpleNamespace(hazard_imtls=imtls, quantiles=[0.1, 0.9])
+
+    def read_df(self, name):
+        assert name == 'sitecol'
+        # OpenQuake site coordinates are not rounded
+        return pd.DataFrame({'lat': self.calc.locations.lat + 1e-7, 'lon': self.calc.locations.lon - 1e-7})
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def oq_calc(tmp_path, monkeypatch):
+    """
+    a synthetic OpenQuake hdf5 calculation (5 sites, 2 imts, 3 realizations and the imtls levels) read through
+    fake h5py and openquake modules (neither is needed to run the tests)
+    """
+
+    locations = synthetic_locations(5)
+    imts = ['PGA', 'SA(1.0)']
+    weights = np.array([0.5, 0.3, 0.2])
+    levels = curves_v4.imtls
+    # stored as [site, rlz, imt, level]
+    shape = (len(locations), len(weights), len(imts), len(levels))
+    rlzs = synthetic_curves(int(np.prod(shape[:3])), levels).reshape(shape)
+    aggs = ['mean', '0.1', '0.9']
+    stats = np.transpose(aggregate_realizations(np.transpose(rlzs, (0, 2, 1, 3)), weights, aggs), (0, 2, 1, 3))
+    path = tmp_path / 'calc_1.hdf5'
+    path.touch()
+    calc = SimpleNamespace(
+        path=path, locations=locations, imts=imts, levels=levels, weights=weights, aggs=aggs, rlzs=rlzs, stats=stats
+    )
+
+    h5py = ModuleType('h5py')
+    h5py.File = lambda filepath, mode: FakeHDF5File(calc)
+    datastore = ModuleType('openquake.commonlib.datastore')
+    datastore.read = lambda filepath: FakeDataStore(calc)
+    commonlib = ModuleType('openquake.commonlib')
+    commonlib.datastore = datastore
+    openquake = ModuleType('openquake')
+    openquake.commonlib = commonlib
+    for name, module in [
+        ('h5py', h5py),
+        ('openquake', openquake),
+        ('openquake.commonlib', commonlib),
+        ('openquake.commonlib.datastore', datastore),
+    ]:
+        monkeypatch.setitem(sys.modules, name, module)
+    return calc
+
+
+class FakeQuery:
+    """
+    toshi_hazard_store v2 queries (as used by HazardData) returning synthetic curves for 3 locations, 2 imts,
+    4 realizations and 2 aggs. Locations are returned normalised to 3 dp, the metadata imts, aggs and locs are
+    sets (as THS returns them) and every query is recorded.
+    """
+
+    levels = list(np.geomspace(1e-4, 5.0, 20))
+    imts = ['PGA', 'SA(1.0)']
+    aggs = ['mean', '0.5']
+    nrlz = 4
+    locations = ['-41.300~174.780', '-43.530~172.630', '-36.870~174.770']
+
+    def __init__(self):
+        self.queries = []
+
+    def curve(self, location, imt, realization):
+        seed = sum(map(ord, f'{location}{imt}{realization}'))
+        return list(np.exp(-np.array(self.levels) / np.random.default_rng(seed).uniform(0.1, 1.0)))
+
+    @staticmethod
+    def normalised(code):
+        lat, lon = map(float, code.split('~'))
+        return f'{lat:.3f}~{lon:.3f}'
+
+    def get_hazard_rlz_curves_v2(self, hazard_id, vs30s, locs, rlzs):
+        self.queries.append(('rlz', list(locs)))
+        for loc in locs:
+            for rlz in range(self.nrlz):
+                values = [
+                    SimpleNamespace(imt=imt, lvls=self.levels, vals=self.curve(loc, imt, rlz)) for imt in self.imts
+                ]
+                yield SimpleNamespace(loc=self.normalised(loc), rlz=str(rlz), values=values)
+
+    def get_hazard_stats_curves_v2(self, hazard_id, vs30s, locs, aggs):
+        self.queries.append(('agg', list(locs)))
+        for loc in locs:
+            for agg in self.aggs:
+                values = [
+                    SimpleNamespace(imt=imt, lvls=self.levels, vals=self.curve(loc, imt, agg)) for imt in self.imts
+                ]
+                yield SimpleNamespace(loc=self.normalised(loc), agg=agg, values=values)
+
+    def get_hazard_metadata(self, hazard_ids):
+        self.queries.append(('metadata', hazard_ids))
+        weights = {i: 1 / self.nrlz for i in range(self.nrlz)}
+        rlz_lt = {'weight': weights, 'gsims': {i: ['a', 'b'] for i in range(self.nrlz)}}
+        yield SimpleNamespace(
+            imts=set(self.imts),
+            vs30=400,
+            aggs=set(self.aggs),
+            gsim_lt=str({'branch': {0: ('Bradley', 1.0)}, 'weight': {0: 1.0}}),
+            haz_sol_id=hazard_ids[0],
+            hazsol_vs30_rk='rk',
+            locs=set(self.locations),
+            rlz_lt=str(rlz_lt),
+            src_lt=str({'branch': {0: 'A'}, 'weight': {0: 1.0}}),
+        )
+
+
+@pytest.fixture
+def fake_query(monkeypatch):
+    """the toshi_hazard_store queries of HazardData replaced with a FakeQuery"""
+
+    fake = FakeQuery()
+    for name in ('get_hazard_rlz_curves_v2', 'get_hazard_stats_curves_v2', 'get_hazard_metadata'):
+        monkeypatch.setattr(hazard_data.query, name, getattr(fake, name))
+    return fake
@@ -0,0 +1,104 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from nzshm_hazlab import aggregation
+from nzshm_hazlab.data_functions import aggregate_realizations
+from nzshm_hazlab.hazard_data import HazardData
+from nzshm_hazlab.store import curves_v4, sources
+from nzshm_hazlab.store.benchmark import synthetic_curves, synthetic_locations
+from nzshm_hazlab.store.columnar import matrix_to_list_array
+
+AGGS = ['mean', 'std', 'cov', '0.1', '0.5', '0.9']
+VS30 = 400
+
+
+@pytest.fixture
+def hdf5_reader(oq_calc):
+    source = sources.OQHDF5Source({'calc': oq_calc.path}, {'calc': VS30})
+    # stored as [site, rlz, imt, level]
+    return aggregation.HDF5Realizations(source, 'calc'), np.transpose(oq_calc.rlzs, (0, 2, 1, 3))
+
+
+@pytest.fixture
+def hazard_data_reader(fake_query):
+    # the locations and imts are in the (arbitrary) order of the metadata sets
+    reader = aggregation.HazardDataRealizations(HazardData('H'))
+    values = [
+        [[fake_query.curve(loc, imt, rlz) for rlz in range(fake_query.nrlz)] for imt in reader.imts]
+        for loc in reader.locations
+    ]
+    return reader, np.array(values)
+
+
+@pytest.fixture
+def arrow_reader(tmp_path):
+    locs = synthetic_locations(7)
+    imts = ['PGA', 'SA(0.5)']
+    weights = {0: 0.2, 1: 0.5, 2: 0.3}
+    values = synthetic_curves(len(locs) * len(imts) * len(weights)).reshape(len(locs), len(imts), len(weights), -1)
+    loc_idx, imt_idx, rlz_idx = [index.ravel() for index in np.indices(values.shape[:3])]
+    # rows are written in reverse so that the reader has to put them in order
+    table = pa.table(
+        {
+            'nloc_001': pa.array(locs.codes[loc_idx][::-1], pa.string()),
+            'imt': pa.array(np.array(imts)[imt_idx][::-1], pa.string()),
+            'rlz': pa.array(rlz_idx[::-1]),
+            'values': matrix_to_list_array(values.reshape(-1, values.shape[-1])[::-1]),
+        }
+    )
+    partition = tmp_path / 'rlzs' / f'vs30={VS30}'
+    partition.mkdir(parents=True)
+    pq.write_table(table, partition / 'part-0.parquet')
+    fs_specs = {'arrow_fs': curves_v4.ArrowFS.LOCAL, 'arrow_dir': str(tmp_path / 'rlzs')}
+    curves_v4.DATASETS.clear()
+    yield aggregation.ArrowRealizations(fs_specs, locs, imts, weights, {'vs30': [VS30]}), values
+    curves_v4.DATASETS.clear()
+
+
+@pytest.mark.parametrize('reader', ['hdf5_reader', 'hazard_data_reader', 'arrow_reader'])
+def test_iter_aggregates_over_each_reader(request, reader):
+    reader, values = request.getfixturevalue(reader)
+    expected = aggregate_realizations(values, reader.weights, AGGS)
+
+    chunks = list(aggregation.iter_aggregates(reader, AGGS, max_workers=1, chunk_sites=2))
+
+    nsites = len(reader.locations)
+    assert [(start, stop) for start, stop, _ in chunks] == [(i, min(i + 2, nsites)) for i in range(0, nsites, 2)]
+    np.testing.assert_allclose(np.concatenate([aggregates for _, _, aggregates in chunks]), expected)
+
+
+def test_aggregate_on_a_process_pool(hdf5_reader):
+    reader, values = hdf5_reader
+    cube = aggregation.aggregate(reader, AGGS, max_workers=2, chunk_sites=1)
+
+    assert (cube.locations, cube.imts, cube.aggs) == (reader.locations, reader.imts, AGGS)
+    np.testing.assert_allclose(cube.values, aggregate_realizations(values, reader.weights, AGGS))
+
+
+def test_sites_per_chunk(hdf5_reader):
+    reader, _ = hdf5_reader
+    site_bytes = len(reader.imts) * len(reader.weights) * len(reader.levels) * 8 * aggregation.WORKING_COPIES
+
+    assert aggregation.sites_per_chunk(reader, site_bytes * 2 * 3, workers=2) == 2
+    assert aggregation.sites_per_chunk(reader, 0, workers=2) == 1
+    assert aggregation.sites_per_chunk(reader, 10**12, workers=2) == len(reader.locations)
+
+
+def test_aggregate_to_dataset(tmp_path, hdf5_reader, oq_calc):
+    reader, values = hdf5_reader
+    aggs = ['mean', '0.9']
+    root = tmp_path / 'aggs'
+    fs_specs = aggregation.aggregate_to_dataset(reader, aggs, root, 'AGG', VS30, max_workers=1, chunk_sites=2)
+
+    cube = sources.ArrowSource(fs_specs).get_hazard('AGG', VS30, oq_calc.locations, reader.imts, aggs, as_cube=True)
+    assert cube.locations == reader.locations
+    np.testing.assert_allclose(cube.values, aggregate_realizations(values, reader.weights, aggs))
+
+
+def test_aggregate_to_dataset_requires_the_imtls_levels(tmp_path, hazard_data_reader):
+    reader, _ = hazard_data_reader
+    with pytest.raises(ValueError):
+        aggregation.aggregate_to_dataset(reader, ['mean'], tmp_path / 'aggs', 'AGG', VS30, max_workers=1)
+    assert not any(tmp_path.rglob('*.parquet'))
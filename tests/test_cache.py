@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from nzshm_hazlab.store import cache, curves
+from nzshm_hazlab.store.benchmark import HAZARD_ID, VS30, FakeTHS, fake_ths, synthetic_locations
+
+IMTS = ['PGA', 'SA(1.0)']
+AGGS = ['mean', '0.9']
+
+
+@pytest.fixture
+def fetch():
+    """store.curves.get_hazard against a FakeTHS, recording the locations of every fetch"""
+
+    fetched = []
+
+    def fetch(hazard_id, vs30, locs, imts, aggs):
+        fetched.append(list(locs))
+        return curves.get_hazard(hazard_id, vs30, locs, imts, aggs)
+
+    with fake_ths(FakeTHS()):
+        yield fetch, fetched
+
+
+def assert_same_curves(hazard_curves, expected):
+    assert list(hazard_curves['lat'] + '~' + hazard_curves['lon']) == list(expected['lat'] + '~' + expected['lon'])
+    assert list(hazard_curves['imt']) == list(expected['imt'])
+    assert list(hazard_curves['agg']) == list(expected['agg'])
+    np.testing.assert_allclose(np.vstack(hazard_curves['apoe']), np.vstack(expected['apoe']))
+    np.testing.assert_allclose(np.vstack(hazard_curves['level']), np.vstack(expected['level']))
+
+
+def test_round_trip(tmp_path, fetch):
+    fetch, fetched = fetch
+    curve_cache = cache.CurveCache(tmp_path)
+    locs = synthetic_locations(12)
+
+    cold = cache.get_hazard(curve_cache, HAZARD_ID, VS30, locs, IMTS, AGGS, fetch=fetch)
+    warm = cache.get_hazard(cache.CurveCache(tmp_path), HAZARD_ID, VS30, locs, IMTS, AGGS, fetch=fetch)
+
+    assert len(fetched) == 1
+    assert len(cold) == len(locs) * len(IMTS) * len(AGGS)
+    assert_same_curves(warm, cold)
+
+
+def test_absent_curves_are_recorded(tmp_path, fetch):
+    fetch, fetched = fetch
+    locs = synthetic_locations(6)
+    absent_code = locs[2].code
+
+    def fetch_without_location(*args, **kwargs):
+        hazard_curves = fetch(*args, **kwargs)
+        return hazard_curves.loc[(hazard_curves['lat'] + '~' + hazard_curves['lon']) != absent_code]
+
+    cold = cache.get_hazard(cache.CurveCache(tmp_path), HAZARD_ID, VS30, locs, IMTS, AGGS, fetch=fetch_without_location)
+    warm = cache.get_hazard(cache.CurveCache(tmp_path), HAZARD_ID, VS30, locs, IMTS, AGGS, fetch=fetch_without_location)
+
+    assert len(fetched) == 1
+    assert len(cold) == (len(locs) - 1) * len(IMTS) * len(AGGS)
+    assert absent_code not in set(cold['lat'] + '~' + cold['lon'])
+    assert_same_curves(warm, cold)
+
+    # a curve that becomes available replaces its marker
+    curve_cache = cache.CurveCache(tmp_path)
+    curve_cache.write(HAZARD_ID, VS30, fetch(HAZARD_ID, VS30, locs[2:3], IMTS, AGGS))
+    hazard_curves = cache.get_hazard(curve_cache, HAZARD_ID, VS30, locs, IMTS, AGGS, fetch=fetch_without_location)
+    assert len(fetched) == 2
+    assert len(hazard_curves) == len(locs) * len(IMTS) * len(AGGS)
+
+
+def test_request_order_and_partial_miss(tmp_path, fetch):
+    fetch, fetched = fetch
+    curve_cache = cache.CurveCache(tmp_path)
+    locs = synthetic_locations(12)
+    cached = cache.get_hazard(curve_cache, HAZARD_ID, VS30, locs[:8], IMTS, AGGS, fetch=fetch)
+
+    request = [locs[i] for i in (11, 3, 9, 0, 3)]
+    hazard_curves = cache.get_hazard(curve_cache, HAZARD_ID, VS30, request, IMTS, AGGS, fetch=fetch)
+
+    # only the locations missing from the cache are fetched, the result is in request order without repeats
+    assert [loc.code for loc in fetched[1]] == [locs[11].code, locs[9].code]
+    codes = list(dict.fromkeys(hazard_curves['lat'] + '~' + hazard_curves['lon']))
+    assert codes == [locs[i].code for i in (11, 3, 9, 0)]
+    from_cache = hazard_curves.loc[(hazard_curves['lat'] + '~' + hazard_curves['lon']) == locs[3].code]
+    assert_same_curves(
+        from_cache.reset_index(drop=True),
+        cached.loc[(cached['lat'] + '~' + cached['lon']) == locs[3].code].reset_index(drop=True),
+    )
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+import pytest
+from nzshm_common.location import CodedLocation
+
+from nzshm_hazlab.store import curves, curves_v4
+from nzshm_hazlab.store.benchmark import HAZARD_ID, VS30, FakeTHS, fake_ths, synthetic_locations, write_synthetic_oqcsv
+from nzshm_hazlab.store.columnar import BatchFormat, CurveArrays, list_column_to_matrix
+
+IMTS = ['PGA', 'SA(1.0)']
+AGGS = ['mean', '0.1', '0.9']
+
+
+@pytest.fixture
+def locs():
+    return synthetic_locations(6)
+
+
+def ths_records(locs):
+    """the records of a single THS query, as the fake returns them to a fresh store.curves query"""
+
+    return list(FakeTHS().get_hazard_curves(curves.location_codes(locs), [VS30], [HAZARD_ID], IMTS, AGGS))
+
+
+def baseline_frame(records):
+    """the frame store.curves.get_hazard built one record at a time before the columnar accumulator"""
+
+    rows = [
+        dict(
+            lat=f'{res.lat:0.3f}',
+            lon=f'{res.lon:0.3f}',
+            imt=res.imt,
+            agg=res.agg,
+            level=np.array([float(item.lvl) for item in res.values]),
+            apoe=np.array([float(item.val) for item in res.values]),
+        )
+        for res in records
+    ]
+    return pd.DataFrame(rows, columns=curves.COLUMNS)
+
+
+def baseline_frame_v1(records):
+    """the frame store.curves.get_hazard_v1 built one curve point at a time"""
+
+    rows = [
+        dict(lat=f'{res.lat:0.3f}', lon=f'{res.lon:0.3f}', imt=res.imt, agg=res.agg, level=value.lvl, apoe=value.val)
+        for res in records
+        for value in res.values
+    ]
+    return pd.DataFrame(rows, columns=curves.COLUMNS)
+
+
+def test_get_hazard_layout_matches_baseline(locs):
+    expected = baseline_frame(ths_records(locs))
+    with fake_ths(FakeTHS()):
+        hazard_curves = curves.get_hazard(HAZARD_ID, VS30, locs, IMTS, AGGS)
+
+    assert list(hazard_curves.columns) == curves.COLUMNS
+    for column in ('lat', 'lon', 'imt', 'agg'):
+        assert list(hazard_curves[column]) == list(expected[column])
+    for column in ('level', 'apoe'):
+        np.testing.assert_array_equal(np.vstack(hazard_curves[column]), np.vstack(expected[column]))
+
+
+def test_get_hazard_v1_layout_matches_baseline(locs):
+    expected = baseline_frame_v1(ths_records(locs))
+    with fake_ths(FakeTHS()):
+        hazard_curves = curves.get_hazard_v1(HAZARD_ID, VS30, locs, IMTS, AGGS)
+
+    pd.testing.assert_frame_equal(hazard_curves, expected, check_dtype=False)
+
+
+def test_get_hazard_row_per_curve_and_empty_request(locs):
+    with fake_ths(FakeTHS()):
+        hazard_curves = curves.get_hazard(HAZARD_ID, VS30, locs, IMTS, AGGS)
+        empty = curves.get_hazard(HAZARD_ID, VS30, [], IMTS, AGGS)
+
+    assert len(hazard_curves) == len(locs) * len(IMTS) * len(AGGS)
+    assert list(empty.columns) == curves.COLUMNS
+    assert len(empty) == 0
+
+
+@pytest.mark.parametrize('batch_format', [BatchFormat.NUMPY, BatchFormat.ARROW])
+def test_iter_hazard_batches(locs, batch_format):
+    with fake_ths(FakeTHS()):
+        expected = curves.get_hazard_arrays(HAZARD_ID, VS30, locs, IMTS, AGGS)
+    with fake_ths(FakeTHS()):
+        batches = list(curves.iter_hazard(HAZARD_ID, VS30, locs, IMTS, AGGS, batch_size=7, batch_format=batch_format))
+
+    assert [len(batch.apoe) if batch_format is BatchFormat.NUMPY else batch.num_rows for batch in batches] == [7] * 5 + [1]
+    if batch_format is BatchFormat.ARROW:
+        apoe = np.vstack([list_column_to_matrix(batch['apoe']) for batch in batches])
+        imt = np.concatenate([batch['imt'].to_numpy(zero_copy_only=False) for batch in batches])
+    else:
+        assert all(isinstance(batch, CurveArrays) for batch in batches)
+        apoe = np.vstack([batch.apoe for batch in batches])
+        imt = np.concatenate([batch.imt for batch in batches])
+    np.testing.assert_array_equal(apoe, expected.apoe)
+    assert list(imt) == list(expected.imt)
+
+
+def test_oqcsv_matches_the_csv_rows(tmp_path, locs):
+    pattern = write_synthetic_oqcsv(tmp_path, locs, IMTS)
+
+    hazard_curves = curves.get_hazard_from_oqcsv(pattern, IMTS)
+    cube = curves.get_hazard_from_oqcsv(pattern, IMTS, as_cube=True)
+
+    assert list(hazard_curves.columns) == curves.COLUMNS
+    assert list(hazard_curves['imt']) == list(np.repeat(IMTS, len(locs)))
+    assert set(hazard_curves['agg']) == {'mean'}
+    for i, imt in enumerate(IMTS):
+        oq_output = pd.read_csv(pattern.replace('IMT', imt), skiprows=1, float_precision='round_trip')
+        rows = hazard_curves.loc[hazard_curves['imt'] == imt]
+        codes = [CodedLocation(lat, lon, 0.001).code for lat, lon in zip(oq_output['lat'], oq_output['lon'])]
+        assert list(rows['lat'] + '~' + rows['lon']) == codes
+        np.testing.assert_array_equal(np.vstack(rows['apoe']), oq_output.iloc[:, 3:].to_numpy())
+        np.testing.assert_array_equal(np.vstack(rows['level']), np.tile(curves_v4.imtls, (len(locs), 1)))
+        np.testing.assert_array_equal(cube[codes, imt, 'mean'], oq_output.iloc[:, 3:].to_numpy())
+    assert cube.aggs == ['mean']
@@ -0,0 +1,91 @@
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from nzshm_hazlab.store import curves_v4
+from nzshm_hazlab.store.benchmark import HAZARD_ID, VS30, synthetic_locations, write_synthetic_dataset
+from nzshm_hazlab.store.columnar import BatchFormat, list_column_to_matrix, matrix_to_list_array
+
+IMTS = ['PGA', 'SA(0.5)', 'SA(1.0)']
+AGGS = ['mean', '0.1', '0.9']
+
+
+@pytest.fixture
+def locs():
+    return synthetic_locations(10)
+
+
+@pytest.fixture
+def fs_specs(tmp_path, locs):
+    curves_v4.DATASETS.clear()
+    fs_specs = write_synthetic_dataset(tmp_path, HAZARD_ID, VS30, locs, IMTS, AGGS)
+    yield fs_specs
+    curves_v4.DATASETS.clear()
+
+
+def curve_keys(arrays):
+    return list(zip(arrays.lat, arrays.lon, arrays.imt, arrays.agg))
+
+
+@pytest.mark.parametrize('batch_format', [BatchFormat.NUMPY, BatchFormat.ARROW])
+def test_iter_hazard_batches(fs_specs, locs, batch_format):
+    request = (HAZARD_ID, VS30, locs[:7], IMTS[1:], AGGS, fs_specs)
+    expected = curves_v4.get_hazard_arrays(*request)
+    batches = list(curves_v4.iter_hazard(*request, batch_size=5, batch_format=batch_format))
+
+    if batch_format is BatchFormat.ARROW:
+        batches = [curves_v4._table_to_arrays(batch) for batch in batches]
+    assert [len(batch.apoe) for batch in batches] == [5] * 8 + [2]
+    assert sum((curve_keys(batch) for batch in batches), []) == curve_keys(expected)
+    np.testing.assert_array_equal(np.vstack([batch.apoe for batch in batches]), expected.apoe)
+
+
+def test_registry_reuses_datasets_and_prunes_partitions(tmp_path, fs_specs, locs):
+    for hazard_id, vs30 in [('OTHER', VS30), (HAZARD_ID, 750)]:
+        write_synthetic_dataset(tmp_path, hazard_id, vs30, locs, IMTS, AGGS)
+    curves_v4.DATASETS.clear()
+
+    dataset = curves_v4.DATASETS.dataset(fs_specs)
+    hazard_curves = curves_v4.get_hazard(HAZARD_ID, 750, locs[:2], ['PGA'], ['mean'], fs_specs)
+
+    assert curves_v4.DATASETS.dataset(dict(fs_specs)) is dataset
+    assert (curves_v4.DATASETS.last_scan.fragments, curves_v4.DATASETS.last_scan.fragments_total) == (1, 3)
+    assert curves_v4.DATASETS.last_scan.fragment_bytes > 0
+    assert list(hazard_curves['vs30']) == [750, 750]
+    assert len(curves_v4.DATASETS.fragments(fs_specs, {'vs30': [VS30], 'not_a_partition': ['x']})) == 2
+
+    curves_v4.DATASETS.clear()
+    assert curves_v4.DATASETS.dataset(fs_specs) is not dataset
+
+
+def test_values_column_to_matrix(fs_specs, locs):
+    table = curves_v4._scan_table(HAZARD_ID, VS30, locs, IMTS, AGGS, fs_specs)
+    hazard_curves = curves_v4.get_hazard(HAZARD_ID, VS30, locs, IMTS, AGGS, fs_specs)
+
+    np.testing.assert_array_equal(np.vstack(hazard_curves['apoe']), np.array(table['values'].to_pylist()))
+    np.testing.assert_array_equal(np.vstack(hazard_curves['level']), np.tile(curves_v4.imtls, (len(table), 1)))
+    assert list(hazard_curves['lat']) == [f'{lat:0.3f}' for lat in table['lat'].to_pylist()]
+
+    values = table['values'].combine_chunks()
+    chunked = pa.chunked_array([values[:4], values[4:]])
+    np.testing.assert_array_equal(list_column_to_matrix(chunked), np.vstack(hazard_curves['apoe']))
+    matrix = np.vstack(hazard_curves['apoe'])
+    np.testing.assert_array_equal(list_column_to_matrix(matrix_to_list_array(matrix)), matrix)
+
+
+def test_get_hazard_multi_matches_single_scans(tmp_path, fs_specs, locs):
+    write_synthetic_dataset(tmp_path, HAZARD_ID, 750, locs, IMTS, AGGS)
+    curves_v4.DATASETS.clear()
+
+    hazard = curves_v4.get_hazard_multi([HAZARD_ID, 'MISSING'], [VS30, 750], locs[:4], IMTS[:2], AGGS, fs_specs)
+
+    assert set(hazard) == {(HAZARD_ID, VS30), (HAZARD_ID, 750)}
+    for (hazard_id, vs30), hazard_curves in hazard.items():
+        single = curves_v4.get_hazard(hazard_id, vs30, locs[:4], IMTS[:2], AGGS, fs_specs)
+        assert list(hazard_curves.columns) == list(single.columns)
+        assert list(hazard_curves['imt']) == list(single['imt'])
+        np.testing.assert_array_equal(np.vstack(hazard_curves['apoe']), np.vstack(single['apoe']))
+
+    cube = curves_v4.get_hazard_multi([HAZARD_ID], [750], locs[:4], IMTS[:2], AGGS, fs_specs, as_cube=True)
+    single = curves_v4.get_hazard(HAZARD_ID, 750, locs[:4], IMTS[:2], AGGS, fs_specs, as_cube=True)
+    np.testing.assert_array_equal(cube[(HAZARD_ID, 750)].values, single.values)
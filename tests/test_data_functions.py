@@ -0,0 +1,153 @@
+import numpy as np
+import pytest
+
+from nzshm_hazlab.base_functions import acc_to_disp
+from nzshm_hazlab.data_functions import (
+    aggregate_realizations,
+    compute_hazard_at_poes,
+    compute_poe_at_intensities,
+    compute_rate_at_intensities,
+    compute_uhs,
+    get_poe_df,
+    rp_from_poe,
+    weighted_quantile,
+    weighted_quantiles,
+    weighted_stats,
+)
+from nzshm_hazlab.hazard_cube import HazardCube
+from nzshm_hazlab.store import curves as store_curves
+from nzshm_hazlab.store.benchmark import HAZARD_ID, VS30, FakeTHS, fake_ths, synthetic_curves, synthetic_locations
+
+LEVELS = np.geomspace(1e-4, 5.0, 30)
+INV_TIME = 50
+
+
+@pytest.fixture
+def curves():
+    return synthetic_curves(40, LEVELS, seed=1)
+
+
+def test_hazard_at_poes_matches_loglog_interp(curves):
+    poes = [0.1, 0.02, 0.5]
+    hazard = compute_hazard_at_poes(LEVELS, curves, poes, INV_TIME)
+
+    assert hazard.shape == (len(curves), len(poes))
+    for curve, curve_hazard in zip(curves, hazard):
+        for poe, haz in zip(poes, curve_hazard):
+            target = 1 / rp_from_poe(poe, INV_TIME)
+            expected = np.exp(np.interp(np.log(target), np.flip(np.log(curve)), np.flip(np.log(LEVELS))))
+            assert haz == pytest.approx(expected)
+
+
+def test_hazard_at_poes_stacked_and_missing(curves):
+    stacked = curves.reshape(4, 10, -1).copy()
+    stacked[1, 3] = np.nan
+    hazard = compute_hazard_at_poes(LEVELS, stacked, [0.1], INV_TIME)
+
+    assert hazard.shape == (4, 10, 1)
+    assert np.isnan(hazard[1, 3, 0])
+    np.testing.assert_allclose(hazard[0, :, 0], compute_hazard_at_poes(LEVELS, curves[:10], [0.1], INV_TIME)[:, 0])
+
+
+@pytest.mark.parametrize('layout', ['get_hazard', 'get_hazard_v1', 'cube'])
+def test_poe_df_in_location_order(layout):
+    locs = synthetic_locations(5)
+    with fake_ths(FakeTHS()):
+        hazard_curves = store_curves.get_hazard(HAZARD_ID, VS30, locs[1:], ['PGA'], ['mean', '0.9'])
+    if layout == 'get_hazard_v1':
+        # a new FakeTHS returns the same curves
+        with fake_ths(FakeTHS()):
+            hazard = store_curves.get_hazard_v1(HAZARD_ID, VS30, locs[1:], ['PGA'], ['mean', '0.9'])
+    else:
+        hazard = HazardCube.from_dataframe(hazard_curves) if layout == 'cube' else hazard_curves
+
+    # the first location has no curve
+    request = locs[[3, 0, 1]]
+    poe_df = get_poe_df(hazard, request, 'PGA', '0.9', 0.1, INV_TIME)
+
+    np.testing.assert_array_equal(poe_df['lat'], request.lat)
+    np.testing.assert_array_equal(poe_df['lon'], request.lon)
+    assert np.isnan(poe_df['level'][1])
+    agg_curves = hazard_curves.loc[hazard_curves['agg'] == '0.9', 'apoe']
+    expected = compute_hazard_at_poes(hazard_curves['level'][0], np.vstack(agg_curves), [0.1], INV_TIME)[:, 0]
+    np.testing.assert_allclose(poe_df['level'][[0, 2]], expected[[2, 0]])
+
+
+def test_poe_at_intensities_matches_loglog_interp(curves):
+    intensities = [1e-3, 0.05, 0.3, 2.0]
+    poe = compute_poe_at_intensities(LEVELS, curves, intensities)
+
+    for curve, curve_poe in zip(curves, poe):
+        expected = np.exp(np.interp(np.log(intensities), np.log(LEVELS), np.log(curve)))
+        np.testing.assert_allclose(curve_poe, expected)
+
+
+def test_poe_at_intensities_inverts_hazard_at_poes(curves):
+    target = 1 / rp_from_poe(0.1, INV_TIME)
+    hazard = compute_hazard_at_poes(LEVELS, curves, [0.1], INV_TIME)[:, 0]
+    # hazard is clamped to the levels, only curves crossing the target within them can be inverted
+    inside = (curves[:, 0] > target) & (curves[:, -1] < target)
+    assert inside.any()
+    poe = [compute_poe_at_intensities(LEVELS, curve, [haz])[0] for curve, haz in zip(curves[inside], hazard[inside])]
+    np.testing.assert_allclose(poe, target)
+
+
+def test_rate_at_intensities(curves):
+    poe = compute_poe_at_intensities(LEVELS, curves, [0.1])
+    np.testing.assert_allclose(compute_rate_at_intensities(LEVELS, curves, [0.1], INV_TIME), -np.log(1 - poe) / INV_TIME)
+
+
+@pytest.mark.parametrize('old_style', [False, True])
+def test_weighted_quantiles_match_weighted_quantile(old_style):
+    rng = np.random.default_rng(2)
+    values = rng.uniform(size=(25, len(LEVELS)))
+    weights = rng.uniform(size=25)
+    quantiles = [0.05, 0.5, 0.9]
+
+    result = weighted_quantiles(values, quantiles, weights, old_style=old_style)
+
+    assert result.shape == (len(quantiles), len(LEVELS))
+    for j in range(len(LEVELS)):
+        expected = weighted_quantile(values[:, j], quantiles, weights, old_style=old_style)
+        np.testing.assert_allclose(result[:, j], expected)
+
+
+def test_weighted_stats():
+    rng = np.random.default_rng(3)
+    values = rng.uniform(size=(3, 25, len(LEVELS)))
+    weights = rng.uniform(size=25)
+
+    mean, std, cov = weighted_stats(values, weights)
+
+    np.testing.assert_allclose(mean, np.average(values, axis=1, weights=weights))
+    variance = np.average((values - mean[:, np.newaxis, :]) ** 2, axis=1, weights=weights)
+    np.testing.assert_allclose(std, np.sqrt(variance))
+    np.testing.assert_allclose(cov, std / mean)
+
+
+def test_aggregate_realizations_order():
+    rng = np.random.default_rng(4)
+    values = rng.uniform(size=(25, len(LEVELS)))
+    weights = np.full(25, 1 / 25)
+
+    result = aggregate_realizations(values, weights, ['0.9', 'mean', 0.1])
+
+    np.testing.assert_allclose(result[0], weighted_quantiles(values, [0.9], weights)[0])
+    np.testing.assert_allclose(result[1], values.mean(axis=0))
+    np.testing.assert_allclose(result[2], weighted_quantiles(values, [0.1], weights)[0])
+
+
+def test_uhs_period_order_and_displacement():
+    imts = ['SA(1.0)', 'PGA', 'SA(0.5)']
+    aggs = ['mean', '0.9']
+    values = synthetic_curves(2 * len(imts) * len(aggs), LEVELS, seed=5).reshape(2, len(imts), len(aggs), -1)
+    cube = HazardCube(values, LEVELS, ['-41.300~174.780', '-43.530~172.630'], imts, aggs)
+
+    uhs = compute_uhs(cube, [0.1, 0.02], INV_TIME)
+
+    assert uhs.imts == ['PGA', 'SA(0.5)', 'SA(1.0)']
+    np.testing.assert_array_equal(uhs.periods, [0.0, 0.5, 1.0])
+    assert uhs.acc.shape == (2, len(aggs), 2, len(imts))
+    expected = compute_hazard_at_poes(LEVELS, cube['-43.530~172.630', 'SA(0.5)', '0.9'], [0.02], INV_TIME)[0]
+    assert uhs.acc[1, 1, 1, 1] == pytest.approx(expected)
+    np.testing.assert_allclose(uhs.disp, acc_to_disp(uhs.acc, uhs.periods))
@@ -0,0 +1,94 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from pyarrow import fs
+
+from nzshm_hazlab.store import curves_v4
+from nzshm_hazlab.store.benchmark import HAZARD_ID, synthetic_locations, write_synthetic_dataset
+from nzshm_hazlab.store.fs_cache import CachingFileSystemHandler, caching_filesystem
+
+IMTS = ['PGA', 'SA(1.0)']
+AGGS = ['mean', '0.9']
+VS30S = [150, 250, 400, 750]
+
+
+@pytest.fixture
+def source_dir(tmp_path):
+    source_dir = tmp_path / 'source'
+    for vs30 in VS30S:
+        write_synthetic_dataset(source_dir, HAZARD_ID, vs30, synthetic_locations(20), IMTS, AGGS)
+    return source_dir
+
+
+def fragment_paths(source_dir):
+    return sorted(str(path) for path in source_dir.rglob('*.parquet'))
+
+
+def test_read_through_and_invalidation(tmp_path, source_dir):
+    handler = CachingFileSystemHandler(fs.LocalFileSystem(), tmp_path / 'cache')
+    path = fragment_paths(source_dir)[0]
+
+    with handler.open_input_file(path) as cold:
+        data = cold.read()
+    with handler.open_input_stream(path) as warm:
+        assert warm.read() == data
+    assert (handler.hits, handler.misses) == (1, 1)
+
+    # a changed source file is fetched again
+    os.utime(path, ns=(0, 0))
+    with handler.open_input_file(path) as changed:
+        assert changed.read() == data
+    assert (handler.hits, handler.misses) == (1, 2)
+
+
+def test_eviction_skips_files_in_use(tmp_path, source_dir):
+    paths = fragment_paths(source_dir)
+    handler = CachingFileSystemHandler(fs.LocalFileSystem(), tmp_path / 'cache', max_bytes=1)
+
+    in_use = handler._cached_file(paths[0])
+    for path in paths[1:]:
+        with handler.open_input_file(path):
+            pass
+        assert in_use.exists()
+    handler._release(in_use)
+
+    with handler.open_input_file(paths[1]):
+        pass
+    assert not in_use.exists()
+    assert handler.size() <= os.path.getsize(paths[1])
+
+
+def test_threaded_scans_within_a_small_cache(tmp_path, source_dir):
+    fs_specs = {
+        'arrow_fs': curves_v4.ArrowFS.LOCAL,
+        'arrow_dir': str(source_dir),
+        'cache_dir': str(tmp_path / 'cache'),
+        'cache_bytes': 1,
+    }
+    locs = synthetic_locations(20)
+    curves_v4.DATASETS.clear()
+    try:
+        expected = {vs30: curves_v4.get_hazard_arrays(HAZARD_ID, vs30, locs, IMTS, AGGS, fs_specs) for vs30 in VS30S}
+        handler = curves_v4._fs_cache(fs_specs)
+        opens = handler.hits + handler.misses
+
+        def scan(vs30):
+            return vs30, curves_v4.get_hazard_arrays(HAZARD_ID, vs30, locs, IMTS, AGGS, fs_specs)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for vs30, arrays in executor.map(scan, VS30S * 10):
+                np.testing.assert_array_equal(arrays.apoe, expected[vs30].apoe)
+    finally:
+        curves_v4.DATASETS.clear()
+    assert handler.hits + handler.misses > opens
+    assert handler._in_use == {}
+
+
+def test_caching_filesystem_passes_other_operations_through(tmp_path, source_dir):
+    filesystem = caching_filesystem(fs.LocalFileSystem(), tmp_path / 'cache')
+    path = fragment_paths(source_dir)[0]
+
+    assert filesystem.get_file_info(path).size == os.path.getsize(path)
+    assert filesystem.type_name == 'py::caching+local'
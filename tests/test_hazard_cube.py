@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+from nzshm_common.location import CodedLocation
+
+from nzshm_hazlab.hazard_cube import HazardCube
+from nzshm_hazlab.locations import LocationArray
+from nzshm_hazlab.store.benchmark import synthetic_curves
+
+LEVELS = np.geomspace(1e-4, 5.0, 10)
+LOCATIONS = ['-41.300~174.780', '-43.530~172.630', '-36.870~174.770']
+IMTS = ['PGA', 'SA(1.0)']
+AGGS = ['mean', '0.1', '0.9']
+
+
+@pytest.fixture
+def cube():
+    values = synthetic_curves(len(LOCATIONS) * len(IMTS) * len(AGGS), LEVELS).reshape(3, 2, 3, -1)
+    return HazardCube(values, LEVELS, LOCATIONS, IMTS, AGGS)
+
+
+def test_indexing(cube):
+    curve = cube['-43.530~172.630', 'SA(1.0)', '0.1']
+    np.testing.assert_array_equal(curve, cube.values[1, 1, 1])
+    assert np.shares_memory(curve, cube.values)
+    np.testing.assert_array_equal(cube[CodedLocation(-43.53, 172.63, 0.001), 'SA(1.0)', '0.1'], curve)
+    np.testing.assert_array_equal(cube.curve(LOCATIONS[1], 'SA(1.0)', '0.1'), curve)
+
+    assert cube[:, 'PGA', ['0.9', 'mean']].shape == (3, 2, len(LEVELS))
+    np.testing.assert_array_equal(cube[:, 'PGA', ['0.9', 'mean']][:, 0], cube.values[:, 0, 2])
+    locs = LocationArray([-36.87, -41.3], [174.77, 174.78])
+    np.testing.assert_array_equal(cube[locs, None, 'mean'], cube.values[[2, 0], :, 0])
+
+
+def test_sel(cube):
+    sub = cube.sel(['-36.870~174.770', '-41.300~174.780'], aggs=['0.9'])
+
+    assert sub.locations == ['-36.870~174.770', '-41.300~174.780']
+    assert sub.imts == IMTS
+    assert sub.shape == (2, 2, 1, len(LEVELS))
+    np.testing.assert_array_equal(sub.values[0, :, 0], cube.values[2, :, 2])
+    np.testing.assert_allclose(sub.lat, [-36.87, -41.3])
+
+
+def test_shape_is_checked():
+    with pytest.raises(ValueError):
+        HazardCube(np.zeros((2, 2, 3, len(LEVELS))), LEVELS, LOCATIONS, IMTS, AGGS)
+
+
+def test_dataframe_round_trip(cube):
+    cube.values[0, 1, 2] = np.nan
+    hazard_curves = cube.to_dataframe()
+
+    assert len(hazard_curves) == cube.values[..., 0].size - 1
+    assert list(hazard_curves.iloc[0][['lat', 'lon', 'imt', 'agg']]) == ['-41.300', '174.780', 'PGA', 'mean']
+
+    round_trip = HazardCube.from_dataframe(hazard_curves)
+    assert round_trip.locations == LOCATIONS
+    np.testing.assert_array_equal(round_trip.levels, LEVELS)
+    np.testing.assert_array_equal(round_trip.values, cube.values)
+
+
+def test_from_dataframe_requires_shared_levels(cube):
+    hazard_curves = cube.to_dataframe()
+    hazard_curves.at[0, 'level'] = LEVELS * 2
+    with pytest.raises(ValueError):
+        HazardCube.from_dataframe(hazard_curves)
+    assert HazardCube.from_dataframe(pd.DataFrame({'apoe': pd.Series(dtype=object)})).shape == (0, 0, 0, 0)
@@ -0,0 +1,85 @@
+import numpy as np
+
+from nzshm_hazlab import hazard_data
+from nzshm_hazlab.hazard_data import HazardData
+
+
+def test_curves_are_evicted_beyond_the_memory_limit(fake_query):
+    # the levels and realization curves of one location and imt
+    nbytes = len(fake_query.levels) * (fake_query.nrlz + 1) * 8
+    hd = HazardData('H', memory_limit=nbytes)
+
+    for location in fake_query.locations:
+        vals = hd.values(location, 'PGA', 1).vals
+        np.testing.assert_allclose(vals, fake_query.curve(location, 'PGA', 1))
+        assert hd.cache_info().nbytes <= nbytes
+    hd.values(fake_query.locations[-1], 'PGA', 2)
+    hd.values(fake_query.locations[0], 'PGA', 2)
+
+    info = hd.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 4, 1)
+
+
+def test_prefetch_batches_unnormalised_codes(fake_query):
+    locations = ['-41.3~174.78', '-43.53~172.63']
+    hd = HazardData('H', locations=locations)
+
+    for location in locations:
+        np.testing.assert_allclose(hd.values(location, 'PGA', 1).vals, fake_query.curve(location, 'PGA', 1))
+
+    assert fake_query.queries == [('rlz', locations)]
+    assert hd.cache_info().misses == 0
+
+
+def test_background_prefetch_within_memory_limit(fake_query):
+    nbytes = len(fake_query.levels) * (fake_query.nrlz + 1) * 8
+    hd = HazardData('H', memory_limit=nbytes, locations=fake_query.locations, background=True)
+    try:
+        for location in reversed(fake_query.locations):
+            vals = hd.values(location, 'SA(1.0)', 3).vals
+            np.testing.assert_allclose(vals, fake_query.curve(location, 'SA(1.0)', 3))
+    finally:
+        hd.close()
+    assert hd.cache_info().nbytes <= nbytes
+
+
+def test_rlz_matrix(fake_query):
+    hd = HazardData('H')
+    location = fake_query.locations[1]
+    realizations = hd.rlz_matrix(location, 'SA(1.0)')
+
+    np.testing.assert_allclose(realizations.lvls, fake_query.levels)
+    expected = [fake_query.curve(location, 'SA(1.0)', rlz) for rlz in range(fake_query.nrlz)]
+    np.testing.assert_allclose(realizations.vals, expected)
+    np.testing.assert_allclose(realizations.weights, np.full(fake_query.nrlz, 1 / fake_query.nrlz))
+    np.testing.assert_allclose(hd.values(location, 'SA(1.0)', 2).vals, realizations.vals[2])
+    np.testing.assert_allclose(hd.values(location, 'PGA', 'mean').vals, fake_query.curve(location, 'PGA', 'mean'))
+
+
+def test_snapshot_round_trip(tmp_path, fake_query):
+    cold = HazardData('H', locations=fake_query.locations, cache_dir=tmp_path)
+    location = fake_query.locations[0]
+    cold.values(location, 'PGA', 'mean')
+    cold.save()
+
+    fake_query.queries.clear()
+    warm = HazardData('H', locations=fake_query.locations, cache_dir=tmp_path)
+
+    for field in hazard_data.METADATA_FIELDS + hazard_data.LOGIC_TREES:
+        assert getattr(warm, field) == getattr(cold, field)
+        assert type(getattr(warm, field)) is type(getattr(cold, field))
+    assert isinstance(warm.locs, set)
+    for loc in fake_query.locations:
+        for imt in fake_query.imts:
+            np.testing.assert_array_equal(warm.rlz_matrix(loc, imt).vals, cold.rlz_matrix(loc, imt).vals)
+    np.testing.assert_array_equal(warm.values(location, 'PGA', 'mean').vals, fake_query.curve(location, 'PGA', 'mean'))
+    assert fake_query.queries == []
+
+
+def test_snapshot_curves_are_not_views(tmp_path, fake_query):
+    cold = HazardData('H', locations=fake_query.locations, cache_dir=tmp_path)
+    cold.save()
+
+    warm = HazardData('H', cache_dir=tmp_path)
+    for curves in warm._data.data.values():
+        assert curves.vals.base is None and curves.lvls.base is None
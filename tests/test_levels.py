@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from nzshm_hazlab.data_functions import compute_hazard_at_poes
+from nzshm_hazlab.hazard_cube import HazardCube
+from nzshm_hazlab.store import curves, levels
+from nzshm_hazlab.store.benchmark import HAZARD_ID, VS30, FakeTHS, fake_ths, synthetic_locations
+
+IMT = 'PGA'
+AGGS = ['mean', '0.9']
+POES = [0.1, 0.02]
+
+
+@pytest.fixture
+def geometry(monkeypatch):
+    locations = synthetic_locations(9)
+    geometry = levels.GridGeometry(locations.lat, locations.lon, locations)
+    monkeypatch.setattr(levels, 'grid_geometry', lambda site_list: geometry)
+    return geometry
+
+
+@pytest.fixture
+def fetch(geometry):
+    """the same THS curves on every call, for all grid points but the first and only for the mean"""
+
+    with fake_ths(FakeTHS()):
+        hazard_curves = curves.get_hazard(HAZARD_ID, VS30, geometry.locations[1:], [IMT], ['mean'])
+
+    def fetch(hazard_id, vs30, locs, imts, aggs):
+        return hazard_curves.copy()
+
+    return fetch
+
+
+def test_gridded_hazard_interpolates_every_curve(geometry, fetch):
+    gridded = levels.compute_gridded_hazard(HAZARD_ID, VS30, IMT, AGGS, POES, fetch=fetch)
+    cube = HazardCube.from_dataframe(fetch(HAZARD_ID, VS30, geometry.locations, [IMT], AGGS))
+
+    assert set(gridded) == {(agg, poe) for agg in AGGS for poe in POES}
+    for poe in POES:
+        grid = gridded[('mean', poe)]
+        np.testing.assert_array_equal(grid['lat'], geometry.lat)
+        np.testing.assert_array_equal(grid['lon'], geometry.lon)
+        curves_mean = cube[geometry.locations[1:], IMT, 'mean']
+        expected = compute_hazard_at_poes(cube.levels, curves_mean, [poe], levels.INV_TIME)[:, 0]
+        np.testing.assert_allclose(grid['level'][1:], expected)
+        # no curve for the first grid point or for the 0.9 agg
+        assert np.isnan(grid['level'][0])
+        assert gridded[('0.9', poe)]['level'].isna().all()
+
+
+def test_gridded_hazard_without_curves(geometry):
+    gridded = levels.compute_gridded_hazard(
+        HAZARD_ID, VS30, IMT, AGGS, POES, fetch=lambda *args: curves.get_hazard(HAZARD_ID, VS30, [], [IMT], AGGS)
+    )
+    assert all(grid['level'].isna().all() for grid in gridded.values())
+
+
+def test_get_hazard_at_poe(monkeypatch, geometry, fetch):
+    grid_poes = np.arange(len(geometry.locations), dtype=float)
+
+    def get_gridded_hazard(hazard_ids, site_lists, vs30s, imts, aggs, poes):
+        # THS only has a record for the 0.1 poe
+        return iter([SimpleNamespace(grid_poes=grid_poes)] if poes == [0.1] else [])
+
+    monkeypatch.setattr(levels.query, 'get_gridded_hazard', get_gridded_hazard)
+
+    from_ths = levels.get_hazard_at_poe(HAZARD_ID, VS30, IMT, 'mean', 0.1, fetch=fetch)
+    np.testing.assert_array_equal(from_ths['level'], grid_poes)
+
+    local = levels.get_hazard_at_poe(HAZARD_ID, VS30, IMT, 'mean', 0.1, local=True, fetch=fetch)
+    missing_record = levels.get_hazard_at_poe(HAZARD_ID, VS30, IMT, 'mean', 0.02, fetch=fetch)
+    gridded = levels.compute_gridded_hazard(HAZARD_ID, VS30, IMT, ['mean'], [0.1, 0.02], fetch=fetch)
+    np.testing.assert_array_equal(local['level'], gridded[('mean', 0.1)]['level'])
+    np.testing.assert_array_equal(missing_record['level'], gridded[('mean', 0.02)]['level'])
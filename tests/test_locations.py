@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from nzshm_common.location import CodedLocation
+
+from nzshm_hazlab.locations import LocationArray, location_codes
+
+
+@pytest.fixture
+def latlon():
+    rng = np.random.default_rng(0)
+    return np.column_stack((rng.uniform(-47.5, -34.0, 500), rng.uniform(166.0, 178.6, 500)))
+
+
+@pytest.mark.parametrize('resolution', [0.001, 0.01, 0.1])
+def test_same_coordinates_and_codes_as_coded_location(latlon, resolution):
+    latlon = np.vstack((latlon, [(-41.3, 172.7), (-41.3, 174.78), (-36.87, 174.77)]))
+    locations = LocationArray(latlon[:, 0], latlon[:, 1], resolution)
+    coded = [CodedLocation(lat, lon, resolution) for lat, lon in latlon]
+
+    assert list(locations.lat) == [loc.lat for loc in coded]
+    assert list(locations.lon) == [loc.lon for loc in coded]
+    assert list(locations.codes) == [loc.code for loc in coded]
+    assert list(locations) == coded
+
+
+def test_grid_coordinates_are_not_noisy():
+    locations = LocationArray([-41.3], [172.7], 0.1)
+    assert (locations.lat[0], locations.lon[0]) == (-41.3, 172.7)
+
+
+def test_sequence_and_index(latlon):
+    locations = LocationArray.from_locations(list(map(tuple, latlon[:5])) + [tuple(latlon[1])])
+    coded = CodedLocation(*latlon[1], 0.001)
+
+    assert len(locations) == 6
+    assert locations[1] == coded
+    assert coded in locations and coded.code in locations
+    assert locations.position(coded) == 1
+    assert list(locations[[4, 1]].codes) == [locations.codes[4], locations.codes[1]]
+    assert location_codes(locations) == location_codes(list(locations))
+    combined = [coded] + locations
+    assert isinstance(combined, LocationArray) and list(combined.codes[:2]) == [coded.code, locations.codes[0]]
+
+
+def test_lat_lon_lengths_must_match():
+    with pytest.raises(ValueError):
+        LocationArray([-41.0, -42.0], [174.0])
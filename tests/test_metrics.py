@@ -0,0 +1,70 @@
+import pytest
+
+from nzshm_hazlab.store import cache, curves, curves_v4
+from nzshm_hazlab.store.benchmark import HAZARD_ID, VS30, FakeTHS, fake_ths, synthetic_locations
+from nzshm_hazlab.store.metrics import FetchMetrics
+
+IMTS = ['PGA', 'SA(1.0)']
+AGGS = ['mean', '0.9']
+
+
+def test_totals_and_events():
+    events = []
+    metrics = FetchMetrics(callback=lambda event, data: events.append((event, data)))
+    for latency in (0.1, 0.4, 0.2, 0.3):
+        metrics.record_chunk('ths', latency, 10, 100)
+    metrics.record_retry('ths', RuntimeError('throttled'), 1.5)
+    metrics.record_cache('cache', 3, 1)
+
+    assert (metrics.records, metrics.bytes_decoded, metrics.retries) == (40, 400, 1)
+    assert metrics.fetch_time == pytest.approx(1.0)
+    assert metrics.cache_hit_ratio == 0.75
+    assert metrics.latency_percentiles((50, 99)) == {50: 0.3, 99: 0.4}
+    assert [event for event, _ in events] == ['chunk'] * 4 + ['retry', 'cache']
+    assert events[-1][1] == dict(source='cache', hits=3, misses=1)
+    assert 'records: 40' in metrics.summary()
+
+
+@pytest.mark.parametrize('max_workers', [None, 2])
+def test_ths_chunks_are_recorded(max_workers):
+    locs = synthetic_locations(5)
+    metrics = FetchMetrics()
+    with fake_ths(FakeTHS()):
+        curves.get_hazard(HAZARD_ID, VS30, locs, IMTS, AGGS, chunk_size=2, max_workers=max_workers, metrics=metrics)
+
+    nchunks = 3 if max_workers else 1
+    assert len(metrics.chunks) == nchunks
+    assert metrics.records == len(locs) * len(IMTS) * len(AGGS)
+    assert metrics.bytes_decoded == metrics.records * 16 * len(curves_v4.imtls)
+
+
+def test_throttled_queries_are_retried(monkeypatch):
+    fake = FakeTHS()
+    calls = []
+
+    def get_hazard_curves(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise RuntimeError('ProvisionedThroughputExceededException: slow down')
+        return fake.get_hazard_curves(*args)
+
+    monkeypatch.setattr(curves.query, 'get_hazard_curves', get_hazard_curves)
+    monkeypatch.setattr(curves.time, 'sleep', lambda delay: None)
+    metrics = FetchMetrics()
+    hazard_curves = curves.get_hazard(HAZARD_ID, VS30, synthetic_locations(2), IMTS, AGGS, max_workers=1, metrics=metrics)
+
+    assert metrics.retries == 1
+    assert len(hazard_curves) == 2 * len(IMTS) * len(AGGS)
+
+
+def test_cache_hits_and_misses_are_recorded(tmp_path):
+    locs = synthetic_locations(4)
+    curve_cache = cache.CurveCache(tmp_path)
+    metrics = FetchMetrics()
+    with fake_ths(FakeTHS()):
+        cache.get_hazard(curve_cache, HAZARD_ID, VS30, locs[:2], IMTS, AGGS, metrics=metrics)
+        cache.get_hazard(curve_cache, HAZARD_ID, VS30, locs, IMTS, AGGS, metrics=metrics)
+
+    ncurves = len(IMTS) * len(AGGS)
+    assert (metrics.cache_hits, metrics.cache_misses) == (2 * ncurves, 4 * ncurves)
+    assert [chunk.source for chunk in metrics.chunks] == ['cache', 'ths', 'cache', 'ths']
@@ -0,0 +1,173 @@
+import numpy as np
+import pytest
+
+from nzshm_hazlab.hazard_cube import HazardCube
+from nzshm_hazlab.store import curves, sources
+from nzshm_hazlab.store.benchmark import (
+    HAZARD_ID,
+    VS30,
+    FakeTHS,
+    fake_ths,
+    synthetic_locations,
+    write_synthetic_dataset,
+    write_synthetic_oqcsv,
+)
+
+IMTS = ['PGA', 'SA(1.0)']
+AGGS = ['mean', '0.9']
+
+
+def codes(hazard_curves):
+    return list(hazard_curves['lat'] + '~' + hazard_curves['lon'])
+
+
+def assert_request_order(hazard_curves, locs, imts, aggs):
+    assert codes(hazard_curves) == list(np.repeat([loc.code for loc in locs], len(imts) * len(aggs)))
+    assert list(hazard_curves['imt']) == list(np.tile(np.repeat(imts, len(aggs)), len(locs)))
+    assert list(hazard_curves['agg']) == list(np.tile(aggs, len(locs) * len(imts)))
+
+
+@pytest.fixture
+def hdf5_source(oq_calc):
+    return sources.OQHDF5Source({'calc': oq_calc.path}, {'calc': VS30})
+
+
+def test_hdf5_metadata(hdf5_source, oq_calc):
+    metadata = hdf5_source.metadata('calc')
+
+    assert metadata.locations == list(oq_calc.locations.codes)
+    assert metadata.imts == oq_calc.imts
+    assert metadata.aggs == oq_calc.aggs
+    np.testing.assert_array_equal(metadata.levels, oq_calc.levels)
+    np.testing.assert_array_equal(metadata.weights, oq_calc.weights)
+
+
+def test_hdf5_get_hazard(hdf5_source, oq_calc):
+    locs = oq_calc.locations[[3, 0]]
+    hazard_curves = hdf5_source.get_hazard('calc', VS30, locs, ['SA(1.0)'], ['0.9', 'mean'])
+    cube = hdf5_source.get_hazard('calc', VS30, locs, ['SA(1.0)'], ['0.9', 'mean'], as_cube=True)
+
+    assert_request_order(hazard_curves, locs, ['SA(1.0)'], ['0.9', 'mean'])
+    np.testing.assert_array_equal(hazard_curves['apoe'][0], oq_calc.stats[3, 2, 1])
+    np.testing.assert_array_equal(hazard_curves['apoe'][3], oq_calc.stats[0, 0, 1])
+    assert cube.locations == list(locs.codes)
+    np.testing.assert_array_equal(cube.values[:, 0, 0], oq_calc.stats[[3, 0], 2, 1])
+
+
+def test_hdf5_get_realizations(hdf5_source, oq_calc):
+    locs = oq_calc.locations[[1, 4]]
+    cube, weights = hdf5_source.get_realizations('calc', VS30, locs, ['PGA'])
+
+    np.testing.assert_array_equal(weights, oq_calc.weights)
+    assert cube.aggs == ['0', '1', '2']
+    np.testing.assert_array_equal(cube.values[:, 0], oq_calc.rlzs[[1, 4], :, 0])
+
+
+def test_hdf5_only_serves_the_vs30_of_its_run(hdf5_source, oq_calc):
+    assert hdf5_source.available('calc', VS30)
+    assert not hdf5_source.available('calc', 750)
+    assert not hdf5_source.available('other', VS30)
+    with pytest.raises(ValueError):
+        hdf5_source.get_hazard('calc', 750, oq_calc.locations, IMTS, ['mean'])
+
+
+def test_oqcsv_source(tmp_path):
+    locs = synthetic_locations(6)
+    pattern = write_synthetic_oqcsv(tmp_path, locs, IMTS)
+    source = sources.OQCSVSource({'csv': pattern}, {'csv': VS30})
+
+    request = locs[[5, 2]]
+    hazard_curves = source.get_hazard('csv', VS30, request, IMTS[::-1], ['mean'])
+
+    assert_request_order(hazard_curves, request, IMTS[::-1], ['mean'])
+    expected = curves.get_hazard_from_oqcsv(pattern, IMTS)
+    np.testing.assert_array_equal(hazard_curves['apoe'][0], expected['apoe'][len(locs) + 5])
+    assert not source.available('csv', 750)
+    with pytest.raises(ValueError):
+        source.get_hazard('csv', 750, request, IMTS, ['mean'])
+
+
+def test_ths_and_arrow_sources_agree_on_layout(tmp_path):
+    locs = synthetic_locations(6)
+    fs_specs = write_synthetic_dataset(tmp_path, HAZARD_ID, VS30, locs, IMTS, AGGS)
+    arrow = sources.ArrowSource(fs_specs)
+    ths = sources.THSSource(chunk_size=2, max_workers=2)
+
+    request = locs[[4, 1, 2]]
+    with fake_ths(FakeTHS()):
+        from_ths = ths.get_hazard(HAZARD_ID, VS30, request, IMTS, AGGS)
+    from_arrow = arrow.get_hazard(HAZARD_ID, VS30, request, IMTS, AGGS)
+
+    for hazard_curves in (from_ths, from_arrow):
+        assert list(hazard_curves.columns) == sources.COLUMNS
+        assert_request_order(hazard_curves, request, IMTS, AGGS)
+    assert arrow.available(HAZARD_ID, VS30) and not arrow.available(HAZARD_ID, 750)
+    assert arrow.capabilities.local and not ths.capabilities.local
+
+
+def test_router_and_config(tmp_path, oq_calc):
+    fs_specs = write_synthetic_dataset(tmp_path / 'arrow', HAZARD_ID, VS30, oq_calc.locations, IMTS, AGGS)
+    router = sources.source_from_config(
+        {
+            'type': 'router',
+            'sources': [
+                {'type': 'ths', 'max_workers': 2},
+                {'type': 'oqhdf5', 'files': {'calc': str(oq_calc.path)}, 'vs30s': {'calc': VS30}},
+                {'type': 'arrow', 'arrow_fs': 'local', 'arrow_dir': fs_specs['arrow_dir']},
+            ],
+        }
+    )
+
+    assert isinstance(router.source_for(HAZARD_ID, VS30), sources.ArrowSource)
+    assert isinstance(router.source_for(HAZARD_ID, 750), sources.THSSource)
+    assert isinstance(router.source_for('calc', VS30, realizations=True), sources.OQHDF5Source)
+    cube, weights = router.get_realizations('calc', VS30, oq_calc.locations[:2], ['PGA'])
+    np.testing.assert_array_equal(cube.values[:, 0], oq_calc.rlzs[:2, :, 0])
+    hazard = router.get_hazard('calc', VS30, oq_calc.locations[:2], ['PGA'], ['mean'], as_cube=True)
+    assert isinstance(hazard, HazardCube)
+    with pytest.raises(KeyError):
+        router.source_for('calc', 750, realizations=True)
+    with pytest.raises(ValueError):
+        sources.source_from_config({'type': 'unknown'})
+
+
+def test_cached_and_concurrent_sources(tmp_path):
+    locs = synthetic_locations(7)
+    fake = FakeTHS()
+    source = sources.source_from_config(
+        {'type': 'ths', 'concurrency': {'chunk_size': 3, 'max_workers': 2}, 'cache': {'cache_dir': str(tmp_path)}}
+    )
+    assert isinstance(source, sources.CachedSource) and isinstance(source.source, sources.ConcurrentSource)
+
+    with fake_ths(fake):
+        cold = source.get_hazard(HAZARD_ID, VS30, locs, IMTS, AGGS)
+        calls = fake.calls
+        warm = source.get_hazard(HAZARD_ID, VS30, locs[::-1], IMTS, AGGS)
+
+    assert calls == 3 and fake.calls == calls
+    assert_request_order(cold, locs, IMTS, AGGS)
+    assert_request_order(warm, locs[::-1], IMTS, AGGS)
+
+
+def test_arrow_cube_is_in_request_order(tmp_path):
+    locs = synthetic_locations(6)
+    arrow = sources.ArrowSource(write_synthetic_dataset(tmp_path, HAZARD_ID, VS30, locs, IMTS, AGGS))
+
+    request = locs[[4, 1, 2]]
+    cube = arrow.get_hazard(HAZARD_ID, VS30, request, IMTS[::-1], AGGS[::-1], as_cube=True)
+    hazard_curves = arrow.get_hazard(HAZARD_ID, VS30, request, IMTS[::-1], AGGS[::-1])
+
+    assert (cube.locations, cube.imts, cube.aggs) == (list(request.codes), IMTS[::-1], AGGS[::-1])
+    np.testing.assert_array_equal(cube.values.reshape(len(hazard_curves), -1), np.vstack(hazard_curves['apoe']))
+
+
+def test_router_prefers_local_sources_to_a_cache_in_front_of_ths(tmp_path):
+    locs = synthetic_locations(3)
+    fs_specs = write_synthetic_dataset(tmp_path / 'arrow', HAZARD_ID, VS30, locs, IMTS, AGGS)
+    cached_ths = sources.source_from_config({'type': 'ths', 'cache': {'cache_dir': str(tmp_path / 'cache')}})
+    router = sources.SourceRouter([cached_ths, sources.THSSource(), sources.ArrowSource(fs_specs)])
+
+    assert not cached_ths.capabilities.local
+    assert [type(source) for source in router.sources] == [sources.ArrowSource, sources.CachedSource, sources.THSSource]
+    assert router.source_for(HAZARD_ID, VS30) is router.sources[0]
+    assert router.source_for(HAZARD_ID, 750) is cached_ths